@@ -0,0 +1,271 @@
+"""
+End-to-end benchmarks for sqlite-comprehend entities, against a fake client
+
+Generate synthetic databases, then time runs against them:
+
+    python benchmarks/entities.py generate --rows 10000 --rows 1000000
+    python benchmarks/entities.py run --rows 10000 --compound --latency 0.02
+    python benchmarks/entities.py run --rows 10000 -- --concurrency 4 --cache
+
+Anything after -- is passed on to sqlite-comprehend entities. Each run is
+made in a fresh process so that peak RSS is measured for that run alone.
+Results are written as JSON, by default to benchmarks/results/<commit>.json
+"""
+
+from fake_comprehend import FakeComprehend
+from unittest import mock
+import click
+import datetime
+import json
+import os
+import pathlib
+import random
+import resource
+import sqlite_utils
+import subprocess
+import sys
+import time
+
+HERE = pathlib.Path(__file__).parent
+
+WORDS = (
+    "the of and to in is was for on that with as by at from his her city river "
+    "council company university museum station library minister president "
+    "village county festival railway school church bridge market hospital "
+    "harbour parliament cathedral stadium orchestra newspaper"
+).split()
+
+NAMES = (
+    "Alice Bob Carol Dave Erin Frank Grace Heidi Ivan Judy Mallory Niaj Olivia "
+    "Peggy Rupert Sybil Trent Victor Walter London Paris Berlin Madrid Rome "
+    "Lisbon Vienna Dublin Oslo Acme Globex Initech Umbrella Hooli Vandelay"
+).split()
+
+
+def database_path(data_dir, rows, compound):
+    return pathlib.Path(data_dir) / "pages-{}-{}.db".format(
+        rows, "compound" if compound else "single"
+    )
+
+
+def sentences(count, seed=0):
+    generator = random.Random(seed)
+    result = []
+    for _ in range(count):
+        words = [
+            generator.choice(NAMES if generator.random() < 0.2 else WORDS)
+            for _ in range(generator.randint(8, 25))
+        ]
+        result.append(" ".join(words).capitalize() + ".")
+    return result
+
+
+def generate_database(path, rows, compound=False, seed=0):
+    "Create a pages table with rows rows of synthetic text"
+    generator = random.Random(seed)
+    pool = sentences(2000, seed)
+    path = pathlib.Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if path.exists():
+        path.unlink()
+    db = sqlite_utils.Database(path)
+    columns = {"id": int, "text": str}
+    if compound:
+        columns = {"section": str, "id": int, "text": str}
+    db["pages"].create(columns, pk=("section", "id") if compound else "id")
+    sql = "insert into pages ({}) values ({})".format(
+        ", ".join(columns), ", ".join("?" for _ in columns)
+    )
+
+    def generated():
+        for id in range(1, rows + 1):
+            text = " ".join(generator.sample(pool, generator.randint(2, 8)))
+            if compound:
+                yield ("section-{}".format(id % 10), id, text)
+            else:
+                yield (id, text)
+
+    with db.conn:
+        db.conn.executemany(sql, generated())
+    return path
+
+
+@click.group()
+def cli():
+    "Benchmarks for sqlite-comprehend entities"
+
+
+@cli.command()
+@click.option(
+    "rows_options",
+    "--rows",
+    type=int,
+    multiple=True,
+    default=(10000,),
+    help="Rows to generate, can be used more than once",
+)
+@click.option("--compound", is_flag=True, help="Use a compound primary key")
+@click.option("--data-dir", default=str(HERE / "data"), help="Where to write databases")
+def generate(rows_options, compound, data_dir):
+    "Generate synthetic databases"
+    for rows in rows_options:
+        start = time.perf_counter()
+        path = generate_database(
+            database_path(data_dir, rows, compound), rows, compound
+        )
+        click.echo("{} in {:.1f}s".format(path, time.perf_counter() - start))
+
+
+def fake_options(fn):
+    for decorator in reversed(
+        (
+            click.option(
+                "--latency",
+                type=float,
+                default=0.05,
+                help="Seconds for each fake API call",
+            ),
+            click.option(
+                "--throttle-rate",
+                type=float,
+                default=0.0,
+                help="Fraction of calls that are throttled",
+            ),
+            click.option(
+                "--error-rate",
+                type=float,
+                default=0.0,
+                help="Fraction of documents that fail",
+            ),
+            click.option(
+                "--entity-density",
+                type=float,
+                default=1.0,
+                help="Entities per 100 characters of text",
+            ),
+        )
+    ):
+        fn = decorator(fn)
+    return fn
+
+
+@cli.command(context_settings={"ignore_unknown_options": True})
+@click.option(
+    "rows_options",
+    "--rows",
+    type=int,
+    multiple=True,
+    default=(10000,),
+    help="Size of database to run against, can be used more than once",
+)
+@click.option("--compound", is_flag=True, help="Use a compound primary key")
+@click.option("--data-dir", default=str(HERE / "data"), help="Where databases are kept")
+@click.option("-o", "--output", help="JSON file to write results to")
+@fake_options
+@click.argument("extra", nargs=-1, type=click.UNPROCESSED)
+def run(rows_options, compound, data_dir, output, extra, **fake_settings):
+    "Run entities against generated databases using a fake client"
+    commit = git_commit()
+    runs = []
+    for rows in rows_options:
+        path = database_path(data_dir, rows, compound)
+        if not path.exists():
+            click.echo("Generating {}".format(path), err=True)
+            generate_database(path, rows, compound)
+        args = [sys.executable, __file__, "run-one", str(path)]
+        for key, value in fake_settings.items():
+            args.extend(["--{}".format(key.replace("_", "-")), str(value)])
+        args.append("--")
+        args.extend(extra)
+        result = json.loads(subprocess.check_output(args))
+        result.update({"rows_in_table": rows, "compound": compound})
+        runs.append(result)
+        click.echo(
+            "{rows_in_table} rows{compound}: {rows_per_second:,.0f} rows/s, "
+            "{mentions_per_second:,.0f} mentions/s, peak RSS {peak_rss_mb:.0f}MB, "
+            "first API call after {time_to_first_call:.3f}s".format(
+                **dict(result, compound=" (compound)" if compound else "")
+            )
+        )
+    output = pathlib.Path(output or HERE / "results" / "{}.json".format(commit))
+    output.parent.mkdir(parents=True, exist_ok=True)
+    output.write_text(
+        json.dumps(
+            {
+                "commit": commit,
+                "date": datetime.datetime.utcnow().isoformat(),
+                "python": sys.version.split()[0],
+                "sqlite": sqlite_utils.Database(memory=True)
+                .execute("select sqlite_version()")
+                .fetchone()[0],
+                "settings": dict(fake_settings, extra=list(extra)),
+                "runs": runs,
+            },
+            indent=2,
+        )
+    )
+    click.echo("Results written to {}".format(output))
+
+
+@cli.command(
+    name="run-one", hidden=True, context_settings={"ignore_unknown_options": True}
+)
+@click.argument("path")
+@fake_options
+@click.argument("extra", nargs=-1, type=click.UNPROCESSED)
+def run_one(path, extra, **fake_settings):
+    from sqlite_comprehend.cli import cli as sqlite_comprehend
+
+    fake = FakeComprehend(**fake_settings)
+    # The fake client does its own throttling, so --rate defaults to no limit
+    args = ["entities", path, "pages", "text", "--reset", "--no-count"]
+    args += ["--rate", "1000000"] + list(extra)
+    start = time.perf_counter()
+    with mock.patch("sqlite_comprehend.cli.make_client", return_value=fake):
+        with open(os.devnull, "w") as devnull, mock.patch("sys.stderr", devnull):
+            sqlite_comprehend.main(args, standalone_mode=False)
+    duration = time.perf_counter() - start
+    db = sqlite_utils.Database(path)
+    rows = db["pages_comprehend_entities_done"].count
+    mentions = db["pages_comprehend_entities"].count
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform != "darwin":
+        # Linux reports kilobytes, macOS reports bytes
+        peak_rss *= 1024
+    click.echo(
+        json.dumps(
+            {
+                "args": args[1:],
+                "seconds": duration,
+                "rows": rows,
+                "mentions": mentions,
+                "api_calls": fake.calls,
+                "throttled": fake.throttled,
+                "rows_per_second": rows / duration,
+                "mentions_per_second": mentions / duration,
+                "peak_rss_mb": peak_rss / 1024 / 1024,
+                "time_to_first_call": (
+                    fake.first_call - start if fake.first_call else None
+                ),
+            }
+        )
+    )
+
+
+def git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "--short", "HEAD"],
+                cwd=str(HERE),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode("utf-8")
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+if __name__ == "__main__":
+    cli()
@@ -0,0 +1,149 @@
+"""
+A local stand-in for the boto3 Comprehend client, for benchmarks
+
+Responses are generated from the text that is sent, so the same text always
+produces the same entities. Latency, throttling and per-document errors are
+simulated at configurable rates.
+"""
+
+from botocore.exceptions import ClientError
+import random
+import re
+import threading
+import time
+
+WORD_RE = re.compile(r"\w+")
+
+ENTITY_TYPES = ("PERSON", "LOCATION", "ORGANIZATION", "DATE", "OTHER")
+
+
+class FakeComprehend:
+    def __init__(
+        self,
+        latency=0.05,
+        throttle_rate=0.0,
+        error_rate=0.0,
+        entity_density=1.0,
+        seed=0,
+    ):
+        # Seconds per API call
+        self.latency = latency
+        # Fraction of API calls that raise ThrottlingException
+        self.throttle_rate = throttle_rate
+        # Fraction of documents that are returned in ErrorList
+        self.error_rate = error_rate
+        # Entities returned per 100 characters of text
+        self.entity_density = entity_density
+        self.calls = 0
+        self.documents = 0
+        self.throttled = 0
+        self.first_call = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _start_call(self, documents):
+        with self._lock:
+            if self.first_call is None:
+                self.first_call = time.perf_counter()
+            self.calls += 1
+            throttled = self._random.random() < self.throttle_rate
+            if throttled:
+                self.throttled += 1
+            else:
+                self.documents += documents
+        time.sleep(self.latency)
+        if throttled:
+            raise ClientError(
+                {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+                "BatchDetectEntities",
+            )
+
+    def _failed(self):
+        if not self.error_rate:
+            return False
+        with self._lock:
+            return self._random.random() < self.error_rate
+
+    def _spans(self, text):
+        "Deterministic (word, begin, end) spans to report for text"
+        words = [match for match in WORD_RE.finditer(text) if len(match.group()) > 3]
+        wanted = int(len(text) * self.entity_density / 100)
+        if not words or not wanted:
+            return []
+        step = max(len(words) // wanted, 1)
+        return [(match.group(), match.start(), match.end()) for match in words[::step]][
+            :wanted
+        ]
+
+    def _batch(self, TextList, detect):
+        self._start_call(len(TextList))
+        response = {"ResultList": [], "ErrorList": []}
+        for index, text in enumerate(TextList):
+            if self._failed():
+                response["ErrorList"].append(
+                    {
+                        "Index": index,
+                        "ErrorCode": "INTERNAL_SERVER_ERROR",
+                        "ErrorMessage": "Simulated failure",
+                    }
+                )
+            else:
+                response["ResultList"].append(dict(detect(text), Index=index))
+        return response
+
+    def _entities(self, text):
+        return {
+            "Entities": [
+                {
+                    "Score": 0.9,
+                    "Type": ENTITY_TYPES[len(word) % len(ENTITY_TYPES)],
+                    "Text": word,
+                    "BeginOffset": begin,
+                    "EndOffset": end,
+                }
+                for word, begin, end in self._spans(text)
+            ]
+        }
+
+    def batch_detect_entities(self, TextList, LanguageCode):
+        return self._batch(TextList, self._entities)
+
+    def batch_detect_key_phrases(self, TextList, LanguageCode):
+        return self._batch(
+            TextList,
+            lambda text: {
+                "KeyPhrases": [
+                    {
+                        "Score": 0.9,
+                        "Text": word,
+                        "BeginOffset": begin,
+                        "EndOffset": end,
+                    }
+                    for word, begin, end in self._spans(text)
+                ]
+            },
+        )
+
+    def batch_detect_sentiment(self, TextList, LanguageCode):
+        return self._batch(
+            TextList,
+            lambda text: {
+                "Sentiment": "NEUTRAL",
+                "SentimentScore": {
+                    "Positive": 0.1,
+                    "Negative": 0.1,
+                    "Neutral": 0.7,
+                    "Mixed": 0.1,
+                },
+            },
+        )
+
+    def detect_pii_entities(self, Text, LanguageCode):
+        self._start_call(1)
+        return {
+            "Entities": [
+                dict(entity, Type="NAME")
+                for entity in self._entities(Text)["Entities"]
+                if entity["Type"] == "PERSON"
+            ]
+        }
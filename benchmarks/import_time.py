@@ -0,0 +1,76 @@
+"""
+Time how long it takes to start the command-line tool, which is paid on
+every call - even for --help and --version
+
+    python benchmarks/import_time.py
+
+Exits with an error if boto3 or botocore are imported before a command
+needs a client, or if the best time is over --max-ms.
+"""
+
+import click
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ("boto3", "botocore", "s3transfer")
+
+CHECK = """
+import sys
+import sqlite_comprehend.cli
+print(",".join(sorted({{name.split(".")[0] for name in sys.modules}} & {heavy!r})))
+""".format(heavy=set(HEAVY_MODULES))
+
+
+def run(args):
+    start = time.perf_counter()
+    subprocess.run(
+        [sys.executable] + args,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    return time.perf_counter() - start
+
+
+@click.command()
+@click.option("--repeat", type=int, default=10, help="Runs of each command")
+@click.option(
+    "--max-ms",
+    type=float,
+    help="Fail if the best time for --help is more than this many milliseconds",
+)
+def cli(repeat, max_ms):
+    commands = {
+        "python": ["-c", "pass"],
+        "import sqlite_comprehend.cli": ["-c", "import sqlite_comprehend.cli"],
+        "sqlite-comprehend --help": ["-m", "sqlite_comprehend", "--help"],
+        "sqlite-comprehend --version": ["-m", "sqlite_comprehend", "--version"],
+    }
+    best = {}
+    for name, args in commands.items():
+        timings = [run(args) for _ in range(repeat)]
+        best[name] = min(timings)
+        click.echo(
+            "{:<30} best {:7.1f}ms  median {:7.1f}ms".format(
+                name, best[name] * 1000, statistics.median(timings) * 1000
+            )
+        )
+    imported = subprocess.run(
+        [sys.executable, "-c", CHECK], check=True, capture_output=True, text=True
+    ).stdout.strip()
+    if imported:
+        raise click.ClickException(
+            "Importing sqlite_comprehend.cli also imported: {}".format(imported)
+        )
+    if max_ms is not None and best["sqlite-comprehend --help"] * 1000 > max_ms:
+        raise click.ClickException(
+            "--help took {:.1f}ms, more than --max-ms {}".format(
+                best["sqlite-comprehend --help"] * 1000, max_ms
+            )
+        )
+
+
+if __name__ == "__main__":
+    cli()
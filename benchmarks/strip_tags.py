@@ -0,0 +1,83 @@
+"""
+Compare strip_tags(), which reuses one HTMLParser per thread, with the
+previous implementation, which created a new HTMLParser for every pass
+
+    python benchmarks/strip_tags.py
+
+The nested inputs are the worst case for both, as each tag is only formed
+by removing the one inside it - so the value is parsed once per level.
+"""
+
+from html.parser import HTMLParser
+from sqlite_comprehend.utils import strip_tags
+import timeit
+
+PAGE = (
+    "<html><head><title>Page &amp; title</title>"
+    "<style>body { font-family: sans-serif }</style>"
+    "<script>if (a < b) { document.write('<p>') }</script></head>"
+    "<body><div class='content'><p>Some <b>bold</b> and <i>italic</i> text, "
+    "a &lt; b &#169; 2022.</p><ul><li>One</li><li>Two</li></ul></div></body></html>\n"
+)
+
+INPUTS = {
+    "small": PAGE,
+    "medium": PAGE * 200,
+    "large": PAGE * 20000,
+    "nested": "<" * 500 + "a>" * 500,
+    "nested4x": "<" * 2000 + "a>" * 2000,
+}
+
+
+class OldMLStripper(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.reset()
+        self.accumulated = []
+
+    def handle_data(self, d):
+        self.accumulated.append(d)
+
+    def handle_entityref(self, name):
+        self.accumulated.append("&%s;" % name)
+
+    def handle_charref(self, name):
+        self.accumulated.append("&#%s;" % name)
+
+    def get_string(self):
+        return "".join(self.accumulated)
+
+
+def old_strip_tags(value):
+    value = str(value)
+    while "<" in value and ">" in value:
+        s = OldMLStripper()
+        s.feed(value)
+        s.close()
+        new_value = s.get_string()
+        if value.count("<") == new_value.count("<"):
+            break
+        value = new_value
+    return value
+
+
+def best_of(fn, value, repeat=3):
+    # autorange() times enough calls to take at least 0.2 seconds, which is
+    # a single call for the old implementation on the nested inputs
+    timer = timeit.Timer(lambda: fn(value))
+    number, elapsed = timer.autorange()
+    if elapsed > 1:
+        return elapsed / number
+    return min([elapsed] + timer.repeat(repeat - 1, number)) / number
+
+
+if __name__ == "__main__":
+    print("{:<8} {:>12} {:>12} {:>12} {:>8}".format("input", "bytes", "old", "new", ""))
+    for name, value in INPUTS.items():
+        old = best_of(old_strip_tags, value)
+        new = best_of(strip_tags, value)
+        print(
+            "{:<8} {:>12,} {:>11.2f}ms {:>11.2f}ms {:>7.1f}x".format(
+                name, len(value.encode("utf-8")), old * 1000, new * 1000, old / new
+            )
+        )
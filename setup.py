@@ -31,7 +31,12 @@ setup(
         [console_scripts]
         sqlite-comprehend=sqlite_comprehend.cli:cli
     """,
-    install_requires=["click", "boto3", "sqlite-utils"],
+    install_requires=[
+        "click",
+        "boto3",
+        "sqlite-utils",
+        'tomli; python_version < "3.11"',
+    ],
     extras_require={"test": ["pytest", "pytest-mock", "cogapp"]},
     python_requires=">=3.7",
 )
@@ -0,0 +1,18 @@
+from .extractor import EntityExtractor, Extractor
+from .pipeline import (
+    EntitiesAnalysis,
+    KeyPhrasesAnalysis,
+    PiiAnalysis,
+    Result,
+    SentimentAnalysis,
+)
+
+__all__ = [
+    "EntitiesAnalysis",
+    "EntityExtractor",
+    "Extractor",
+    "KeyPhrasesAnalysis",
+    "PiiAnalysis",
+    "Result",
+    "SentimentAnalysis",
+]
@@ -0,0 +1,155 @@
+import json
+import tarfile
+import tempfile
+import time
+import click
+
+# Documents written to each input file uploaded to S3
+LINES_PER_FILE = 10000
+
+FINISHED_STATUSES = {"COMPLETED", "FAILED", "STOPPED"}
+
+
+def parse_s3_uri(uri):
+    "Split s3://bucket/prefix into (bucket, prefix)"
+    if not uri.startswith("s3://"):
+        raise click.ClickException("S3 URI must start with s3://: {}".format(uri))
+    bucket, _, prefix = uri[len("s3://") :].partition("/")
+    return bucket, prefix.strip("/")
+
+
+def export_texts(s3, bucket, prefix, texts, lines_per_file=None):
+    """
+    Upload texts to S3 as ONE_DOC_PER_LINE files under prefix
+
+    Newlines within each text are replaced by spaces, which leaves the
+    character offsets returned by Comprehend unchanged. Returns a list of
+    (file name, number of lines) tuples, in the order the texts were read.
+    """
+    lines_per_file = lines_per_file or LINES_PER_FILE
+    files = []
+    texts = iter(texts)
+    while True:
+        count = 0
+        with tempfile.TemporaryFile() as fp:
+            for text in texts:
+                fp.write(
+                    text.replace("\r", " ").replace("\n", " ").encode("utf-8") + b"\n"
+                )
+                count += 1
+                if count == lines_per_file:
+                    break
+            if not count:
+                break
+            name = "part-{:05d}.txt".format(len(files))
+            fp.seek(0)
+            s3.upload_fileobj(fp, bucket, "{}/{}".format(prefix, name))
+            files.append((name, count))
+        if count < lines_per_file:
+            break
+    return files
+
+
+def wait_for_job(comprehend, job_id, poll_interval=30, sleep=time.sleep):
+    "Poll an entities detection job until it finishes, returning its properties"
+    while True:
+        properties = comprehend.describe_entities_detection_job(JobId=job_id)[
+            "EntitiesDetectionJobProperties"
+        ]
+        if properties["JobStatus"] in FINISHED_STATUSES:
+            return properties
+        sleep(poll_interval)
+
+
+def read_results(s3, output_uri):
+    """
+    Stream the gzipped tar output of a job, yielding one dict per document
+
+    Each dict has File and Line keys plus either Entities or an
+    ErrorCode and ErrorMessage.
+    """
+    bucket, key = parse_s3_uri(output_uri)
+    body = s3.get_object(Bucket=bucket, Key=key)["Body"]
+    with tarfile.open(fileobj=body, mode="r|gz") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            for line in tar.extractfile(member):
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+
+def run_job(
+    comprehend,
+    s3,
+    s3_uri,
+    data_access_role_arn,
+    job_name,
+    texts,
+    language_code="en",
+    poll_interval=30,
+    sleep=time.sleep,
+):
+    """
+    Run texts through an asynchronous entities detection job
+
+    Yields (index, result) pairs, where index is the position of the text
+    in texts. Results are yielded in the order they are read from the job
+    output, which is not necessarily the order of the input texts.
+    """
+    bucket, prefix = parse_s3_uri(s3_uri)
+    prefix = "/".join(part for part in (prefix, job_name) if part)
+    files = export_texts(s3, bucket, prefix + "/input", texts)
+    if not files:
+        return
+    job_id = comprehend.start_entities_detection_job(
+        InputDataConfig={
+            "S3Uri": "s3://{}/{}/input/".format(bucket, prefix),
+            "InputFormat": "ONE_DOC_PER_LINE",
+        },
+        OutputDataConfig={"S3Uri": "s3://{}/{}/output/".format(bucket, prefix)},
+        DataAccessRoleArn=data_access_role_arn,
+        JobName=job_name,
+        LanguageCode=language_code,
+    )["JobId"]
+    click.echo(
+        "Started entities detection job {} for {} documents".format(
+            job_id, sum(count for _, count in files)
+        ),
+        err=True,
+    )
+    properties = wait_for_job(comprehend, job_id, poll_interval, sleep)
+    if properties["JobStatus"] != "COMPLETED":
+        raise click.ClickException(
+            "Job {} {}: {}".format(
+                job_id, properties["JobStatus"], properties.get("Message", "")
+            )
+        )
+    offsets = {}
+    start = 0
+    for name, count in files:
+        offsets[name] = start
+        start += count
+    for result in read_results(s3, properties["OutputDataConfig"]["S3Uri"]):
+        name = result["File"].rsplit("/", 1)[-1]
+        yield offsets[name] + result["Line"], result
+
+
+def batch_response(results):
+    "Convert a list of job output results to a batch_detect_entities response"
+    response = {"ResultList": [], "ErrorList": []}
+    for index, result in enumerate(results):
+        if "Entities" in result:
+            response["ResultList"].append(
+                {"Index": index, "Entities": result["Entities"]}
+            )
+        else:
+            response["ErrorList"].append(
+                {
+                    "Index": index,
+                    "ErrorCode": result.get("ErrorCode"),
+                    "ErrorMessage": result.get("ErrorMessage"),
+                }
+            )
+    return response
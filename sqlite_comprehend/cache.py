@@ -0,0 +1,292 @@
+import collections
+import hashlib
+import json
+import zlib
+from sqlite_utils.utils import chunks
+
+# Each (type, name) pair uses two SQL parameters, stay well under the
+# SQLITE_MAX_VARIABLE_NUMBER default of 999 for older SQLite versions
+PAIRS_PER_QUERY = 400
+
+
+class EntityCache:
+    """
+    In-memory cache of comprehend_entities and comprehend_entity_types IDs
+
+    Maps entity type values to IDs and (type, name) pairs to entity IDs,
+    preloaded from the database. The entity map is an LRU bounded to
+    max_size entries - the handful of entity types are always kept.
+
+    New rows are inserted without committing, so they become part of the
+    caller's current transaction. Call reload() if that is rolled back.
+    """
+
+    def __init__(self, db, max_size=100000):
+        self.db = db
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.ensure_tables()
+        self.reload()
+
+    def ensure_tables(self):
+        types_table = self.db["comprehend_entity_types"]
+        if not types_table.exists():
+            types_table.create({"id": int, "value": str}, pk="id", if_not_exists=True)
+        types_table.create_index(["value"], unique=True, if_not_exists=True)
+        entities_table = self.db["comprehend_entities"]
+        if not entities_table.exists():
+            entities_table.create(
+                {"id": int, "name": str, "type": int},
+                pk="id",
+                foreign_keys=[("type", "comprehend_entity_types", "id")],
+                if_not_exists=True,
+            )
+        entities_table.create_index(["type", "name"], unique=True, if_not_exists=True)
+
+    def reload(self):
+        self.types = {}
+        self.entities = collections.OrderedDict()
+        for row in self.db.query("select id, value from comprehend_entity_types"):
+            self.types[row["value"]] = row["id"]
+        for row in self.db.query(
+            """
+            select comprehend_entities.id, comprehend_entity_types.value as type, name
+            from comprehend_entities
+            join comprehend_entity_types
+                on comprehend_entities.type = comprehend_entity_types.id
+            limit ?
+            """,
+            [self.max_size],
+        ):
+            self.entities[(row["type"], row["name"])] = row["id"]
+
+    def lookup_many(self, pairs):
+        "Returns a {(type, name): id} dictionary, inserting any new entities"
+        ids = {}
+        missing = []
+        for pair in pairs:
+            if pair in ids:
+                self.hits += 1
+                continue
+            id = self.entities.get(pair)
+            if id is None:
+                self.misses += 1
+                missing.append(pair)
+                # Placeholder so repeats within this call count as hits
+                ids[pair] = None
+            else:
+                self.hits += 1
+                self.entities.move_to_end(pair)
+                ids[pair] = id
+        if missing:
+            ids.update(self._fetch_or_insert(missing))
+        return ids
+
+    def _fetch_or_insert(self, pairs):
+        type_ids = self._type_ids(sorted({type_value for type_value, _ in pairs}))
+        wanted = [(type_ids[type_value], name) for type_value, name in pairs]
+        self.db.conn.executemany(
+            "insert or ignore into comprehend_entities (type, name) values (?, ?)",
+            wanted,
+        )
+        types_by_id = {id: type_value for type_value, id in type_ids.items()}
+        found = {}
+        for chunk in chunks(wanted, PAIRS_PER_QUERY):
+            chunk = list(chunk)
+            sql = "select id, type, name from comprehend_entities where (type, name) in (values {})".format(
+                ", ".join(["(?, ?)"] * len(chunk))
+            )
+            params = [value for pair in chunk for value in pair]
+            for id, type_id, name in self.db.execute(sql, params).fetchall():
+                found[(types_by_id[type_id], name)] = id
+        for pair, id in found.items():
+            self.entities[pair] = id
+        while len(self.entities) > self.max_size:
+            self.entities.popitem(last=False)
+        return found
+
+    def _type_ids(self, types):
+        missing = [type_value for type_value in types if type_value not in self.types]
+        if missing:
+            self.db.conn.executemany(
+                "insert or ignore into comprehend_entity_types (value) values (?)",
+                [(type_value,) for type_value in missing],
+            )
+            sql = "select id, value from comprehend_entity_types where value in ({})".format(
+                ", ".join("?" for _ in missing)
+            )
+            for id, value in self.db.execute(sql, missing).fetchall():
+                self.types[value] = id
+        return {type_value: self.types[type_value] for type_value in types}
+
+
+class ResponseCache:
+    """
+    Content-addressed cache of Comprehend responses, in comprehend_cache
+
+    Keys are a SHA-256 hash of the API name, the language code and the
+    final prepared text. Each cached value is the zlib-compressed JSON
+    result for a single document. Callers record hits and misses.
+
+    language_code is the default, for documents that don't have their own.
+    """
+
+    table_name = "comprehend_cache"
+
+    def __init__(self, db, api, language_code):
+        self.db = db
+        self.api = api
+        self.language_code = language_code
+        self.hits = 0
+        self.misses = 0
+        table = db[self.table_name]
+        if not table.exists():
+            table.create(
+                {"key": str, "api": str, "language_code": str, "response": bytes},
+                pk="key",
+                if_not_exists=True,
+            )
+
+    def key(self, text, language_code=None):
+        return hashlib.sha256(
+            "\0".join((self.api, language_code or self.language_code, text)).encode(
+                "utf-8"
+            )
+        ).hexdigest()
+
+    def get_many(self, keys):
+        "Returns a {key: response} dictionary for the keys that are cached"
+        found = {}
+        for chunk in chunks(keys, PAIRS_PER_QUERY):
+            chunk = list(chunk)
+            sql = "select key, response from [{}] where key in ({})".format(
+                self.table_name, ", ".join("?" for _ in chunk)
+            )
+            for key, response in self.db.execute(sql, chunk).fetchall():
+                found[key] = json.loads(zlib.decompress(response))
+        return found
+
+    def set_many(self, items):
+        """
+        Store (key, response, language_code) - part of the caller's
+        transaction. language_code can be None for the default.
+        """
+        self.db.conn.executemany(
+            "insert or replace into [{}] (key, api, language_code, response) "
+            "values (?, ?, ?, ?)".format(self.table_name),
+            [
+                (
+                    key,
+                    self.api,
+                    language_code or self.language_code,
+                    zlib.compress(json.dumps(response).encode("utf-8")),
+                )
+                for key, response, language_code in items
+            ],
+        )
+
+    def count(self):
+        return self.db[self.table_name].count
+
+
+class LanguageCache:
+    """
+    The dominant language detected for each text, in comprehend_languages
+
+    Keys are a SHA-256 hash of the final prepared text, so a row is only
+    sent to batch_detect_dominant_language again if its text has changed.
+    """
+
+    table_name = "comprehend_languages"
+
+    def __init__(self, db):
+        self.db = db
+        self.hits = 0
+        self.misses = 0
+        table = db[self.table_name]
+        if not table.exists():
+            table.create(
+                {"key": str, "language_code": str, "score": float},
+                pk="key",
+                if_not_exists=True,
+            )
+        self.insert_sql = (
+            "insert or replace into [{}] (key, language_code, score) "
+            "values (?, ?, ?)".format(self.table_name)
+        )
+
+    def key(self, text):
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys):
+        "Returns a {key: language_code} dictionary for the keys that are cached"
+        found = {}
+        for chunk in chunks(keys, PAIRS_PER_QUERY):
+            chunk = list(chunk)
+            sql = "select key, language_code from [{}] where key in ({})".format(
+                self.table_name, ", ".join("?" for _ in chunk)
+            )
+            found.update(self.db.execute(sql, chunk).fetchall())
+        return found
+
+
+class ResponseArchive:
+    """
+    The result for each row processed by an analysis, kept so the output
+    table can be rebuilt without calling Comprehend again
+
+    Results for rows that were split into segments are stored after the
+    segments have been merged. Each result is zlib-compressed JSON, stored
+    next to the fingerprint recorded for the row in the _done table.
+    """
+
+    def __init__(self, db, table_name, pk_columns):
+        "pk_columns is a {name: type} dictionary of the row's primary keys"
+        self.db = db
+        self.table_name = table_name
+        self.pks = list(pk_columns)
+        table = db[table_name]
+        if not table.exists():
+            table.create(
+                dict(pk_columns, fingerprint=str, response=bytes),
+                pk=self.pks[0] if len(self.pks) == 1 else self.pks,
+                if_not_exists=True,
+            )
+        self.insert_sql = (
+            "insert or replace into [{}] ({}, [fingerprint], [response]) "
+            "values ({}, ?, ?)".format(
+                table_name,
+                ", ".join("[{}]".format(pk) for pk in self.pks),
+                ", ".join("?" for _ in self.pks),
+            )
+        )
+
+    def set_many(self, items):
+        "Store (pk_values, fingerprint, result) - part of the caller's transaction"
+        self.db.conn.executemany(
+            self.insert_sql,
+            [
+                pk_values
+                + (fingerprint, zlib.compress(json.dumps(result).encode("utf-8")))
+                for pk_values, fingerprint, result in items
+            ],
+        )
+
+    def pages(self, size=1000):
+        "Yield lists of up to size (pk_values, result) pairs, reading one cursor"
+        cursor = self.db.conn.execute(
+            "select {}, [response] from [{}]".format(
+                ", ".join("[{}]".format(pk) for pk in self.pks), self.table_name
+            )
+        )
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                return
+            yield [
+                (tuple(row[:-1]), json.loads(zlib.decompress(row[-1]))) for row in rows
+            ]
+
+    def count(self):
+        return self.db[self.table_name].count
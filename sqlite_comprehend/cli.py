@@ -1,8 +1,29 @@
 import click
+import collections
+import contextlib
+import os
 import sqlite_utils
-import json
-from sqlite_utils.utils import chunks
-from .utils import common_boto3_options, make_client, strip_tags
+from .extractor import Extractor
+from .jobs import Job, load_jobs
+from .pipeline import (
+    PAGE_SIZE,
+    SAMPLE_SIZE,
+    EntitiesAnalysis,
+    KeyPhrasesAnalysis,
+    PiiAnalysis,
+    SentimentAnalysis,
+    interleave,
+)
+from .metrics import STAGES, Metrics
+from .utils import (
+    BOTO3_OPTIONS,
+    CommitInterval,
+    Shard,
+    Types,
+    common_boto3_options,
+    make_client,
+)
+from .watch import Watcher, uninstall
 
 
 @click.group()
@@ -11,43 +32,202 @@ def cli():
     "Tools for running data in a SQLite database through AWS Comprehend"
 
 
+def job_options(fn):
+    "The pipeline options that apply to every job in a job file"
+    return pipeline_options(fn, per_table=False)
+
+
+def pipeline_options(fn, per_table=True):
+    # Options marked with table() are set in each job by the run command
+    def table(decorator):
+        return decorator if per_table else None
+
+    for decorator in reversed(
+        (
+            table(
+                click.argument(
+                    "database",
+                    type=click.Path(
+                        file_okay=True, dir_okay=False, allow_dash=False, exists=True
+                    ),
+                )
+            ),
+            table(click.argument("table")),
+            table(click.argument("columns", nargs=-1, required=True)),
+            table(click.option("--where", help="WHERE clause to filter table")),
+            table(
+                click.option(
+                    "params",
+                    "-p",
+                    "--param",
+                    multiple=True,
+                    type=(str, str),
+                    help="Named :parameters for SQL query",
+                )
+            ),
+            click.option(
+                "-r",
+                "--reset",
+                is_flag=True,
+                help="Start from scratch, deleting previous results",
+            ),
+            click.option(
+                "--incremental",
+                is_flag=True,
+                help="Also reprocess rows that have changed since they were processed",
+            ),
+            table(
+                click.option(
+                    "should_strip_tags",
+                    "--strip-tags",
+                    is_flag=True,
+                    help="Strip HTML tags before sending text to Comprehend",
+                )
+            ),
+            click.option(
+                "--segment",
+                is_flag=True,
+                help="Split text longer than 5000 bytes into segments instead of truncating it",
+            ),
+            click.option(
+                "--auto-language",
+                is_flag=True,
+                help="Detect the language of each row and batch rows by language",
+            ),
+            table(
+                click.option(
+                    "--language-column",
+                    help="Column with the language code for each row, instead of detecting it",
+                )
+            ),
+            click.option(
+                "--min-score",
+                type=click.FloatRange(min=0, max=1),
+                help="Only save entities and key phrases with at least this score",
+            ),
+            click.option(
+                "--types",
+                type=Types(),
+                help="Only save entities of these types, e.g. PERSON,LOCATION",
+            ),
+            click.option(
+                "--summary",
+                is_flag=True,
+                help="Keep mention counts for each entity in a _summary table",
+            ),
+            click.option(
+                "--prepare-workers",
+                type=click.IntRange(min=1),
+                help="Prepare text in this many worker processes",
+            ),
+            click.option(
+                "--concurrency",
+                type=click.IntRange(min=1),
+                default=1,
+                help="Number of batches to send to Comprehend at once",
+            ),
+            click.option(
+                "--commit-every",
+                type=CommitInterval(),
+                default="1",
+                help="Commit every N chunks, or every N seconds with e.g. 30s",
+            ),
+            click.option(
+                "--wal", is_flag=True, help="Enable WAL mode so readers are not blocked"
+            ),
+            table(
+                click.option(
+                    "--shard",
+                    type=Shard(),
+                    help="Only process rows in shard i of N, e.g. 1/4",
+                )
+            ),
+            click.option(
+                "--busy-timeout",
+                type=click.FloatRange(min=0),
+                default=30,
+                help="Seconds to wait for other processes writing to the database",
+            ),
+            click.option(
+                "use_cache",
+                "--cache",
+                is_flag=True,
+                help="Cache responses in comprehend_cache and reuse them for identical text",
+            ),
+            click.option(
+                "--archive",
+                is_flag=True,
+                help="Save each row's result so output tables can be recreated with rebuild",
+            ),
+            click.option(
+                "--no-count",
+                is_flag=True,
+                help="Don't count the rows to be processed for the progress bar",
+            ),
+            click.option(
+                "--rate",
+                type=click.FloatRange(min=0, min_open=True),
+                default=10.0,
+                help="Maximum API calls per second, reduced automatically if throttled",
+            ),
+            click.option(
+                "--max-retries",
+                type=click.IntRange(min=0),
+                default=5,
+                help="Times to retry throttled calls and failed documents",
+            ),
+            click.option(
+                "--max-units",
+                type=click.IntRange(min=1),
+                help="Stop before sending more than this many billable units",
+            ),
+            click.option(
+                "--dry-run",
+                is_flag=True,
+                help="Estimate the billable units for the pending rows, then exit",
+            ),
+            click.option(
+                "--retry-errors",
+                is_flag=True,
+                help="Retry rows that previously failed, recorded in comprehend_errors",
+            ),
+            click.option(
+                "--stats", is_flag=True, help="Show statistics at the end of the run"
+            ),
+            click.option(
+                "--metrics-file",
+                type=click.File("w"),
+                help="Write running totals to this file as JSON lines after each batch",
+            ),
+        )
+    ):
+        if decorator:
+            fn = decorator(fn)
+    return fn
+
+
 @cli.command()
-@click.argument(
-    "database",
-    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
-)
-@click.argument("table")
-@click.argument("columns", nargs=-1, required=True)
-@click.option("--where", help="WHERE clause to filter table")
+@pipeline_options
+@click.option("-o", "--output", help="Custom output table")
 @click.option(
-    "params",
-    "-p",
-    "--param",
-    multiple=True,
-    type=(str, str),
-    help="Named :parameters for SQL query",
+    "--bulk",
+    is_flag=True,
+    help="Use an asynchronous entities detection job instead of batch calls",
 )
-@click.option("-o", "--output", help="Custom output table")
+@click.option("--s3-uri", help="s3://bucket/prefix to use for --bulk input and output")
 @click.option(
-    "-r", "--reset", is_flag=True, help="Start from scratch, deleting previous results"
+    "--role-arn",
+    help="IAM role that allows Comprehend to access --s3-uri, for --bulk",
 )
 @click.option(
-    "should_strip_tags",
-    "--strip-tags",
-    is_flag=True,
-    help="Strip HTML tags before extracting entities",
+    "--poll-interval",
+    type=click.FloatRange(min=0),
+    default=30,
+    help="Seconds between checks on the status of a --bulk job",
 )
 @common_boto3_options
 def entities(
-    database,
-    table,
-    columns,
-    where,
-    params,
-    output,
-    reset,
-    should_strip_tags,
-    **boto_options
+    database, table, columns, output, bulk, s3_uri, role_arn, poll_interval, **kwargs
 ):
     """
     Detect entities in columns in a table
@@ -63,170 +243,656 @@ def entities(
     Results will be written to a table called mytable_comprehend_entities
 
     To specify a different output table, use -o custom_table_name
+
+    To keep up to 4 batches of 25 in flight at once, use --concurrency 4
+    """
+    if bulk and not (s3_uri and role_arn):
+        raise click.ClickException("--bulk requires --s3-uri and --role-arn")
+    if bulk and kwargs["segment"]:
+        raise click.ClickException("--segment cannot be used with --bulk")
+    if bulk and kwargs["max_units"]:
+        raise click.ClickException("--max-units cannot be used with --bulk")
+    if bulk and (kwargs["auto_language"] or kwargs["language_column"]):
+        raise click.ClickException(
+            "--auto-language and --language-column cannot be used with --bulk"
+        )
+    bulk_options = None
+    if bulk:
+        bulk_options = {
+            "s3_uri": s3_uri,
+            "role_arn": role_arn,
+            "poll_interval": poll_interval,
+        }
+    run_analyses(
+        database,
+        table,
+        columns,
+        [(EntitiesAnalysis, output)],
+        bulk_options=bulk_options,
+        **kwargs,
+    )
+
+
+@cli.command()
+@pipeline_options
+@click.option("analyze_entities", "--entities", is_flag=True, help="Detect entities")
+@click.option("--key-phrases", is_flag=True, help="Detect key phrases")
+@click.option("--sentiment", is_flag=True, help="Detect sentiment")
+@click.option("--pii", is_flag=True, help="Detect personally identifiable information")
+@common_boto3_options
+def analyze(
+    database, table, columns, analyze_entities, key_phrases, sentiment, pii, **kwargs
+):
+    """
+    Run one or more analyses against columns in a table
+
+    To detect entities and sentiment for columns text1 and text2 in mytable:
+
+        sqlite-comprehend analyze my.db mytable text1 text2 --entities --sentiment
+
+    Each row is read and its text prepared once, then sent to each of the
+    selected APIs. Results are written to tables called
+    mytable_comprehend_entities, mytable_comprehend_key_phrases,
+    mytable_comprehend_sentiment and mytable_comprehend_pii_entities
+    """
+    selected = selected_analyses(analyze_entities, key_phrases, sentiment, pii)
+    if not selected:
+        raise click.ClickException(
+            "Specify at least one of --entities, --key-phrases, --sentiment or --pii"
+        )
+    run_analyses(
+        database,
+        table,
+        columns,
+        [(analysis_class, None) for analysis_class in selected],
+        **kwargs,
+    )
+
+
+@cli.command()
+@pipeline_options
+@click.option("analyze_entities", "--entities", is_flag=True, help="Detect entities")
+@click.option("--key-phrases", is_flag=True, help="Detect key phrases")
+@click.option("--sentiment", is_flag=True, help="Detect sentiment")
+@click.option("--pii", is_flag=True, help="Detect personally identifiable information")
+@click.option(
+    "--poll-interval",
+    type=click.FloatRange(min=0, min_open=True),
+    default=1.0,
+    help="Seconds between checks for new rows",
+)
+@click.option(
+    "--max-wait",
+    type=click.FloatRange(min=0),
+    default=5.0,
+    help="Seconds to wait for a full batch before sending a partial one",
+)
+@common_boto3_options
+def watch(
+    database,
+    table,
+    columns,
+    analyze_entities,
+    key_phrases,
+    sentiment,
+    pii,
+    poll_interval,
+    max_wait,
+    **kwargs
+):
+    """
+    Process rows as they are inserted, until interrupted
+
+    To detect entities in new rows in mytable as they are added:
+
+        sqlite-comprehend watch my.db mytable text
+
+    Rows that have not been processed yet are processed first. Triggers
+    are then used to queue new rows in a table called
+    mytable_comprehend_queue - use "sqlite-comprehend unwatch" to remove them.
+
+    With --incremental, rows are also queued and processed again when the
+    columns change.
+
+    Detects entities by default, use --key-phrases, --sentiment and --pii to
+    select other analyses.
+    """
+    selected = selected_analyses(analyze_entities, key_phrases, sentiment, pii) or [
+        EntitiesAnalysis
+    ]
+    run_analyses(
+        database,
+        table,
+        columns,
+        [(analysis_class, None) for analysis_class in selected],
+        watch_options={"poll_interval": poll_interval, "max_wait": max_wait},
+        **kwargs,
+    )
+
+
+@cli.command()
+@click.argument(
+    "database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument("table")
+@click.option("-o", "--output", help="Custom output table")
+@click.option("analyze_entities", "--entities", is_flag=True, help="Entities")
+@click.option("--key-phrases", is_flag=True, help="Key phrases")
+@click.option("--sentiment", is_flag=True, help="Sentiment")
+@click.option("--pii", is_flag=True, help="Personally identifiable information")
+@click.option(
+    "--min-score",
+    type=click.FloatRange(min=0, max=1),
+    help="Only save entities and key phrases with at least this score",
+)
+@click.option(
+    "--types",
+    type=Types(),
+    help="Only save entities of these types, e.g. PERSON,LOCATION",
+)
+@click.option(
+    "--summary",
+    is_flag=True,
+    help="Also create a _summary table of mention counts for each entity",
+)
+def rebuild(
+    database,
+    table,
+    output,
+    analyze_entities,
+    key_phrases,
+    sentiment,
+    pii,
+    min_score,
+    types,
+    summary,
+):
+    """
+    Recreate output tables from the results saved by --archive
+
+    To recreate mytable_comprehend_entities, without calling Comprehend:
+
+        sqlite-comprehend rebuild my.db mytable
+
+    Rebuilds the entities output table by default, use --key-phrases,
+    --sentiment and --pii to select others. --min-score and --types can
+    be different from the ones used when the results were archived.
     """
+    selected = selected_analyses(analyze_entities, key_phrases, sentiment, pii) or [
+        EntitiesAnalysis
+    ]
+    if output and len(selected) > 1:
+        raise click.ClickException("-o can only be used with a single analysis")
     db = sqlite_utils.Database(database)
-    comprehend = make_client("comprehend", **boto_options)
     if not db[table].exists():
         raise click.ClickException("Table {} does not exist".format(table))
-    if not set(db[table].columns_dict.keys()).issuperset(columns):
-        raise click.ClickException(
-            "Table {} does not have columns: {}".format(table, ", ".join(columns))
-        )
-    pks = db[table].pks
-    # Create table to write to
-    output_table = output or "{}_comprehend_entities".format(table)
-    done_table = "{}_done".format(output_table)
-
-    if reset:
-        db[output_table].drop(True)
-        db[done_table].drop(True)
-        db["comprehend_entity_types"].drop(True)
-        db["comprehend_entities"].drop(True)
-
-    if not db["comprehend_entity_types"].exists():
-        db["comprehend_entity_types"].create(
-            {
-                "id": int,
-                "value": str,
-            },
-            pk="id",
-        )
-
-    entities_table = db.table("comprehend_entities")
-    if not entities_table.exists():
-        entities_table.create(
-            {"id": int, "name": str, "type": int},
-            pk="id",
-            foreign_keys=[("type", "comprehend_entity_types", "id")],
-        )
-
-    if not db[output_table].exists():
-        # Start with columns for the primary keys in the main table
-        column_definitions = {pk: db[table].columns_dict[pk] for pk in pks}
-        reserved_columns = {"score", "entity", "begin_offset", "end_offset"}
-        if set(pks).intersection(reserved_columns):
-            raise click.ClickException(
-                "Primary keys {} overlap with reserved columns: {}".format(
-                    ", ".join(pks), ", ".join(reserved_columns)
-                )
+    extractor = Extractor(
+        analysis_classes=selected, min_score=min_score, types=types, summary=summary
+    )
+    for name, written, kept in extractor.rebuild(db, table, output):
+        click.echo("{}: {:,} rows written".format(name, written), err=True)
+        if kept:
+            click.echo(
+                "{}: {:,} rows not in the archive were left unchanged".format(
+                    name, kept
+                ),
+                err=True,
             )
 
-        column_definitions.update(
-            {
-                "score": float,
-                "entity": int,
-                "begin_offset": int,
-                "end_offset": int,
-            }
-        )
-        foreign_keys = [
-            ("entity", "comprehend_entities", "id"),
-        ]
-        if len(pks) == 1:
-            pk = pks[0]
-            foreign_keys.append((pk, table, pk))
-        db[output_table].create(column_definitions, foreign_keys=foreign_keys)
-
-    # Build the SQL query
-    sql = "select {} from {}".format(
-        ", ".join(list(pks) + list(columns)),
+
+@cli.command()
+@click.argument(
+    "database",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@click.argument("table")
+def unwatch(database, table):
+    "Remove the triggers and queue table created by the watch command"
+    uninstall(sqlite_utils.Database(database), table)
+
+
+@cli.command()
+@click.argument(
+    "job_file",
+    type=click.Path(file_okay=True, dir_okay=False, allow_dash=False, exists=True),
+)
+@job_options
+@common_boto3_options
+def run(job_file, **kwargs):
+    """
+    Detect entities in every table listed in a TOML or JSON job file
+
+    Each job needs a database, table and columns, and can set where, params,
+    output, strip_tags and language_column:
+
+    \b
+        [[jobs]]
+        database = "content.db"
+        table = "pages"
+        columns = ["title", "body"]
+        where = "published = :published"
+        params = {published = 1}
+        strip_tags = true
+
+    All of the jobs run at once in one process, taking turns to send
+    batches. They share the Comprehend client, --rate and --max-units, and
+    tables in the same database share its entity ID cache. --concurrency is
+    the number of batches in flight across all of the jobs. Relative
+    database paths are relative to the job file.
+    """
+    run_jobs(load_jobs(job_file), **kwargs)
+
+
+def selected_analyses(analyze_entities, key_phrases, sentiment, pii):
+    "The analysis classes selected by --entities, --key-phrases etc"
+    return [
+        analysis_class
+        for analysis_class, flag in (
+            (EntitiesAnalysis, analyze_entities),
+            (KeyPhrasesAnalysis, key_phrases),
+            (SentimentAnalysis, sentiment),
+            (PiiAnalysis, pii),
+        )
+        if flag
+    ]
+
+
+def run_analyses(
+    database,
+    table,
+    columns,
+    analyses,
+    where,
+    params,
+    reset,
+    incremental,
+    should_strip_tags,
+    language_column,
+    wal,
+    shard,
+    busy_timeout,
+    no_count,
+    dry_run,
+    retry_errors,
+    stats,
+    metrics_file,
+    bulk_options=None,
+    watch_options=None,
+    **options
+):
+    boto_options = {name: options.pop(name) for name in BOTO3_OPTIONS}
+    db = open_database(database, busy_timeout)
+    extractor = create_extractor(
+        [analysis_class for analysis_class, _ in analyses],
+        dry_run,
+        stats,
+        metrics_file,
+        boto_options,
+        should_strip_tags=should_strip_tags,
+        **options,
+    )
+    output = analyses[0][1] if len(analyses) == 1 else None
+    if dry_run:
+        job = Job(
+            database,
+            table,
+            columns,
+            where,
+            dict(params),
+            output,
+            should_strip_tags,
+            language_column,
+        )
+        echo_dry_run(
+            extractor,
+            {database: db},
+            [job],
+            [""],
+            reset=reset,
+            incremental=incremental,
+            shard=shard,
+        )
+        return
+    if wal:
+        db.enable_wal()
+    pipeline = extractor.pipeline(
+        db,
         table,
+        columns,
+        output=output,
+        where=where,
+        params=dict(params),
+        reset=reset,
+        incremental=incremental,
+        retry_errors=retry_errors,
+        shard=shard,
+        language_column=language_column,
+    )
+    watcher = None
+    if watch_options:
+        watcher = Watcher(pipeline, **watch_options)
+        # Before catching up, so rows added in the meantime are queued
+        watcher.install()
+    rows = pipeline.pending_rows()
+
+    if bulk_options:
+        pipeline.run_bulk(rows, make_client("s3", **boto_options), **bulk_options)
+    else:
+        count = None
+        if not no_count:
+            # Estimate for the progress bar, adjusted as the run proceeds
+            count = pipeline.estimate_pending()
+        with click.progressbar(rows, length=count) as bar:
+            pipeline.run(adjust_length(bar))
+
+    if watcher and not pipeline.budget.reached:
+        click.echo("Watching {} for changes".format(table), err=True)
+        try:
+            watcher.run()
+        except KeyboardInterrupt:
+            pass
+
+    echo_budget_reached(extractor.budget)
+
+    if stats:
+        echo_stats([pipeline])
+
+
+def run_jobs(
+    jobs,
+    reset,
+    incremental,
+    wal,
+    busy_timeout,
+    no_count,
+    dry_run,
+    retry_errors,
+    stats,
+    metrics_file,
+    **options
+):
+    boto_options = {name: options.pop(name) for name in BOTO3_OPTIONS}
+    # One connection for each database, shared by all of its jobs
+    databases = {}
+    for job in jobs:
+        if job.database not in databases:
+            databases[job.database] = open_database(job.database, busy_timeout)
+    labels = ["{} {}".format(os.path.basename(job.database), job.table) for job in jobs]
+    # --concurrency is shared by all of the jobs
+    extractor = create_extractor(
+        [EntitiesAnalysis], dry_run, stats, metrics_file, boto_options, **options
     )
-    where_clauses = []
-    # Clause to skip previously processed rows:
-    if db[done_table].exists():
-        where_clauses.append(
-            "({pks}) not in (select {pks} from {done_table})".format(
-                pks=", ".join(pks),
-                done_table=done_table,
+    if dry_run:
+        echo_dry_run(
+            extractor,
+            databases,
+            jobs,
+            ["{}: ".format(label) for label in labels],
+            reset=reset,
+            incremental=incremental,
+        )
+        return
+    if wal:
+        for db in databases.values():
+            db.enable_wal()
+    in_flight = collections.deque()
+    pipelines = [
+        extractor.pipeline(
+            databases[job.database],
+            job.table,
+            job.columns,
+            output=job.output,
+            where=job.where,
+            params=job.params,
+            reset=reset,
+            incremental=incremental,
+            retry_errors=retry_errors,
+            should_strip_tags=job.strip_tags,
+            in_flight=in_flight,
+            language_column=job.language_column,
+        )
+        for job in jobs
+    ]
+    processed = [0] * len(pipelines)
+    bar = None
+    if not no_count:
+        # Estimate for the progress bar, adjusted as the run proceeds
+        bar = click.progressbar(
+            length=sum(pipeline.estimate_pending() for pipeline in pipelines)
+        )
+
+    def counted(index, rows):
+        for row in rows:
+            processed[index] += 1
+            yield row
+
+    def job_rows(index, pipeline):
+        rows = counted(index, pipeline.pending_rows())
+        # Every job advances the same progress bar
+        return rows if bar is None else adjust_length(bar, rows)
+
+    with bar or contextlib.nullcontext():
+        for pipeline in interleave(
+            (pipeline, job_rows(i, pipeline)) for i, pipeline in enumerate(pipelines)
+        ):
+            index = pipelines.index(pipeline)
+            click.echo(
+                "{}: {:,} rows processed".format(labels[index], processed[index]),
+                err=True,
             )
+
+    echo_budget_reached(extractor.budget)
+
+    if stats:
+        echo_stats(pipelines, labels)
+
+
+def open_database(path, busy_timeout):
+    db = sqlite_utils.Database(path)
+    db.execute("pragma busy_timeout = {}".format(int(busy_timeout * 1000)))
+    return db
+
+
+def create_extractor(
+    analysis_classes, dry_run, stats, metrics_file, boto_options, **options
+):
+    """
+    Create an Extractor with the command's options, such as --rate and
+    --concurrency, which is closed once the command has finished
+
+    No Comprehend client is created for a dry run.
+    """
+    comprehend = None
+    if not dry_run:
+        pool_size = options["concurrency"] * len(analysis_classes)
+        comprehend = make_client(
+            "comprehend",
+            max_pool_connections=pool_size if pool_size > 1 else None,
+            **boto_options,
+        )
+    extractor = Extractor(
+        comprehend,
+        analysis_classes,
+        metrics=Metrics(metrics_file) if (stats or metrics_file) else None,
+        **options,
+    )
+    # Shuts down the --prepare-workers pool
+    click.get_current_context().call_on_close(extractor.close)
+    return extractor
+
+
+def echo_dry_run(extractor, databases, jobs, prefixes, **kwargs):
+    "Output the estimates for each Job, with kwargs passed to estimate()"
+    for job, prefix in zip(jobs, prefixes):
+        echo_estimates(
+            extractor.estimate(
+                databases[job.database],
+                job.table,
+                job.columns,
+                output=job.output,
+                where=job.where,
+                params=job.params,
+                should_strip_tags=job.strip_tags,
+                language_column=job.language_column,
+                **kwargs,
+            ),
+            job.strip_tags,
+            prefix=prefix,
+        )
+    echo_detection_note(
+        extractor.auto_language and any(not job.language_column for job in jobs)
+    )
+
+
+def echo_budget_reached(budget):
+    if budget.reached:
+        click.echo(
+            "Stopped after sending {} billable units, the limit set by --max-units is {}".format(
+                budget.units, budget.max_units
+            ),
+            err=True,
         )
-    if where:
-        where_clauses.append(where)
-    if where_clauses:
-        sql += " where " + " and ".join(where_clauses)
-
-    rows = db.query(sql, params=dict(params))
-
-    # Run a count, for the progress bar
-    count = next(
-        db.query(
-            "with t as ({}) select count(*) as c from t".format(sql),
-            params=dict(params),
-        )
-    )["c"]
-
-    with click.progressbar(rows, length=count) as bar:
-        # Batch process 25 at a time
-        for chunk in chunks(bar, 25):
-            chunk = list(chunk)
-            # Each input is a max of 5,000 utf-8 bytes
-            texts = []
-            for row in chunk:
-                concat = " ".join((row[column] or "") for column in columns)
-                if should_strip_tags:
-                    concat = strip_tags(concat)
-                concat_utf8 = concat.encode("utf-8")
-                if len(concat_utf8) > 5000:
-                    concat_utf8 = concat_utf8[:5000]
-                    # Truncate back to last whitespace to avoid risk of splitting a codepoint
-                    concat_utf8 = concat_utf8.rsplit(None, 1)[0]
-                texts.append(concat_utf8.decode("utf-8"))
-
-            # Run the batch
-            response = comprehend.batch_detect_entities(
-                TextList=texts, LanguageCode="en"
+
+
+def echo_estimates(estimates, should_strip_tags, prefix=""):
+    for name, estimate in estimates:
+        click.echo(
+            "{}{}: {:,} rows, {:,} documents, {:,} bytes, {:,} billable units".format(
+                prefix,
+                name,
+                estimate["rows"],
+                estimate["documents"],
+                estimate["bytes"],
+                estimate["units"],
             )
-            if response.get("ErrorList"):
-                # Match errors to documents
-                errors_by_index = {
-                    error["Index"]: error for error in response["ErrorList"]
-                }
-                for i, row in enumerate(chunk):
-                    if i in errors_by_index:
-                        click.echo(
-                            "{}: Error: {}".format(
-                                json.dumps({pk: row[pk] for pk in pks}),
-                                json.dumps(errors_by_index[i]),
-                            ),
-                            err=True,
-                        )
-
-            results = response["ResultList"]
-            # Match those to their primary keys and insert into output_table
-            # we match on Index because we cannot guarantee that every document
-            # has an item in ResultList, since there may have been errors
-            results_by_index = {
-                result["Index"]: result["Entities"] for result in results
-            }
-            to_insert = []
-            for i, row in enumerate(chunk):
-                pk_values = {pk: row[pk] for pk in pks}
-                entities = results_by_index.get(i, [])
-                if entities:
-                    to_insert.extend(
-                        [
-                            dict(
-                                **pk_values,
-                                score=entity["Score"],
-                                entity=entities_table.lookup(
-                                    {
-                                        "type": db["comprehend_entity_types"].lookup(
-                                            {"value": entity["Type"]}
-                                        ),
-                                        "name": entity["Text"],
-                                    }
-                                ),
-                                begin_offset=entity["BeginOffset"],
-                                end_offset=entity["EndOffset"],
-                            )
-                            for entity in entities
-                        ]
-                    )
-            if to_insert:
-                db[output_table].insert_all(to_insert)
-            db[done_table].insert_all(
-                [{pk: row[pk] for pk in pks} for row in chunk],
-                pk=pks,
-                foreign_keys=[(pks[0], table, pks[0])] if len(pks) == 1 else [],
+        )
+    if should_strip_tags:
+        click.echo(
+            "Estimated by stripping tags from a sample of up to {:,} rows".format(
+                SAMPLE_SIZE
             )
+        )
+
+
+def echo_detection_note(auto_language):
+    if auto_language:
+        click.echo(
+            "Detecting languages with --auto-language is billed in addition, "
+            "for each row whose text has not been detected before"
+        )
+
+
+def adjust_length(bar, rows=None):
+    """
+    Raise the progress bar length if the estimate turns out to be too low
+
+    Iterates over bar itself, or over rows - advancing bar for each one -
+    if several iterables share the same bar.
+    """
+    for row in bar if rows is None else rows:
+        if rows is not None:
+            bar.update(1)
+        if bar.length is not None and bar.pos > bar.length:
+            bar.length = bar.pos + PAGE_SIZE
+        yield row
+
+
+def echo_stats(pipelines, labels=None):
+    "labels is a name for each pipeline, used when there is more than one"
+    entity_caches = []
+    for i, pipeline in enumerate(pipelines):
+        for analysis in pipeline.analyses:
+            names = []
+            if labels and len(pipelines) > 1:
+                names.append(labels[i])
+            if len(pipeline.analyses) > 1:
+                names.append(analysis.name)
+            prefix = "".join("{}: ".format(name) for name in names)
+            entity_cache = getattr(analysis, "entity_cache", None)
+            # Shared by every table in the same database
+            if entity_cache and entity_cache not in entity_caches:
+                entity_caches.append(entity_cache)
+                click.echo(
+                    "{}Entity cache: {} hits, {} misses".format(
+                        prefix, entity_cache.hits, entity_cache.misses
+                    ),
+                    err=True,
+                )
+            response_cache = analysis.response_cache
+            if response_cache:
+                lookups = response_cache.hits + response_cache.misses
+                click.echo(
+                    "{}Response cache: {} hits, {} misses ({:.1%} hit rate), {} cached responses".format(
+                        prefix,
+                        response_cache.hits,
+                        response_cache.misses,
+                        response_cache.hits / lookups if lookups else 0,
+                        response_cache.count(),
+                    ),
+                    err=True,
+                )
+        language_cache = pipeline.language_cache
+        if language_cache:
+            prefix = "{}: ".format(labels[i]) if labels and len(pipelines) > 1 else ""
+            click.echo(
+                "{}Language cache: {} hits, {} misses".format(
+                    prefix, language_cache.hits, language_cache.misses
+                ),
+                err=True,
+            )
+    pipeline = pipelines[0]
+    metrics = pipeline.metrics
+    totals = metrics.totals()
+    click.echo(
+        "Rows: {rows}, bytes sent: {bytes}, billable units: {units}, "
+        "mentions: {mentions}, errors: {errors}, retries: {retries}, "
+        "throttled: {throttled}".format(**totals),
+        err=True,
+    )
+    click.echo(
+        "Time: {:.2f}s, {:.1f} rows/s".format(
+            totals["elapsed"], totals["rows_per_second"]
+        ),
+        err=True,
+    )
+    total_seconds = sum(metrics.seconds.values()) or 1
+    click.echo("{:<10} {:>10} {:>7}".format("Stage", "Seconds", "%"), err=True)
+    for stage in STAGES:
+        click.echo(
+            "{:<10} {:>10.3f} {:>6.1%}".format(
+                stage, metrics.seconds[stage], metrics.seconds[stage] / total_seconds
+            ),
+            err=True,
+        )
+    # Pipelines for tables in the same database share a transaction
+    transactions = []
+    for other in pipelines:
+        if other.commits not in transactions:
+            transactions.append(other.commits)
+    written = sum(commits.writer.written for commits in transactions)
+    seconds = sum(commits.writer.seconds for commits in transactions)
+    click.echo(
+        "Rows written to the database: {}, {:.1f} rows/s".format(
+            written, written / seconds if seconds else 0.0
+        ),
+        err=True,
+    )
+    click.echo(
+        "Transactions committed: {}".format(
+            sum(commits.commits for commits in transactions)
+        ),
+        err=True,
+    )
+    click.echo(
+        "Throttled: {}, current rate: {:.1f}/s, rows with errors: {}".format(
+            pipeline.limiter.throttles,
+            pipeline.limiter.rate,
+            sum(
+                analysis.error_log.recorded
+                for other in pipelines
+                for analysis in other.analyses
+            ),
+        ),
+        err=True,
+    )
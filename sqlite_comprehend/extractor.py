@@ -0,0 +1,423 @@
+import click
+import concurrent.futures
+import sqlite_utils
+from .cache import EntityCache
+from .metrics import Budget
+from .pipeline import (
+    EntitiesAnalysis,
+    Pipeline,
+    analysis_settings,
+    estimate_units,
+    language_setting,
+    sql_fingerprint,
+)
+from .retry import AdaptiveRateLimiter
+from .utils import BatchedCommits, make_client, shard_of
+from .writer import BufferedWriter
+
+
+class Extractor:
+    """
+    Runs text through one or more Comprehend analyses
+
+    Text can come from columns in a database table, in which case results
+    are written to output tables alongside it, or from any iterable of
+    (key, text) pairs. The client, rate limiter, prepare_workers process
+    pool and entity ID caches are shared between runs, so one extractor can
+    be used for many tables in a long-running process. Call close() once it
+    is finished with to shut down the process pool.
+    """
+
+    analysis_classes = ()
+
+    def __init__(
+        self,
+        client=None,
+        analysis_classes=None,
+        language_code="en",
+        should_strip_tags=False,
+        segment=False,
+        concurrency=1,
+        prepare_workers=None,
+        commit_every=(1, "chunks"),
+        rate=10.0,
+        max_retries=5,
+        use_cache=False,
+        archive=False,
+        min_score=None,
+        types=None,
+        summary=False,
+        metrics=None,
+        max_units=None,
+        auto_language=False,
+    ):
+        self.analysis_classes = list(analysis_classes or self.analysis_classes)
+        if not self.analysis_classes:
+            raise ValueError("At least one analysis class is required")
+        self._client = client
+        self._prepare_pool = None
+        self.language_code = language_code
+        self.should_strip_tags = should_strip_tags
+        self.segment = segment
+        # Detect the language of each text, rather than using language_code
+        self.auto_language = auto_language
+        self.concurrency = concurrency
+        self.prepare_workers = prepare_workers
+        self.commit_every = commit_every
+        self.max_retries = max_retries
+        self.use_cache = use_cache
+        self.archive = archive
+        self.min_score = min_score
+        self.types = types
+        self.summary = summary
+        self.metrics = metrics
+        self.limiter = AdaptiveRateLimiter(rate)
+        # Shared by every pipeline, so max_units applies to all of them
+        self.budget = Budget(max_units)
+        self.entity_caches = {}
+        self.transactions = {}
+
+    @property
+    def client(self):
+        "The Comprehend client, created when it is first needed"
+        if self._client is None:
+            pool_size = self.concurrency * len(self.analysis_classes)
+            self._client = make_client(
+                "comprehend", max_pool_connections=pool_size if pool_size > 1 else None
+            )
+        return self._client
+
+    @property
+    def prepare_pool(self):
+        "The process pool for prepare_workers, created when it is first needed"
+        if self._prepare_pool is None and self.prepare_workers:
+            self._prepare_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.prepare_workers
+            )
+        return self._prepare_pool
+
+    def close(self):
+        "Shut down the prepare_workers process pool, if it was started"
+        if self._prepare_pool is not None:
+            self._prepare_pool.shutdown()
+            self._prepare_pool = None
+
+    def pipeline(
+        self,
+        db,
+        table,
+        columns,
+        output=None,
+        where=None,
+        params=None,
+        reset=False,
+        incremental=False,
+        retry_errors=False,
+        read_db=None,
+        shard=None,
+        should_strip_tags=None,
+        in_flight=None,
+        language_column=None,
+    ):
+        """
+        Create the output tables for columns in a table and return a
+        Pipeline to process its rows
+
+        output is the name of the output table, for a single analysis.
+        Rows are read using read_db, which defaults to a separate connection
+        to the same database file if it is in WAL mode, or db otherwise.
+        shard is an optional (index, count) tuple to only process the rows
+        in one of count shards, from 1 to count.
+        should_strip_tags overrides the extractor's setting for this table.
+        Pipelines that are run together with interleave() should share an
+        in_flight deque. language_column is a column with the language code
+        for each row, used instead of detecting it.
+        """
+        if should_strip_tags is None:
+            should_strip_tags = self.should_strip_tags
+        if output and len(self.analysis_classes) > 1:
+            raise ValueError("output can only be used with a single analysis")
+        check_columns(
+            db, table, list(columns) + ([language_column] if language_column else [])
+        )
+        analyses = []
+        for analysis_class in self.analysis_classes:
+            analysis = self.analysis(
+                analysis_class,
+                db,
+                table,
+                output,
+                use_cache=self.use_cache,
+                archive=self.archive,
+            )
+            if reset:
+                analysis.reset()
+            analysis.ensure_tables()
+            if incremental:
+                # Used to delete the old results for rows that have changed
+                analysis.create_pk_index()
+            if retry_errors:
+                analysis.retry_errors()
+            analyses.append(analysis)
+        pipeline = Pipeline(
+            db,
+            table,
+            columns,
+            analyses,
+            self.client,
+            read_db=read_db or separate_connection(db),
+            where=where,
+            params=params,
+            should_strip_tags=should_strip_tags,
+            segment=self.segment,
+            prepare_workers=self.prepare_workers,
+            prepare_pool=self.prepare_pool,
+            incremental=incremental,
+            metrics=self.metrics,
+            concurrency=self.concurrency,
+            max_retries=self.max_retries,
+            limiter=self.limiter,
+            shard=shard,
+            budget=self.budget,
+            commits=self.commits(db),
+            in_flight=in_flight,
+            auto_language=self.auto_language and not language_column,
+            language_column=language_column,
+        )
+        if incremental:
+            pipeline.backfill_fingerprints()
+        return pipeline
+
+    def estimate(
+        self,
+        db,
+        table,
+        columns,
+        output=None,
+        where=None,
+        params=None,
+        reset=False,
+        incremental=False,
+        shard=None,
+        should_strip_tags=None,
+        language_column=None,
+    ):
+        """
+        Estimate what processing the pending rows in a table would send to
+        each analysis, as a list of (analysis name, estimate) pairs
+
+        Takes the same arguments as pipeline(), but nothing is written to
+        the database. Each estimate is a dictionary of rows, documents,
+        bytes and billable units, not including any language detection.
+        """
+        if should_strip_tags is None:
+            should_strip_tags = self.should_strip_tags
+        check_columns(
+            db, table, list(columns) + ([language_column] if language_column else [])
+        )
+        if incremental:
+            db.conn.create_function("comprehend_fingerprint", -1, sql_fingerprint)
+        if shard:
+            db.conn.create_function("comprehend_shard", -1, shard_of)
+        estimates = []
+        for analysis_class in self.analysis_classes:
+            analysis = analysis_class(
+                db, table, output, language_code=self.language_code
+            )
+            # Every row is pending if the analysis has not been run before
+            done = not reset and db[analysis.done_table].exists()
+            # Rows without a fingerprint will be assumed to be unchanged, as
+            # will every row if the done table has no fingerprint column yet
+            compare = (
+                done
+                and incremental
+                and "fingerprint" in db[analysis.done_table].columns_dict
+            )
+            estimates.append(
+                (
+                    analysis.name,
+                    estimate_units(
+                        db,
+                        table,
+                        analysis.pks,
+                        columns,
+                        [analysis.done_table] if done else [],
+                        where,
+                        params,
+                        fingerprints=(
+                            [
+                                analysis_settings(
+                                    analysis,
+                                    columns,
+                                    should_strip_tags,
+                                    self.segment,
+                                    language_setting(
+                                        self.auto_language, language_column
+                                    ),
+                                )
+                            ]
+                            if compare
+                            else None
+                        ),
+                        shard=shard,
+                        should_strip_tags=should_strip_tags,
+                        segment=self.segment,
+                    ),
+                )
+            )
+        return estimates
+
+    def rebuild(self, db, table, output=None):
+        """
+        Recreate the output tables for a table from the results saved with
+        archive=True, without calling Comprehend
+
+        Returns a list of (analysis name, rows written, rows kept) tuples,
+        where rows kept is the number of rows whose results were left as
+        they are because they were processed without archive=True.
+        """
+        if output and len(self.analysis_classes) > 1:
+            raise ValueError("output can only be used with a single analysis")
+        rebuilt = []
+        for analysis_class in self.analysis_classes:
+            analysis = self.analysis(analysis_class, db, table, output)
+            rebuilt.append((analysis.name,) + analysis.rebuild())
+        return rebuilt
+
+    def extract_table(self, db, table, columns, **kwargs):
+        """
+        Process the pending rows in a table, yielding a Result for each row
+        and analysis as soon as it has been written to the output tables
+
+        Takes the same keyword arguments as pipeline(). Nothing is processed
+        until the generator is iterated over.
+        """
+        pipeline = self.pipeline(db, table, columns, **kwargs)
+        yield from pipeline.stream(pipeline.pending_rows())
+
+    def extract(self, documents):
+        """
+        Process an iterable of (key, text) pairs, yielding a Result for each
+        document and analysis where key is the key for that document
+
+        Nothing is written to a database. Each key must be unique. Items are
+        left out of each result using min_score and types, in the same way
+        as they are left out of the output tables by extract_table().
+        """
+        db = sqlite_utils.Database(memory=True)
+        db["documents"].create({"key": str, "text": str}, pk="key")
+        analyses = [
+            analysis_class(
+                db,
+                "documents",
+                language_code=self.language_code,
+                min_score=self.min_score,
+                types=self.types,
+            )
+            for analysis_class in self.analysis_classes
+        ]
+        analyses_by_name = {analysis.name: analysis for analysis in analyses}
+        pipeline = Pipeline(
+            db,
+            "documents",
+            ["text"],
+            analyses,
+            self.client,
+            should_strip_tags=self.should_strip_tags,
+            segment=self.segment,
+            prepare_workers=self.prepare_workers,
+            prepare_pool=self.prepare_pool,
+            metrics=self.metrics,
+            concurrency=self.concurrency,
+            max_retries=self.max_retries,
+            limiter=self.limiter,
+            store=False,
+            budget=self.budget,
+            auto_language=self.auto_language,
+        )
+        rows = ({"key": key, "text": text} for key, text in documents)
+        for result in pipeline.stream(rows):
+            if result.result is not None:
+                analysis = analyses_by_name[result.analysis]
+                [(_, filtered)] = analysis.filtered([(None, result.result)])
+                result = result._replace(result=filtered)
+            yield result._replace(key=result.key["key"])
+
+    def analysis(self, analysis_class, db, table, output, **kwargs):
+        "Create an analysis using this extractor's settings"
+        if issubclass(analysis_class, EntitiesAnalysis):
+            kwargs.update(entity_cache=self.entity_cache(db), summary=self.summary)
+        return analysis_class(
+            db,
+            table,
+            output,
+            language_code=self.language_code,
+            min_score=self.min_score,
+            types=self.types,
+            **kwargs
+        )
+
+    def commits(self, db):
+        """
+        The transaction for a database, shared by all of its pipelines so
+        that they can write to the same connection at the same time
+        """
+        if db not in self.transactions:
+            every, unit = self.commit_every
+            self.transactions[db] = BatchedCommits(
+                db,
+                every,
+                unit,
+                on_rollback=lambda: self.rolled_back(db),
+                writer=BufferedWriter(db, metrics=self.metrics),
+            )
+        return self.transactions[db]
+
+    def rolled_back(self, db):
+        "Called if a transaction for a database was rolled back"
+        if db in self.entity_caches:
+            self.entity_caches[db].reload()
+
+    def entity_cache(self, db):
+        "The entity ID cache for a database, shared by all of its tables"
+        if db not in self.entity_caches:
+            self.entity_caches[db] = EntityCache(db)
+        return self.entity_caches[db]
+
+
+class EntityExtractor(Extractor):
+    """
+    Detects entities in text, from a table or an iterable of (key, text)
+
+        extractor = EntityExtractor()
+        for result in extractor.extract([(1, "Text about London")]):
+            print(result.key, result.result["Entities"])
+    """
+
+    analysis_classes = (EntitiesAnalysis,)
+
+
+def check_columns(db, table, columns):
+    if not db[table].exists():
+        raise click.ClickException("Table {} does not exist".format(table))
+    if not set(db[table].columns_dict.keys()).issuperset(columns):
+        raise click.ClickException(
+            "Table {} does not have columns: {}".format(table, ", ".join(columns))
+        )
+
+
+def separate_connection(db):
+    """
+    A new connection to the same file as db, if it is in WAL mode
+
+    Otherwise db itself is returned: with a rollback journal, reading on a
+    second connection would wait for db's own open transaction once that
+    transaction has spilled to the database file.
+    """
+    path = db.execute("pragma database_list").fetchone()[2]
+    if not path or db.journal_mode != "wal":
+        return db
+    read_db = sqlite_utils.Database(path)
+    busy_timeout = db.execute("pragma busy_timeout").fetchone()[0]
+    read_db.execute("pragma busy_timeout = {}".format(int(busy_timeout)))
+    return read_db
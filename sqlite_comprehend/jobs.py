@@ -0,0 +1,101 @@
+import click
+import collections
+import json
+import os
+
+Job = collections.namedtuple(
+    "Job",
+    (
+        "database",
+        "table",
+        "columns",
+        "where",
+        "params",
+        "output",
+        "strip_tags",
+        "language_column",
+    ),
+)
+
+REQUIRED_KEYS = ("database", "table", "columns")
+OPTIONAL_KEYS = ("where", "params", "output", "strip_tags", "language_column")
+
+
+def load_jobs(path):
+    """
+    Read a list of Jobs from a TOML or JSON file
+
+    TOML files have a [[jobs]] table for each job. JSON files can be a list
+    of jobs, or an object with a "jobs" key. Relative database paths are
+    relative to the directory containing the file.
+    """
+    with open(path, "rb") as fp:
+        content = fp.read()
+    if path.endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            import tomli as tomllib
+        try:
+            spec = tomllib.loads(content.decode("utf-8"))
+        except tomllib.TOMLDecodeError as e:
+            raise click.ClickException("Invalid TOML in {}: {}".format(path, e))
+    else:
+        try:
+            spec = json.loads(content)
+        except ValueError as e:
+            raise click.ClickException("Invalid JSON in {}: {}".format(path, e))
+    if isinstance(spec, dict):
+        spec = spec.get("jobs")
+    if not isinstance(spec, list) or not spec:
+        raise click.ClickException("{} does not list any jobs".format(path))
+    base = os.path.dirname(os.path.abspath(path))
+    jobs = []
+    seen = {}
+    for number, item in enumerate(spec, 1):
+        job = parse_job(item, number, base)
+        key = (job.database, job.table, job.output)
+        if key in seen:
+            raise click.ClickException(
+                "Job {} writes to the same output table as job {}".format(
+                    number, seen[key]
+                )
+            )
+        seen[key] = number
+        jobs.append(job)
+    return jobs
+
+
+def parse_job(item, number, base):
+    if not isinstance(item, dict):
+        raise click.ClickException(
+            "Job {} should be a table of settings".format(number)
+        )
+    missing = [key for key in REQUIRED_KEYS if not item.get(key)]
+    if missing:
+        raise click.ClickException(
+            "Job {} is missing: {}".format(number, ", ".join(missing))
+        )
+    unknown = sorted(set(item) - set(REQUIRED_KEYS) - set(OPTIONAL_KEYS))
+    if unknown:
+        raise click.ClickException(
+            "Job {} has unknown settings: {}".format(number, ", ".join(unknown))
+        )
+    columns = item["columns"]
+    if isinstance(columns, str):
+        columns = [columns]
+    database = os.path.join(base, os.path.expanduser(item["database"]))
+    if not os.path.isfile(database):
+        raise click.ClickException(
+            "Job {}: database {} does not exist".format(number, item["database"])
+        )
+    return Job(
+        database=os.path.normpath(database),
+        table=item["table"],
+        columns=list(columns),
+        where=item.get("where"),
+        params=dict(item.get("params") or {}),
+        output=item.get("output"),
+        strip_tags=bool(item.get("strip_tags")),
+        language_column=item.get("language_column"),
+    )
@@ -0,0 +1,132 @@
+import contextlib
+import json
+import threading
+import time
+
+# Stages of the pipeline that time is recorded for, in the order they run
+STAGES = ("query", "prepare", "cache", "api", "lookup", "write")
+
+# retries counts resubmitted documents, throttled counts retried calls
+COUNTERS = (
+    "rows",
+    "bytes",
+    "units",
+    "mentions",
+    "errors",
+    "retries",
+    "throttled",
+    "written",
+)
+
+
+def billable_units(text):
+    "Comprehend charges per 100 characters, with a minimum of 3 units"
+    return max(3, -(-len(text) // 100))
+
+
+class Budget:
+    """
+    A limit on the billable units sent, which can be shared by pipelines
+
+    Once a batch would take the total over max_units, reached is set and no
+    more batches should be sent.
+    """
+
+    def __init__(self, max_units=None):
+        self.max_units = max_units
+        self.units = 0
+        self.reached = False
+
+    def spend(self, units):
+        "Record units about to be sent, or return False if that is over budget"
+        if self.max_units is not None and self.units + units > self.max_units:
+            self.reached = True
+            return False
+        self.units += units
+        return True
+
+
+class Metrics:
+    """
+    Counters and per-stage timings for a run of the pipeline
+
+    Time spent in a stage that is nested inside another, such as entity
+    lookups while writing results, is only counted against the inner stage.
+    Time in the api stage is summed across all of the worker threads.
+
+    If stream is a file, a JSON line with the totals so far is written to it
+    each time a chunk of results has been written.
+    """
+
+    enabled = True
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.seconds = dict.fromkeys(STAGES, 0.0)
+        self.chunks = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def count(self, name, amount=1):
+        # Throttled calls are counted from the API worker threads
+        with self._lock:
+            self.counters[name] += amount
+
+    @contextlib.contextmanager
+    def timer(self, stage):
+        stack = self._local.__dict__.setdefault("stack", [])
+        stack.append(0.0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            duration = time.perf_counter() - start
+            nested = stack.pop()
+            if stack:
+                stack[-1] += duration
+            with self._lock:
+                self.seconds[stage] += duration - nested
+
+    def chunk_written(self, analysis):
+        self.chunks += 1
+        if self.stream is None:
+            return
+        self.stream.write(
+            json.dumps(
+                dict(
+                    self.totals(),
+                    time=time.time(),
+                    analysis=analysis,
+                )
+            )
+            + "\n"
+        )
+        self.stream.flush()
+
+    def totals(self):
+        elapsed = time.perf_counter() - self.started
+        return dict(
+            self.counters,
+            chunks=self.chunks,
+            elapsed=round(elapsed, 6),
+            rows_per_second=round(self.counters["rows"] / elapsed, 3) if elapsed else 0,
+            seconds={stage: round(value, 6) for stage, value in self.seconds.items()},
+        )
+
+
+class NullMetrics:
+    "Used when metrics are disabled, every method does nothing"
+
+    enabled = False
+    _null_timer = contextlib.nullcontext()
+
+    def count(self, name, amount=1):
+        pass
+
+    def timer(self, stage):
+        return self._null_timer
+
+    def chunk_written(self, analysis):
+        pass
@@ -0,0 +1,1749 @@
+import click
+import collections
+import concurrent.futures
+import hashlib
+import itertools
+import json
+import time
+from sqlite_utils.utils import chunks
+from .bulk import batch_response, run_job
+from .cache import EntityCache, LanguageCache, ResponseArchive, ResponseCache
+from .metrics import Budget, NullMetrics, billable_units
+from .retry import (
+    RETRYABLE_ERROR_CODES,
+    THROTTLING_ERROR_CODES,
+    AdaptiveRateLimiter,
+    ErrorLog,
+    call_with_retries,
+)
+from .utils import BatchedCommits, prepare_text, segment_text, shard_of
+from .writer import BufferedWriter
+
+# Number of pending rows to fetch from the source table at a time
+PAGE_SIZE = 1000
+
+# Maximum number of documents in a batch_detect_* call
+BATCH_SIZE = 25
+
+# Maximum UTF-8 bytes of text in each document
+MAX_BYTES = 5000
+
+# Rows prepared in Python to estimate the effect of stripping tags
+SAMPLE_SIZE = 1000
+
+# Languages supported by the batch_detect_* APIs
+LANGUAGES = ("ar", "de", "en", "es", "fr", "hi", "it", "ja", "ko", "pt", "zh", "zh-TW")
+
+# A prepared text, the source row it came from, its response cache key,
+# its character offset in the row's text and the number of segments that
+# text was split into, the number of times it has been resubmitted after a
+# failure, the fingerprint to record for the row in the _done table and its
+# language code, if that is not the analysis's language_code
+Document = collections.namedtuple(
+    "Document",
+    ("row", "text", "key", "offset", "parts", "attempts", "fingerprint", "language"),
+    defaults=(0, 1, 0, None, None),
+)
+
+# The outcome for a row from one analysis: the name of the analysis, the
+# row's primary keys as a dictionary and either the result, in the shape
+# returned by the API, or an error
+Result = collections.namedtuple("Result", ("analysis", "key", "result", "error"))
+
+
+class Analysis:
+    """
+    A Comprehend API along with the output and _done tables it writes to
+
+    Subclasses define the API call, the output columns and how to turn a
+    single document's result into rows for the output table. Each instance
+    also holds the queues for one run of the pipeline.
+    """
+
+    name = None
+    output_suffix = None
+    output_columns = {}
+    # Key of the list of items with offsets in each result
+    result_key = None
+    # Language codes the API supports
+    languages = LANGUAGES
+
+    def __init__(
+        self,
+        db,
+        table,
+        output=None,
+        language_code="en",
+        use_cache=False,
+        archive=False,
+        min_score=None,
+        types=None,
+    ):
+        self.db = db
+        self.table = table
+        self.pks = db[table].pks
+        self.output_table = output or "{}_{}".format(table, self.output_suffix)
+        self.done_table = "{}_done".format(self.output_table)
+        self.archive_table = "{}_archive".format(self.output_table)
+        self.language_code = language_code
+        self.use_cache = use_cache
+        self.response_cache = None
+        self.archive = archive
+        self.response_archive = None
+        # Items scoring less than min_score, or with a Type that is not in
+        # types, are left out of the output table
+        self.min_score = min_score
+        self.types = set(types) if types else None
+        self.error_log = ErrorLog(db, self.output_table, self.pks)
+        # Cache misses, packed into full batches before they are sent
+        self.queue = []
+        # Documents that failed with a retryable error, sent first
+        self.retries = []
+        # Documents waiting on the result for an identical text in flight
+        self.duplicates = {}
+        # Rows split into segments that are not all finished yet
+        self.segments = {}
+
+    def reset(self):
+        self.db[self.output_table].drop(True)
+        self.db[self.done_table].drop(True)
+        self.db[self.archive_table].drop(True)
+        self.error_log.clear()
+        self.response_archive = None
+
+    def retry_errors(self):
+        """
+        Remove the output and _done rows for rows with recorded errors, so
+        they are processed again, returning the number of rows to retry
+        """
+        keys = self.error_log.keys()
+        if not keys:
+            return 0
+        with self.db.conn:
+            self.output_deleting(keys)
+            self.db.conn.executemany(self.delete_output_sql, keys)
+            count = self.db.conn.executemany(self.delete_done_sql, keys).rowcount
+        self.error_log.clear()
+        return count
+
+    def ensure_tables(self):
+        db = self.db
+        pks = self.pks
+        if self.use_cache and not self.response_cache:
+            self.response_cache = ResponseCache(db, self.name, self.language_code)
+        if self.archive and not self.response_archive:
+            self.response_archive = ResponseArchive(
+                db,
+                self.archive_table,
+                {pk: db[self.table].columns_dict[pk] for pk in pks},
+            )
+        if not db[self.output_table].exists():
+            # Start with columns for the primary keys in the main table
+            column_definitions = {pk: db[self.table].columns_dict[pk] for pk in pks}
+            reserved_columns = set(self.output_columns)
+            if set(pks).intersection(reserved_columns):
+                raise click.ClickException(
+                    "Primary keys {} overlap with reserved columns: {}".format(
+                        ", ".join(pks), ", ".join(reserved_columns)
+                    )
+                )
+            column_definitions.update(self.output_columns)
+            foreign_keys = self.foreign_keys()
+            if len(pks) == 1:
+                pk = pks[0]
+                foreign_keys.append((pk, self.table, pk))
+            # if_not_exists in case another process has just created it
+            db[self.output_table].create(
+                column_definitions, foreign_keys=foreign_keys, if_not_exists=True
+            )
+        if not db[self.done_table].exists():
+            db[self.done_table].create(
+                dict(
+                    {pk: db[self.table].columns_dict[pk] for pk in pks},
+                    fingerprint=str,
+                    language=str,
+                ),
+                pk=pks[0] if len(pks) == 1 else pks,
+                foreign_keys=[(pks[0], self.table, pks[0])] if len(pks) == 1 else [],
+                if_not_exists=True,
+            )
+        else:
+            # Created by an older version - those rows have no fingerprint
+            # or language
+            done_columns = db[self.done_table].columns_dict
+            for column in ("fingerprint", "language"):
+                if column not in done_columns:
+                    db[self.done_table].add_column(column, str)
+        columns = list(pks) + list(self.output_columns)
+        self.insert_output_sql = "insert into [{}] ({}) values ({})".format(
+            self.output_table,
+            ", ".join("[{}]".format(column) for column in columns),
+            ", ".join("?" for _ in columns),
+        )
+        # Replaces the _done row for a row that is being reprocessed
+        self.insert_done_sql = (
+            "insert or replace into [{}] ({}, [fingerprint], [language]) "
+            "values ({}, ?, ?)".format(
+                self.done_table,
+                ", ".join("[{}]".format(pk) for pk in pks),
+                ", ".join("?" for _ in pks),
+            )
+        )
+        self.delete_output_sql = "delete from [{}] where {}".format(
+            self.output_table, " and ".join("[{}] = ?".format(pk) for pk in pks)
+        )
+        self.delete_done_sql = "delete from [{}] where {}".format(
+            self.done_table, " and ".join("[{}] = ?".format(pk) for pk in pks)
+        )
+        # Rows that are written without an archived result, such as rows
+        # that failed, lose the one from when they were last processed -
+        # otherwise rebuild would bring back the results they replaced
+        self.delete_archive_sql = None
+        if self.archive or db[self.archive_table].exists():
+            self.delete_archive_sql = "delete from [{}] where {}".format(
+                self.archive_table, " and ".join("[{}] = ?".format(pk) for pk in pks)
+            )
+
+    def rebuild(self):
+        """
+        Recreate the output table from the archive table, returning the
+        number of rows written to it and the number of rows whose results
+        were kept because they are not in the archive
+
+        If every row in the output table is in the archive the table is
+        dropped and created again, otherwise the results for the archived
+        rows are replaced and the others are left as they are.
+        """
+        if not self.db[self.archive_table].exists():
+            raise click.ClickException(
+                "Archive table {} does not exist - it is created by --archive".format(
+                    self.archive_table
+                )
+            )
+        self.archive = True
+        kept = self.unarchived()
+        if not kept:
+            self.db[self.output_table].drop(True)
+        self.ensure_tables()
+        if kept:
+            self.create_pk_index()
+        written = 0
+        # A single transaction, reading the archive on the same connection
+        with self.db.conn:
+            for items in self.response_archive.pages(PAGE_SIZE):
+                if kept:
+                    self.db.conn.executemany(
+                        self.delete_output_sql, [pk_values for pk_values, _ in items]
+                    )
+                to_insert = self.output_rows(self.filtered(items))
+                self.db.conn.executemany(self.insert_output_sql, to_insert)
+                written += len(to_insert)
+        self.create_indexes()
+        return written, kept
+
+    def unarchived(self):
+        "Count the rows with results in the output table but not in the archive"
+        if not self.db[self.output_table].exists():
+            return 0
+        return self.db.execute(
+            """
+            select count(*) from (
+                select distinct {pks} from [{output}] where not exists (
+                    select 1 from [{archive}] where {match}
+                )
+            )
+            """.format(
+                pks=", ".join("[{}]".format(pk) for pk in self.pks),
+                output=self.output_table,
+                archive=self.archive_table,
+                match=" and ".join(
+                    "[{archive}].[{pk}] = [{output}].[{pk}]".format(
+                        archive=self.archive_table, output=self.output_table, pk=pk
+                    )
+                    for pk in self.pks
+                ),
+            )
+        ).fetchone()[0]
+
+    def create_pk_index(self):
+        "Index the primary key columns of the output table"
+        self.db[self.output_table].create_index(self.pks, if_not_exists=True)
+
+    def create_indexes(self):
+        """
+        Index the output table - called once rows have been written, as
+        building an index in one go is faster than updating it for each row
+        """
+        self.create_pk_index()
+
+    def filtered(self, items):
+        "Leave out items scoring under min_score, or with a Type not in types"
+        if self.result_key is None or (self.min_score is None and not self.types):
+            return items
+        return [
+            (
+                pk_values,
+                dict(
+                    result,
+                    **{
+                        self.result_key: [
+                            item
+                            for item in result[self.result_key]
+                            if (
+                                self.min_score is None
+                                or item["Score"] >= self.min_score
+                            )
+                            and (
+                                not self.types
+                                or "Type" not in item
+                                or item["Type"] in self.types
+                            )
+                        ]
+                    }
+                ),
+            )
+            for pk_values, result in items
+        ]
+
+    def output_written(self, rows):
+        "Called with rows that have been inserted into the output table"
+
+    def output_deleting(self, keys):
+        "Called with primary keys whose output rows are about to be deleted"
+
+    def foreign_keys(self):
+        return []
+
+    def detect(self, client, texts, call, language_code=None):
+        """
+        Returns a batch_detect_* style response, using call() for API calls
+
+        The texts are all in language_code, or the analysis's language_code
+        if that is None.
+        """
+        raise NotImplementedError
+
+    def output_rows(self, items):
+        "Turn (pk values tuple, result) pairs into output table row tuples"
+        raise NotImplementedError
+
+    def rolled_back(self):
+        "Called if the transaction for a chunk was rolled back"
+        pass
+
+    def add_segment(self, pk_values, document, result, error):
+        """
+        Record the result or error for one segment of a row's text
+
+        Returns a (result, error, attempts) tuple once every segment of the
+        row has finished, or None while some are still outstanding.
+        """
+        state = self.segments.setdefault(
+            pk_values, {"remaining": document.parts, "parts": [], "error": None}
+        )
+        state["remaining"] -= 1
+        if error:
+            if not state["error"]:
+                state["error"] = (error, document.attempts + 1)
+        elif result is not None:
+            state["parts"].append((document, result))
+        if state["remaining"]:
+            return None
+        del self.segments[pk_values]
+        if state["error"]:
+            return (None,) + state["error"]
+        state["parts"].sort(key=lambda part: part[0].offset)
+        return self.merge(state["parts"]), None, 0
+
+    def merge(self, parts):
+        """
+        Combine the (document, result) pairs for the segments of one text,
+        shifting offsets to be relative to the start of the whole text
+        """
+        return {
+            self.result_key: [
+                dict(
+                    item,
+                    BeginOffset=item["BeginOffset"] + document.offset,
+                    EndOffset=item["EndOffset"] + document.offset,
+                )
+                for document, result in parts
+                for item in result[self.result_key]
+            ]
+        }
+
+
+class EntitiesAnalysis(Analysis):
+    name = "entities"
+    output_suffix = "comprehend_entities"
+    result_key = "Entities"
+    output_columns = {
+        "score": float,
+        "entity": int,
+        "begin_offset": int,
+        "end_offset": int,
+    }
+
+    def __init__(self, *args, entity_cache=None, summary=False, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Can be shared between tables in the same database
+        self.entity_cache = entity_cache
+        # Maintain a table of mention counts for each entity
+        self.summary = summary
+        self.summary_table = "{}_summary".format(self.output_table)
+
+    def reset(self):
+        super().reset()
+        self.db[self.summary_table].drop(True)
+        self.db["comprehend_entity_types"].drop(True)
+        self.db["comprehend_entities"].drop(True)
+        if self.entity_cache is not None:
+            self.entity_cache.ensure_tables()
+            self.entity_cache.reload()
+
+    def ensure_tables(self):
+        if self.entity_cache is None:
+            self.entity_cache = EntityCache(self.db)
+        super().ensure_tables()
+        if self.summary and not self.db[self.summary_table].exists():
+            self.db[self.summary_table].create(
+                {
+                    "entity": int,
+                    "mentions": int,
+                    "documents": int,
+                    "average_score": float,
+                },
+                pk="entity",
+                foreign_keys=[("entity", "comprehend_entities", "id")],
+                if_not_exists=True,
+            )
+            # Include any rows that were written before the summary existed
+            with self.db.conn:
+                self.refresh_summary()
+        # Counts are added to the existing totals, and the average score
+        # is weighted by the number of mentions on each side
+        self.update_summary_sql = """
+            insert into [{summary}] (entity, mentions, documents, average_score)
+            values (?, ?, ?, ?)
+            on conflict (entity) do update set
+                mentions = mentions + excluded.mentions,
+                documents = documents + excluded.documents,
+                average_score = (
+                    average_score * mentions
+                    + excluded.average_score * excluded.mentions
+                ) / (mentions + excluded.mentions)
+        """.format(summary=self.summary_table)
+
+    def rebuild(self):
+        rebuilt = super().rebuild()
+        if self.db[self.summary_table].exists():
+            with self.db.conn:
+                self.refresh_summary()
+        return rebuilt
+
+    def create_indexes(self):
+        super().create_indexes()
+        self.db[self.output_table].create_index(["entity"], if_not_exists=True)
+
+    def refresh_summary(self):
+        "Recalculate the whole summary table from the output table"
+        pks = ", ".join("[{}]".format(pk) for pk in self.pks)
+        self.db.execute("delete from [{}]".format(self.summary_table))
+        self.db.execute("""
+            insert into [{summary}] (entity, mentions, documents, average_score)
+            select entity, sum(mentions), count(*), sum(total_score) / sum(mentions)
+            from (
+                select entity, {pks}, count(*) as mentions, sum(score) as total_score
+                from [{output}] group by entity, {pks}
+            )
+            group by entity
+            """.format(summary=self.summary_table, output=self.output_table, pks=pks))
+
+    def output_written(self, rows):
+        if self.summary:
+            self.update_summary(rows, 1)
+
+    def output_deleting(self, keys):
+        if not self.summary:
+            return
+        # Output rows are (*pks, score, entity, begin_offset, end_offset)
+        sql = "select * from [{}] where {}".format(
+            self.output_table, " and ".join("[{}] = ?".format(pk) for pk in self.pks)
+        )
+        rows = [row for key in keys for row in self.db.execute(sql, key).fetchall()]
+        self.update_summary(rows, -1)
+        self.db.execute(
+            "delete from [{}] where mentions <= 0".format(self.summary_table)
+        )
+
+    def update_summary(self, rows, sign):
+        "Add output rows to the summary, or subtract them if sign is -1"
+        count = len(self.pks)
+        mentions = collections.Counter()
+        documents = collections.defaultdict(set)
+        total_scores = collections.Counter()
+        for row in rows:
+            score, entity = row[count], row[count + 1]
+            mentions[entity] += 1
+            documents[entity].add(row[:count])
+            total_scores[entity] += score
+        self.db.conn.executemany(
+            self.update_summary_sql,
+            [
+                (
+                    entity,
+                    sign * mentions[entity],
+                    sign * len(documents[entity]),
+                    total_scores[entity] / mentions[entity],
+                )
+                for entity in mentions
+            ],
+        )
+
+    def foreign_keys(self):
+        return [("entity", "comprehend_entities", "id")]
+
+    def detect(self, client, texts, call, language_code=None):
+        return call(
+            lambda: client.batch_detect_entities(
+                TextList=texts, LanguageCode=language_code or self.language_code
+            )
+        )
+
+    def output_rows(self, items):
+        entity_ids = self.entity_cache.lookup_many(
+            [
+                (entity["Type"], entity["Text"])
+                for _, result in items
+                for entity in result["Entities"]
+            ]
+        )
+        return [
+            pk_values
+            + (
+                entity["Score"],
+                entity_ids[(entity["Type"], entity["Text"])],
+                entity["BeginOffset"],
+                entity["EndOffset"],
+            )
+            for pk_values, result in items
+            for entity in result["Entities"]
+        ]
+
+    def rolled_back(self):
+        self.entity_cache.reload()
+
+
+class KeyPhrasesAnalysis(Analysis):
+    name = "key_phrases"
+    output_suffix = "comprehend_key_phrases"
+    result_key = "KeyPhrases"
+    output_columns = {
+        "score": float,
+        "text": str,
+        "begin_offset": int,
+        "end_offset": int,
+    }
+
+    def detect(self, client, texts, call, language_code=None):
+        return call(
+            lambda: client.batch_detect_key_phrases(
+                TextList=texts, LanguageCode=language_code or self.language_code
+            )
+        )
+
+    def output_rows(self, items):
+        return [
+            pk_values
+            + (
+                phrase["Score"],
+                phrase["Text"],
+                phrase["BeginOffset"],
+                phrase["EndOffset"],
+            )
+            for pk_values, result in items
+            for phrase in result["KeyPhrases"]
+        ]
+
+
+class SentimentAnalysis(Analysis):
+    name = "sentiment"
+    output_suffix = "comprehend_sentiment"
+    output_columns = {
+        "sentiment": str,
+        "positive": float,
+        "negative": float,
+        "neutral": float,
+        "mixed": float,
+    }
+
+    def detect(self, client, texts, call, language_code=None):
+        return call(
+            lambda: client.batch_detect_sentiment(
+                TextList=texts, LanguageCode=language_code or self.language_code
+            )
+        )
+
+    def merge(self, parts):
+        # Average the scores of the segments, weighted by their length
+        total = sum(len(document.text) for document, _ in parts) or 1
+        scores = {
+            label: sum(
+                result["SentimentScore"][label] * len(document.text)
+                for document, result in parts
+            )
+            / total
+            for label in ("Positive", "Negative", "Neutral", "Mixed")
+        }
+        return {
+            "Sentiment": max(scores, key=scores.get).upper(),
+            "SentimentScore": scores,
+        }
+
+    def output_rows(self, items):
+        return [
+            pk_values
+            + (
+                result["Sentiment"],
+                result["SentimentScore"]["Positive"],
+                result["SentimentScore"]["Negative"],
+                result["SentimentScore"]["Neutral"],
+                result["SentimentScore"]["Mixed"],
+            )
+            for pk_values, result in items
+        ]
+
+
+class PiiAnalysis(Analysis):
+    name = "pii"
+    output_suffix = "comprehend_pii_entities"
+    result_key = "Entities"
+    languages = ("en", "es")
+    output_columns = {
+        "type": str,
+        "score": float,
+        "begin_offset": int,
+        "end_offset": int,
+    }
+
+    def detect(self, client, texts, call, language_code=None):
+        from botocore.exceptions import ClientError
+
+        # There is no batch API for PII, so call detect_pii_entities for
+        # each document and assemble the results into a batch response
+        response = {"ResultList": [], "ErrorList": []}
+        for index, text in enumerate(texts):
+            try:
+                result = call(
+                    lambda: client.detect_pii_entities(
+                        Text=text, LanguageCode=language_code or self.language_code
+                    )
+                )
+            except ClientError as e:
+                error = e.response.get("Error", {})
+                if error.get("Code") in THROTTLING_ERROR_CODES:
+                    raise
+                response["ErrorList"].append(
+                    {
+                        "Index": index,
+                        "ErrorCode": error.get("Code"),
+                        "ErrorMessage": error.get("Message"),
+                    }
+                )
+                continue
+            response["ResultList"].append(
+                {"Index": index, "Entities": result["Entities"]}
+            )
+        return response
+
+    def output_rows(self, items):
+        return [
+            pk_values
+            + (
+                entity["Type"],
+                entity["Score"],
+                entity["BeginOffset"],
+                entity["EndOffset"],
+            )
+            for pk_values, result in items
+            for entity in result["Entities"]
+        ]
+
+
+class Pipeline:
+    """
+    Reads rows from a table, prepares each row's text once and sends it
+    to one or more analyses, writing the results as they come back
+
+    Up to `concurrency` batches per analysis are in flight on a worker pool
+    at once, so the same rows are sent to each API in parallel.
+    Results are written by the calling thread in the order the batches were
+    submitted, so _done tables only ever record rows whose results have been
+    written - anything still in flight when the run is interrupted will be
+    picked up again next time.
+    """
+
+    def __init__(
+        self,
+        db,
+        table,
+        columns,
+        analyses,
+        client,
+        read_db=None,
+        where=None,
+        params=None,
+        should_strip_tags=False,
+        concurrency=1,
+        commit_every=(1, "chunks"),
+        rate=10.0,
+        max_retries=5,
+        segment=False,
+        metrics=None,
+        prepare_workers=None,
+        prepare_pool=None,
+        incremental=False,
+        limiter=None,
+        store=True,
+        shard=None,
+        budget=None,
+        commits=None,
+        in_flight=None,
+        auto_language=False,
+        language_column=None,
+    ):
+        self.db = db
+        self.read_db = read_db or db
+        self.table = table
+        self.columns = columns
+        self.pks = db[table].pks
+        self.analyses = analyses
+        self.client = client
+        self.where = where
+        self.params = params or {}
+        self.should_strip_tags = should_strip_tags
+        self.segment = segment
+        self.prepare_workers = prepare_workers
+        # A process pool for prepare_workers that can be shared between
+        # pipelines - otherwise each run starts its own
+        self.prepare_pool = prepare_pool
+        self.incremental = incremental
+        # (index, count) to only process rows in shard index of count
+        self.shard = shard
+        self.metrics = metrics or NullMetrics()
+        # Each row's language is either detected or read from a column,
+        # otherwise every row is in each analysis's language_code
+        self.auto_language = auto_language and not language_column
+        self.language_column = language_column
+        self.language_cache = LanguageCache(db) if self.auto_language else None
+        language = language_setting(auto_language, language_column)
+        # Everything that affects the results for a row other than its
+        # column values, which are combined with them in its fingerprint
+        self.settings = {
+            analysis: analysis_settings(
+                analysis, columns, should_strip_tags, segment, language
+            )
+            for analysis in analyses
+        }
+        for connection in {db.conn, self.read_db.conn}:
+            if incremental:
+                connection.create_function(
+                    "comprehend_fingerprint", -1, sql_fingerprint
+                )
+            if shard:
+                connection.create_function("comprehend_shard", -1, shard_of)
+        # Total batches in flight, across all of the analyses
+        self.concurrency = concurrency * len(analyses)
+        self.max_retries = max_retries
+        self.limiter = limiter or AdaptiveRateLimiter(rate)
+        # Batches stop being sent once this is reached
+        self.budget = budget or Budget()
+        # Set store=False to skip writing results to the database
+        self.store = store
+        # Results waiting to be yielded by stream()
+        self.written = None
+        if commits is None:
+            # Output and _done rows are buffered across chunks, and always
+            # written before the transaction they belong to is committed
+            every, unit = commit_every
+            commits = BatchedCommits(
+                db,
+                every,
+                unit,
+                on_rollback=self.rolled_back,
+                writer=BufferedWriter(db, metrics=self.metrics),
+            )
+        # Pipelines writing to the same connection at once share commits
+        self.commits = commits
+        self.writer = commits.writer
+        # Batches in flight, as (pipeline, analysis, documents, future) -
+        # pipelines that share this are limited to concurrency between them
+        self.in_flight = collections.deque() if in_flight is None else in_flight
+        self.executor = None
+
+    def rolled_back(self):
+        for analysis in self.analyses:
+            analysis.rolled_back()
+
+    def pending_rows(self, where=None, params=None):
+        "Rows to process, where is an extra clause to combine with self.where"
+        if where and self.where:
+            where = "({}) and ({})".format(self.where, where)
+        return pending_rows(
+            self.read_db,
+            self.table,
+            self.pks,
+            self.columns,
+            [analysis.done_table for analysis in self.analyses],
+            where or self.where,
+            dict(self.params, **(params or {})),
+            fingerprints=(
+                [self.settings[analysis] for analysis in self.analyses]
+                if self.incremental
+                else None
+            ),
+            shard=self.shard,
+            extra_columns=[self.language_column] if self.language_column else (),
+        )
+
+    def fingerprint(self, analysis, row):
+        return fingerprint(
+            self.settings[analysis], [row[column] for column in self.columns]
+        )
+
+    def backfill_fingerprints(self):
+        """
+        Record fingerprints for _done rows from before they were stored,
+        assuming those rows have not changed since they were processed
+        """
+        for analysis in self.analyses:
+            sql = """
+                update [{done}] set fingerprint = (
+                    select comprehend_fingerprint(:settings, {columns})
+                    from [{table}] where {match}
+                ) where fingerprint is null
+            """.format(
+                done=analysis.done_table,
+                table=self.table,
+                columns=", ".join(
+                    "[{}].[{}]".format(self.table, column) for column in self.columns
+                ),
+                match=" and ".join(
+                    "[{table}].[{pk}] = [{done}].[{pk}]".format(
+                        table=self.table, done=analysis.done_table, pk=pk
+                    )
+                    for pk in self.pks
+                ),
+            )
+            with self.db.conn:
+                self.db.execute(sql, {"settings": self.settings[analysis]})
+
+    def create_indexes(self):
+        if self.store:
+            for analysis in self.analyses:
+                analysis.create_indexes()
+
+    def estimate_pending(self):
+        pending = max(
+            estimate_pending(
+                self.read_db, self.table, analysis.done_table, self.where, self.params
+            )
+            for analysis in self.analyses
+        )
+        if self.shard:
+            # Rows are split roughly evenly between the shards
+            pending = -(-pending // self.shard[1])
+        return pending
+
+    def run(self, rows):
+        "Process rows, e.g. from pending_rows()"
+        for _ in self.steps(rows):
+            pass
+
+    def stream(self, rows):
+        """
+        Process rows, yielding a Result for each row and analysis as soon as
+        it has been written to the output tables - which may be before its
+        transaction has been committed
+        """
+        self.written = collections.deque()
+        try:
+            for _ in self.steps(rows):
+                yield from self.flush_written()
+            yield from self.flush_written()
+        finally:
+            self.written = None
+
+    def flush_written(self):
+        # Buffered rows are written first, so each Result's rows are in the
+        # output tables by the time it is yielded
+        if self.written:
+            self.commits.flush()
+        while self.written:
+            yield self.written.popleft()
+
+    def steps(self, rows):
+        "Process rows, yielding each time results may have been written"
+        with concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.concurrency
+        ) as executor:
+            self.executor = executor
+            try:
+                for chunk, segments, languages in self.language_chunks(
+                    self.prepared_chunks(rows)
+                ):
+                    for analysis in self.analyses:
+                        self.enqueue(
+                            analysis,
+                            chunk,
+                            self.not_done(analysis, chunk),
+                            segments,
+                            languages,
+                        )
+                        self.send_queued(analysis)
+                    yield
+                    if self.budget.reached:
+                        break
+
+                # Writing the last batches may queue up documents to retry
+                while self.has_in_flight() or any(
+                    analysis.queue or analysis.retries for analysis in self.analyses
+                ):
+                    for analysis in self.analyses:
+                        self.send_queued(analysis, final=True)
+                    if self.has_in_flight():
+                        self.write_next()
+                    yield
+            finally:
+                # Don't start any batches that are still queued - their rows
+                # are not marked as done so they will be retried next time
+                others = []
+                for batch in self.in_flight:
+                    if batch[0] is self:
+                        batch[-1].cancel()
+                    else:
+                        others.append(batch)
+                self.in_flight.clear()
+                self.in_flight.extend(others)
+                # Chunks that were fully written are kept
+                with self.metrics.timer("write"):
+                    self.commits.commit()
+                self.executor = None
+        self.create_indexes()
+
+    def has_in_flight(self):
+        return any(batch[0] is self for batch in self.in_flight)
+
+    def read_chunks(self, rows):
+        "Yield lists of up to BATCH_SIZE rows"
+        rows = iter(rows)
+        while True:
+            with self.metrics.timer("query"):
+                chunk = list(itertools.islice(rows, BATCH_SIZE))
+            if not chunk:
+                return
+            self.metrics.count("rows", len(chunk))
+            yield chunk
+
+    def prepared_chunks(self, rows):
+        """
+        Yield (chunk, segments) pairs, where segments is a list of
+        (offset, text) segments for each row in the chunk
+
+        With prepare_workers the text is prepared in a pool of processes,
+        with up to two chunks per worker queued at once for this pipeline.
+        Chunks are always yielded in the order they were read.
+        """
+        chunks = self.read_chunks(rows)
+        if not self.prepare_workers:
+            for chunk in chunks:
+                with self.metrics.timer("prepare"):
+                    segments = prepare_rows(
+                        self.values(chunk), self.should_strip_tags, self.segment
+                    )
+                yield chunk, segments
+            return
+        pool = self.prepare_pool
+        if pool is None:
+            pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=self.prepare_workers
+            )
+        queued = collections.deque()
+        try:
+            for chunk in chunks:
+                queued.append(
+                    (
+                        chunk,
+                        pool.submit(
+                            prepare_rows,
+                            self.values(chunk),
+                            self.should_strip_tags,
+                            self.segment,
+                        ),
+                    )
+                )
+                if len(queued) >= self.prepare_workers * 2:
+                    yield self.next_prepared(queued)
+            while queued:
+                yield self.next_prepared(queued)
+        finally:
+            for _, future in queued:
+                future.cancel()
+            if pool is not self.prepare_pool:
+                pool.shutdown()
+
+    def next_prepared(self, queued):
+        chunk, future = queued.popleft()
+        with self.metrics.timer("prepare"):
+            return chunk, future.result()
+
+    def values(self, chunk):
+        return [[row[column] for column in self.columns] for row in chunk]
+
+    def language_chunks(self, chunks):
+        """
+        Yield (chunk, segments, languages) tuples, where languages is a list
+        of the language code for each row in the chunk, or None
+
+        With auto_language the languages for the next chunk are detected on
+        the worker pool while the batches for the current one are sent.
+        """
+        if not self.auto_language:
+            for chunk, segments in chunks:
+                languages = None
+                if self.language_column:
+                    # Empty values are treated as unknown
+                    languages = [row[self.language_column] or None for row in chunk]
+                yield chunk, segments, languages
+            return
+        queued = collections.deque()
+        try:
+            for chunk, segments in chunks:
+                queued.append((chunk, segments, self.start_detecting(segments)))
+                if len(queued) > 1:
+                    yield self.finish_detecting(*queued.popleft())
+            while queued:
+                yield self.finish_detecting(*queued.popleft())
+        finally:
+            for _, _, (_, _, future) in queued:
+                if future is not None:
+                    future.cancel()
+
+    def start_detecting(self, segments):
+        """
+        Look up the cached language for the text of each row, and start
+        detecting the languages of the rest - returns (keys, languages,
+        future) where future is None if every language was cached
+        """
+        # Rows that were split into segments are detected from the first
+        keys = [
+            self.language_cache.key(parts[0][1]) if parts else None
+            for parts in segments
+        ]
+        with self.metrics.timer("cache"):
+            languages = self.language_cache.get_many(
+                list({key for key in keys if key is not None})
+            )
+        misses = {}
+        for key, parts in zip(keys, segments):
+            if key is None:
+                continue
+            if key in languages or key in misses:
+                self.language_cache.hits += 1
+            else:
+                self.language_cache.misses += 1
+                misses[key] = parts[0][1]
+        future = None
+        if misses:
+            texts = list(misses.values())
+            units = sum(billable_units(text) for text in texts)
+            # Rows are not sent once the budget has been reached
+            if not self.budget.reached and self.budget.spend(units):
+                if self.metrics.enabled:
+                    self.metrics.count(
+                        "bytes", sum(len(text.encode("utf-8")) for text in texts)
+                    )
+                    self.metrics.count("units", units)
+                future = self.executor.submit(
+                    self.detect_languages, list(misses), texts
+                )
+        return keys, languages, future
+
+    def detect_languages(self, keys, texts):
+        with self.metrics.timer("api"):
+            response = self.call(
+                lambda: self.client.batch_detect_dominant_language(TextList=texts)
+            )
+        # The language with the highest score, for each text that succeeded
+        detected = []
+        for result in response["ResultList"]:
+            if result.get("Languages"):
+                language = max(result["Languages"], key=lambda item: item["Score"])
+                detected.append(
+                    (keys[result["Index"]], language["LanguageCode"], language["Score"])
+                )
+        return detected
+
+    def finish_detecting(self, chunk, segments, detecting):
+        keys, languages, future = detecting
+        if future is not None:
+            detected = future.result()
+            languages.update((key, language) for key, language, _ in detected)
+            if self.store:
+                # Written along with the results for the next chunk
+                self.writer.add([(self.language_cache.insert_sql, detected)])
+        # Texts that could not be detected are left as None
+        return chunk, segments, [languages.get(key) for key in keys]
+
+    def not_done(self, analysis, chunk):
+        "Indexes of rows in chunk that are not yet done for this analysis"
+        if len(self.analyses) == 1 or not self.store:
+            # pending_rows() has already excluded rows that are done
+            return range(len(chunk))
+        keys = [tuple(row[pk] for pk in self.pks) for row in chunk]
+        sql = "select {pks}, fingerprint from [{done}] where ({pks}) in (values {values})".format(
+            pks=", ".join("[{}]".format(pk) for pk in self.pks),
+            done=analysis.done_table,
+            values=", ".join(
+                "({})".format(", ".join("?" for _ in self.pks)) for _ in keys
+            ),
+        )
+        done = {
+            tuple(row[:-1]): row[-1]
+            for row in self.db.execute(
+                sql, [value for key in keys for value in key]
+            ).fetchall()
+        }
+        return [
+            i
+            for i, key in enumerate(keys)
+            if key not in done
+            or (self.incremental and done[key] != self.fingerprint(analysis, chunk[i]))
+        ]
+
+    def enqueue(self, analysis, chunk, indexes, segments, languages=None):
+        documents = []
+        # Rows in a language the analysis does not support, which are
+        # recorded as errors without calling the API
+        unsupported = []
+        for i in indexes:
+            row_fingerprint = self.fingerprint(analysis, chunk[i])
+            language = None
+            if languages:
+                # Rows whose language is not known use the default
+                language = languages[i] or analysis.language_code
+            for offset, text in segments[i]:
+                key = (
+                    analysis.response_cache.key(text, language)
+                    if analysis.response_cache
+                    else None
+                )
+                document = Document(
+                    chunk[i],
+                    text,
+                    key,
+                    offset,
+                    len(segments[i]),
+                    fingerprint=row_fingerprint,
+                    language=language,
+                )
+                if language is not None and language not in analysis.languages:
+                    unsupported.append(document)
+                else:
+                    documents.append(document)
+        if unsupported:
+            self.write_unsupported(analysis, unsupported)
+        if not analysis.response_cache:
+            analysis.queue.extend(documents)
+            return
+        response_cache = analysis.response_cache
+        with self.metrics.timer("cache"):
+            cached = response_cache.get_many([document.key for document in documents])
+        hits = []
+        for document in documents:
+            if document.key in cached:
+                response_cache.hits += 1
+                hits.append(document)
+            elif document.key in analysis.duplicates:
+                # Identical to a text that has already been sent
+                response_cache.hits += 1
+                analysis.duplicates[document.key].append(document)
+            else:
+                response_cache.misses += 1
+                analysis.duplicates[document.key] = []
+                analysis.queue.append(document)
+        if hits:
+            self.write_chunk(
+                analysis,
+                hits,
+                {
+                    "ResultList": [
+                        dict(cached[document.key], Index=i)
+                        for i, document in enumerate(hits)
+                    ],
+                    "ErrorList": [],
+                },
+                from_cache=True,
+            )
+
+    def write_unsupported(self, analysis, documents):
+        "Record documents in a language the analysis does not support as errors"
+        self.write_chunk(
+            analysis,
+            documents,
+            {
+                "ResultList": [],
+                "ErrorList": [
+                    {
+                        "Index": i,
+                        "ErrorCode": "UnsupportedLanguageException",
+                        "ErrorMessage": "{} does not support language {}".format(
+                            analysis.name, document.language
+                        ),
+                    }
+                    for i, document in enumerate(documents)
+                ],
+            },
+        )
+
+    def send_queued(self, analysis, final=False):
+        # Resubmitted documents go first, then misses, in batches of 25
+        # documents in the same language
+        if len(analysis.retries) + len(analysis.queue) < BATCH_SIZE and not (
+            final and (analysis.retries or analysis.queue)
+        ):
+            return
+        by_language = collections.defaultdict(list)
+        for document in analysis.retries + analysis.queue:
+            by_language[document.language].append(document)
+        del analysis.retries[:]
+        del analysis.queue[:]
+        for language, queued in by_language.items():
+            while len(queued) >= BATCH_SIZE or (final and queued):
+                documents = queued[:BATCH_SIZE]
+                del queued[:BATCH_SIZE]
+                units = sum(billable_units(document.text) for document in documents)
+                if self.budget.reached or not self.budget.spend(units):
+                    # Rows that are not sent are not marked as done, so they
+                    # will be processed next time
+                    del analysis.queue[:]
+                    return
+                self.submit(analysis, documents, units)
+            analysis.queue.extend(queued)
+
+    def submit(self, analysis, documents, units):
+        texts = [document.text for document in documents]
+        if self.metrics.enabled:
+            self.metrics.count(
+                "bytes", sum(len(text.encode("utf-8")) for text in texts)
+            )
+            self.metrics.count("units", units)
+        future = self.executor.submit(
+            self.detect, analysis, texts, documents[0].language
+        )
+        self.in_flight.append((self, analysis, documents, future))
+        if len(self.in_flight) >= self.concurrency:
+            self.write_next()
+
+    def detect(self, analysis, texts, language_code=None):
+        with self.metrics.timer("api"):
+            return analysis.detect(self.client, texts, self.call, language_code)
+
+    def call(self, fn):
+        return call_with_retries(fn, self.limiter, self.max_retries, self.metrics)
+
+    def write_next(self):
+        # The oldest batch, which may belong to another pipeline
+        pipeline, analysis, documents, future = self.in_flight.popleft()
+        pipeline.write_chunk(analysis, documents, future.result())
+
+    def write_chunk(self, analysis, documents, response, from_cache=False):
+        # Output, entity and _done writes for each chunk share a transaction
+        with self.metrics.timer("write"):
+            with self.commits.chunk():
+                self.write_results(analysis, documents, response, from_cache)
+            if self.writer.due:
+                self.commits.flush()
+        self.metrics.chunk_written(analysis.name)
+
+    def write_results(self, analysis, documents, response, from_cache=False):
+        pks = self.pks
+        # Match errors to documents
+        errors_by_index = {
+            error["Index"]: error for error in response.get("ErrorList") or []
+        }
+        # Match those to their primary keys and insert into the output table
+        # we match on Index because we cannot guarantee that every document
+        # has an item in ResultList, since there may have been errors
+        results_by_index = {}
+        for result in response["ResultList"]:
+            result = dict(result)
+            results_by_index[result.pop("Index")] = result
+        # Each finished document, along with any others that share its text
+        finished = []
+        to_cache = []
+        for i, document in enumerate(documents):
+            error = errors_by_index.get(i)
+            if (
+                error
+                and error.get("ErrorCode") in RETRYABLE_ERROR_CODES
+                and document.attempts < self.max_retries
+            ):
+                analysis.retries.append(
+                    document._replace(attempts=document.attempts + 1)
+                )
+                self.metrics.count("retries")
+                continue
+            result = results_by_index.get(i)
+            if result is not None:
+                to_cache.append((document.key, result, document.language))
+            finished.extend(
+                (shared, result, error, document.attempts + 1)
+                for shared in [document] + analysis.duplicates.pop(document.key, [])
+            )
+
+        if analysis.response_cache and to_cache and not from_cache:
+            with self.metrics.timer("cache"):
+                analysis.response_cache.set_many(to_cache)
+
+        items = []
+        done = []
+        succeeded = []
+        archived = []
+        for document, result, error, attempts in finished:
+            row = document.row
+            pk_values = tuple(row[pk] for pk in pks)
+            if document.parts > 1 or document.offset:
+                # Rows are only done once all of their segments have finished
+                completed = analysis.add_segment(pk_values, document, result, error)
+                if completed is None:
+                    continue
+                result, error, attempts = completed
+            if self.written is not None:
+                self.written.append(
+                    Result(analysis.name, {pk: row[pk] for pk in pks}, result, error)
+                )
+            if error:
+                self.metrics.count("errors")
+                if not self.store:
+                    continue
+                if self.written is None:
+                    click.echo(
+                        "{}: Error: {}".format(
+                            json.dumps({pk: row[pk] for pk in pks}), json.dumps(error)
+                        ),
+                        err=True,
+                    )
+                analysis.error_log.record(row, error, attempts)
+            elif result is not None:
+                items.append((pk_values, result))
+                succeeded.append(pk_values)
+                if analysis.response_archive:
+                    archived.append((pk_values, document.fingerprint, result))
+            done.append(
+                pk_values
+                + (document.fingerprint, document.language or analysis.language_code)
+            )
+        if not self.store:
+            return
+        keys = [values[:-2] for values in done]
+        if archived:
+            analysis.response_archive.set_many(archived)
+        if analysis.delete_archive_sql:
+            archived_keys = {pk_values for pk_values, _, _ in archived}
+            self.db.conn.executemany(
+                analysis.delete_archive_sql,
+                [key for key in keys if key not in archived_keys],
+            )
+        # Rows that failed on an earlier run are no longer errors
+        analysis.error_log.forget(succeeded)
+        if self.incremental:
+            # Remove the results from when changed rows were last processed
+            analysis.output_deleting(keys)
+            self.db.conn.executemany(analysis.delete_output_sql, keys)
+        with self.metrics.timer("lookup"):
+            to_insert = analysis.output_rows(analysis.filtered(items))
+        if to_insert:
+            analysis.output_written(to_insert)
+            self.metrics.count("mentions", len(to_insert))
+        # Added last, so a chunk that fails part way never buffers its rows
+        self.writer.add(
+            [
+                (analysis.insert_output_sql, to_insert),
+                (analysis.insert_done_sql, done),
+            ]
+        )
+
+    def run_bulk(self, rows, s3, s3_uri, role_arn, poll_interval=30):
+        "Process rows for the first analysis using an asynchronous job"
+        analysis = self.analyses[0]
+        # Only the primary keys of each row are kept while the job runs
+        documents = []
+
+        def texts():
+            for row in rows:
+                text = prepare_text(
+                    [row[column] for column in self.columns], self.should_strip_tags
+                )
+                key = (
+                    analysis.response_cache.key(text)
+                    if analysis.response_cache
+                    else None
+                )
+                documents.append(
+                    Document(
+                        {pk: row[pk] for pk in self.pks},
+                        None,
+                        key,
+                        fingerprint=self.fingerprint(analysis, row),
+                    )
+                )
+                self.metrics.count("rows")
+                yield text
+
+        results = run_job(
+            self.client,
+            s3,
+            s3_uri,
+            role_arn,
+            "{}-{}".format(analysis.output_table, int(time.time())),
+            texts(),
+            language_code=analysis.language_code,
+            poll_interval=poll_interval,
+        )
+        try:
+            for chunk in chunks(results, BATCH_SIZE):
+                chunk = list(chunk)
+                self.write_chunk(
+                    analysis,
+                    [documents[index] for index, _ in chunk],
+                    batch_response([result for _, result in chunk]),
+                )
+        finally:
+            with self.metrics.timer("write"):
+                self.commits.commit()
+        self.create_indexes()
+        if analysis.retries:
+            click.echo(
+                "{} documents failed and will be retried next time".format(
+                    len(analysis.retries)
+                ),
+                err=True,
+            )
+
+
+def interleave(runs):
+    """
+    Process (pipeline, rows) pairs at the same time, taking a chunk of rows
+    from each pipeline in turn, and yield each pipeline once it has finished
+
+    Pipelines created with the same in_flight deque keep up to concurrency
+    batches in flight between them, from whichever tables they are reading.
+    """
+    running = collections.deque(
+        (pipeline, pipeline.steps(rows)) for pipeline, rows in runs
+    )
+    try:
+        while running:
+            pipeline, steps = running.popleft()
+            try:
+                next(steps)
+            except StopIteration:
+                yield pipeline
+            else:
+                running.append((pipeline, steps))
+    finally:
+        for _, steps in running:
+            steps.close()
+
+
+def prepare_rows(values, should_strip_tags=False, segment=False):
+    """
+    Returns a list of (offset, text) segments for each list of column values
+
+    Runs in a worker process if --prepare-workers is used.
+    """
+    prepared = []
+    for row_values in values:
+        if not segment:
+            prepared.append([(0, prepare_text(row_values, should_strip_tags))])
+            continue
+        text = prepare_text(row_values, should_strip_tags, max_bytes=None)
+        prepared.append(list(segment_text(text)) or [(0, text)])
+    return prepared
+
+
+def fingerprint(settings, values):
+    """
+    Fingerprint of a row's column values and the settings used to process
+    them, recorded in the _done table to detect rows that have changed
+    """
+    return hashlib.blake2b(
+        "\0".join([settings] + [repr(value) for value in values]).encode("utf-8"),
+        digest_size=16,
+    ).hexdigest()
+
+
+def sql_fingerprint(settings, *values):
+    "The comprehend_fingerprint(settings, column, ...) SQL function"
+    return fingerprint(settings, values)
+
+
+def analysis_settings(analysis, columns, should_strip_tags, segment, language=None):
+    """
+    Everything that affects the results for a row other than its column
+    values, which are combined with them in its fingerprint
+
+    language is how each row's language is chosen, if it is not always the
+    analysis's language_code.
+    """
+    return json.dumps(
+        [
+            analysis.name,
+            language or analysis.language_code,
+            list(columns),
+            should_strip_tags,
+            segment,
+        ]
+    )
+
+
+def language_setting(auto_language, language_column):
+    "How each row's language is chosen, for analysis_settings()"
+    if language_column:
+        return "column:{}".format(language_column)
+    if auto_language:
+        return "auto"
+    return None
+
+
+def pending_clauses(
+    table, pks, columns, done_tables, where, params, fingerprints=None, shard=None
+):
+    """
+    Returns (clauses, params) for a where clause matching the rows in table
+    that are missing from any of done_tables
+
+    If fingerprints is a list of settings, one for each done table, rows
+    whose fingerprint no longer matches the one in that done table are also
+    included, unless no fingerprint was recorded for them. That uses the
+    comprehend_fingerprint() SQL function.
+
+    shard is an optional (index, count) tuple, which limits the rows to
+    those in that shard using the comprehend_shard() SQL function.
+    """
+    where_clauses = []
+    if done_tables:
+        # Skip previously processed rows, using each done table's index
+        where_clauses.append(
+            "({})".format(
+                " or ".join(
+                    "not exists (select 1 from [{done}] where {match})".format(
+                        done=done_table,
+                        match=" and ".join(
+                            [
+                                "[{done}].[{pk}] = [{table}].[{pk}]".format(
+                                    done=done_table, table=table, pk=pk
+                                )
+                                for pk in pks
+                            ]
+                            + (
+                                [
+                                    # Rows without a fingerprint are assumed
+                                    # to be unchanged, see backfill_fingerprints()
+                                    "([{done}].[fingerprint] is null"
+                                    " or [{done}].[fingerprint] = comprehend_fingerprint("
+                                    ":_settings_{i}, {columns}))".format(
+                                        done=done_table,
+                                        i=i,
+                                        columns=", ".join(
+                                            "[{}].[{}]".format(table, column)
+                                            for column in columns
+                                        ),
+                                    )
+                                ]
+                                if fingerprints
+                                else []
+                            )
+                        ),
+                    )
+                    for i, done_table in enumerate(done_tables)
+                )
+            )
+        )
+    params = dict(params or {})
+    if fingerprints:
+        params.update(
+            {
+                "_settings_{}".format(i): settings
+                for i, settings in enumerate(fingerprints)
+            }
+        )
+    if where:
+        where_clauses.append("({})".format(where))
+    if shard:
+        where_clauses.append(
+            "comprehend_shard(:_shard_count, {}) = :_shard_index".format(
+                ", ".join("[{}].[{}]".format(table, pk) for pk in pks)
+            )
+        )
+        params.update(_shard_index=shard[0] - 1, _shard_count=shard[1])
+    return where_clauses, params
+
+
+def pending_rows(
+    db,
+    table,
+    pks,
+    columns,
+    done_tables,
+    where,
+    params,
+    fingerprints=None,
+    shard=None,
+    extra_columns=(),
+):
+    """
+    Yield rows that are missing from any of done_tables, ordered by primary
+    key - see pending_clauses() for the arguments. extra_columns are also
+    selected, but are not part of the row's fingerprint.
+
+    Rows are fetched PAGE_SIZE at a time using keyset pagination, each
+    page is read in full so no cursor is held open between pages.
+    """
+    select = "select {} from [{}]".format(
+        ", ".join(
+            "[{}]".format(column)
+            for column in list(pks) + list(columns) + list(extra_columns)
+        ),
+        table,
+    )
+    where_clauses, params = pending_clauses(
+        table, pks, columns, done_tables, where, params, fingerprints, shard
+    )
+    pk_columns = ", ".join("[{}]".format(pk) for pk in pks)
+    after_clause = "({}) > ({})".format(
+        pk_columns, ", ".join(":_last_{}".format(i) for i in range(len(pks)))
+    )
+    order_by = " order by {} limit {}".format(pk_columns, PAGE_SIZE)
+    last = None
+    while True:
+        clauses = list(where_clauses)
+        page_params = dict(params)
+        if last is not None:
+            clauses.append(after_clause)
+            page_params.update(
+                {"_last_{}".format(i): value for i, value in enumerate(last)}
+            )
+        sql = select
+        if clauses:
+            sql += " where " + " and ".join(clauses)
+        sql += order_by
+        page = list(db.query(sql, page_params))
+        yield from page
+        if len(page) < PAGE_SIZE:
+            break
+        last = [page[-1][pk] for pk in pks]
+
+
+def estimate_units(
+    db,
+    table,
+    pks,
+    columns,
+    done_tables,
+    where,
+    params,
+    fingerprints=None,
+    shard=None,
+    should_strip_tags=False,
+    segment=False,
+    sample_size=SAMPLE_SIZE,
+):
+    """
+    Estimate the rows, documents, UTF-8 bytes and billable units that
+    processing the pending rows would send, as a dictionary
+
+    The totals are calculated in SQL without reading the text into Python,
+    from the length of the text before it is truncated or split into
+    segments. Stripping tags can't be done in SQL, so with should_strip_tags
+    the text for a random sample of the rows is prepared and the totals for
+    that sample are scaled up to the number of rows.
+    """
+    where_clauses, params = pending_clauses(
+        table, pks, columns, done_tables, where, params, fingerprints, shard
+    )
+    where_sql = (" where " + " and ".join(where_clauses)) if where_clauses else ""
+    text = " || ' ' || ".join("coalesce([{}], '')".format(column) for column in columns)
+    if segment:
+        documents = "max(1, (b + {0} - 1) / {0})".format(MAX_BYTES)
+        sent_bytes = "b"
+        units = "max(3 * {}, (c + 99) / 100)".format(documents)
+    else:
+        documents = "1"
+        sent_bytes = "min(b, {})".format(MAX_BYTES)
+        # Characters left after truncating to MAX_BYTES
+        units = (
+            "max(3, (case when b > {0} then c * {0} / b else c end + 99) / 100)".format(
+                MAX_BYTES
+            )
+        )
+    sql = """
+        select count(*), sum({documents}), sum({sent_bytes}), sum({units}) from (
+            select length(cast({text} as blob)) as b, length({text}) as c
+            from [{table}]{where}
+        )
+    """.format(
+        documents=documents,
+        sent_bytes=sent_bytes,
+        units=units,
+        text=text,
+        table=table,
+        where=where_sql,
+    )
+    rows, documents, sent_bytes, units = db.execute(sql, params).fetchone()
+    estimate = {
+        "rows": rows,
+        "documents": documents or 0,
+        "bytes": sent_bytes or 0,
+        "units": units or 0,
+    }
+    if not should_strip_tags or not rows:
+        return estimate
+    pk_columns = ", ".join("[{}]".format(pk) for pk in pks)
+    sample = db.execute(
+        """
+        select {columns} from [{table}] where ({pks}) in (
+            select {pks} from [{table}]{where} order by random() limit {limit}
+        )
+        """.format(
+            columns=", ".join("[{}]".format(column) for column in columns),
+            table=table,
+            pks=pk_columns,
+            where=where_sql,
+            limit=int(sample_size),
+        ),
+        params,
+    ).fetchall()
+    texts = [
+        text
+        for segments in prepare_rows(sample, should_strip_tags, segment)
+        for _, text in segments
+    ]
+    scale = rows / len(sample)
+    estimate.update(
+        documents=round(len(texts) * scale),
+        bytes=round(sum(len(text.encode("utf-8")) for text in texts) * scale),
+        units=round(sum(billable_units(text) for text in texts) * scale),
+    )
+    return estimate
+
+
+def estimate_pending(db, table, done_table, where, params):
+    "Estimate of rows left to process, without running the anti-join"
+    sql = "select count(*) from [{}]".format(table)
+    if where:
+        sql += " where {}".format(where)
+    total = db.execute(sql, params).fetchone()[0]
+    done = db.execute("select count(*) from [{}]".format(done_table)).fetchone()[0]
+    return max(total - done, 0)
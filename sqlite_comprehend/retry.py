@@ -0,0 +1,193 @@
+import json
+import threading
+import time
+
+# Error codes for a whole API call that mean "slow down and try again"
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ProvisionedThroughputExceededException",
+    "RequestLimitExceeded",
+}
+
+# ErrorCode values in a batch ErrorList that are worth resubmitting
+RETRYABLE_ERROR_CODES = THROTTLING_ERROR_CODES | {
+    "INTERNAL_SERVER_ERROR",
+    "InternalServerException",
+}
+
+
+class AdaptiveRateLimiter:
+    """
+    Thread-safe token bucket that adapts its rate to throttling
+
+    The rate is halved each time a call is throttled, down to min_rate,
+    then increases by a twentieth of max_rate for each successful call
+    until it is back at max_rate.
+    """
+
+    def __init__(self, max_rate=10.0, min_rate=0.1, clock=None, sleep=None):
+        self.max_rate = max_rate
+        self.min_rate = min(min_rate, max_rate)
+        self.rate = max_rate
+        self.clock = clock or time.monotonic
+        self.sleep = sleep or time.sleep
+        self.throttles = 0
+        self._tokens = max(max_rate, 1.0)
+        self._updated = self.clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self._tokens = min(
+            max(self.rate, 1.0), self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    def acquire(self):
+        "Block until a call is allowed"
+        while True:
+            with self._lock:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            self.sleep(wait)
+
+    def throttled(self):
+        with self._lock:
+            self.throttles += 1
+            self.rate = max(self.min_rate, self.rate / 2)
+            # Give the service a moment before the next call
+            self._tokens = min(self._tokens, 0)
+
+    def succeeded(self):
+        with self._lock:
+            self.rate = min(self.max_rate, self.rate + self.max_rate / 20)
+
+
+def call_with_retries(fn, limiter, max_retries=5, metrics=None):
+    """
+    Call fn() at the rate allowed by limiter, retrying if it is throttled
+
+    Errors other than throttling, or throttling that persists for more
+    than max_retries attempts, are raised. Each retry is counted as
+    "throttled" in metrics, if it is provided.
+    """
+    from botocore.exceptions import ClientError
+
+    attempt = 0
+    while True:
+        limiter.acquire()
+        try:
+            response = fn()
+        except ClientError as e:
+            if e.response.get("Error", {}).get("Code") not in THROTTLING_ERROR_CODES:
+                raise
+            limiter.throttled()
+            attempt += 1
+            if attempt > max_retries:
+                raise
+            if metrics is not None:
+                metrics.count("throttled")
+            continue
+        limiter.succeeded()
+        return response
+
+
+class ErrorLog:
+    """
+    Rows that failed permanently, recorded in the comprehend_errors table
+
+    Rows are identified by output table and a JSON object of primary keys.
+    """
+
+    table_name = "comprehend_errors"
+
+    def __init__(self, db, output_table, pks):
+        self.db = db
+        self.output_table = output_table
+        self.pks = pks
+        self.recorded = 0
+        self._exists = False
+
+    def ensure_table(self):
+        # Plain SQL rather than .create(), which would commit the caller's
+        # transaction part way through a chunk
+        self.db.execute("""
+            create table if not exists [{}] (
+               [output_table] TEXT,
+               [row_pks] TEXT,
+               [error_code] TEXT,
+               [error_message] TEXT,
+               [attempts] INTEGER,
+               PRIMARY KEY ([output_table], [row_pks])
+            )
+            """.format(self.table_name))
+        self._exists = True
+
+    def record(self, row, error, attempts):
+        "Record a failure - part of the caller's transaction"
+        self.ensure_table()
+        self.db.execute(
+            "insert or replace into [{}] (output_table, row_pks, error_code, "
+            "error_message, attempts) values (?, ?, ?, ?, ?)".format(self.table_name),
+            [
+                self.output_table,
+                self.row_pks([row[pk] for pk in self.pks]),
+                error.get("ErrorCode"),
+                error.get("ErrorMessage"),
+                attempts,
+            ],
+        )
+        self.recorded += 1
+
+    def exists(self):
+        # Once created, the table is never dropped
+        if not self._exists:
+            self._exists = self.db[self.table_name].exists()
+        return self._exists
+
+    def row_pks(self, pk_values):
+        return json.dumps(dict(zip(self.pks, pk_values)))
+
+    def forget(self, keys):
+        """
+        Remove the errors recorded for rows that have since succeeded - part
+        of the caller's transaction
+
+        keys is a list of primary key value tuples.
+        """
+        if not keys or not self.exists():
+            return
+        self.db.conn.executemany(
+            "delete from [{}] where output_table = ? and row_pks = ?".format(
+                self.table_name
+            ),
+            [(self.output_table, self.row_pks(key)) for key in keys],
+        )
+
+    def keys(self):
+        "Primary key value tuples for the rows with recorded errors"
+        if not self.exists():
+            return []
+        return [
+            tuple(json.loads(row_pks)[pk] for pk in self.pks)
+            for (row_pks,) in self.db.execute(
+                "select row_pks from [{}] where output_table = ?".format(
+                    self.table_name
+                ),
+                [self.output_table],
+            ).fetchall()
+        ]
+
+    def clear(self):
+        "Remove every error recorded for the output table"
+        if not self.exists():
+            return
+        with self.db.conn:
+            self.db.execute(
+                "delete from [{}] where output_table = ?".format(self.table_name),
+                [self.output_table],
+            )
@@ -1,8 +1,21 @@
 import click
-import boto3
+import contextlib
+import functools
 from html.parser import HTMLParser
+import sqlite3
+import threading
+import time
 import json
 import configparser
+import zlib
+
+# Seconds to wait to connect to an AWS endpoint, and then for a response
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 60
+
+
+# The parameters added by common_boto3_options(), for make_client()
+BOTO3_OPTIONS = ("access_key", "secret_key", "session_token", "endpoint_url", "auth")
 
 
 def common_boto3_options(fn):
@@ -36,7 +49,15 @@ def common_boto3_options(fn):
     return fn
 
 
-def make_client(service, access_key, secret_key, session_token, endpoint_url, auth):
+def make_client(
+    service,
+    access_key=None,
+    secret_key=None,
+    session_token=None,
+    endpoint_url=None,
+    auth=None,
+    max_pool_connections=None,
+):
     if auth:
         if access_key or secret_key or session_token:
             raise click.ClickException(
@@ -60,6 +81,29 @@ def make_client(service, access_key, secret_key, session_token, endpoint_url, au
                     secret_key = config[section].get("aws_secret_access_key")
                     session_token = config[section].get("aws_session_token")
                     break
+    return cached_client(
+        service,
+        access_key,
+        secret_key,
+        session_token,
+        endpoint_url,
+        max_pool_connections,
+    )
+
+
+@functools.lru_cache(maxsize=None)
+def cached_client(
+    service, access_key, secret_key, session_token, endpoint_url, max_pool_connections
+):
+    """
+    One client for each service, set of credentials and endpoint, so they
+    and their connection pools are reused within a process
+
+    boto3 is imported here, so commands that don't need a client - and
+    --help - don't have to wait for it to load.
+    """
+    import boto3
+
     kwargs = {}
     if access_key:
         kwargs["aws_access_key_id"] = access_key
@@ -69,18 +113,280 @@ def make_client(service, access_key, secret_key, session_token, endpoint_url, au
         kwargs["aws_session_token"] = session_token
     if endpoint_url:
         kwargs["endpoint_url"] = endpoint_url
-    return boto3.client(service, **kwargs)
+    return boto3.client(service, config=client_config(max_pool_connections), **kwargs)
+
+
+def client_config(max_pool_connections=None):
+    from botocore.config import Config
+
+    return Config(
+        # Concurrent callers each need their own HTTP connection
+        max_pool_connections=max_pool_connections or 10,
+        connect_timeout=CONNECT_TIMEOUT,
+        read_timeout=READ_TIMEOUT,
+        tcp_keepalive=True,
+        # Throttling is retried by call_with_retries(), which slows the
+        # AdaptiveRateLimiter down - so botocore only retries once
+        retries={"mode": "standard", "total_max_attempts": 2},
+    )
+
+
+def prepare_text(values, should_strip_tags=False, max_bytes=5000):
+    """
+    Concatenate column values into a single text of at most max_bytes
+    UTF-8 bytes - pass max_bytes=None to skip truncation
+    """
+    concat = " ".join((value or "") for value in values)
+    if should_strip_tags:
+        concat = strip_tags(concat)
+    if max_bytes is None:
+        return concat
+    concat_utf8 = concat.encode("utf-8")
+    if len(concat_utf8) > max_bytes:
+        concat_utf8 = concat_utf8[:max_bytes]
+        # Truncate back to last whitespace to avoid risk of splitting a codepoint
+        concat_utf8 = concat_utf8.rsplit(None, 1)[0]
+    return concat_utf8.decode("utf-8")
+
+
+SENTENCE_ENDINGS = ".!?\u3002"
+
+
+def segment_text(text, max_bytes=5000):
+    """
+    Yield (offset, segment) pairs splitting text into segments of at most
+    max_bytes UTF-8 bytes, where offset is the segment's character offset
+
+    Segments end at a sentence boundary where there is one in the second
+    half of the segment, otherwise at whitespace. Only one segment-sized
+    window is copied at a time, so this runs in linear time.
+    """
+    length = len(text)
+    start = 0
+    while start < length:
+        # Skip whitespace between segments
+        while start < length and text[start].isspace():
+            start += 1
+        if start == length:
+            return
+        # max_bytes characters is always at least max_bytes bytes
+        window = text[start : start + max_bytes]
+        encoded = window.encode("utf-8")
+        if len(encoded) > max_bytes:
+            window = encoded[:max_bytes].decode("utf-8", "ignore")
+        elif start + len(window) == length:
+            yield start, window
+            return
+        cut = _segment_boundary(window)
+        yield start, window[:cut].rstrip()
+        start += cut
+
+
+def _segment_boundary(window):
+    "Position to end a segment, searching back no further than half way"
+    half = len(window) // 2
+    whitespace = None
+    for i in range(len(window) - 1, half, -1):
+        if window[i].isspace():
+            if window[i - 1] in SENTENCE_ENDINGS:
+                return i
+            if whitespace is None:
+                whitespace = i
+    return whitespace or len(window)
+
+
+class CommitInterval(click.ParamType):
+    "A number of chunks, e.g. 10 - or a number of seconds, e.g. 30s"
+
+    name = "interval"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        unit = "chunks"
+        number = value.strip()
+        if number.endswith("s"):
+            unit = "seconds"
+            number = number[:-1]
+        try:
+            number = float(number) if unit == "seconds" else int(number)
+        except ValueError:
+            self.fail("{!r} should be e.g. 10 or 30s".format(value), param, ctx)
+        if number <= 0:
+            self.fail("{!r} must be greater than 0".format(value), param, ctx)
+        return number, unit
+
+
+class Types(click.ParamType):
+    "Comma-separated entity types, e.g. PERSON,LOCATION - returns a tuple"
+
+    name = "types"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        types = tuple(
+            type_value.strip().upper()
+            for type_value in value.split(",")
+            if type_value.strip()
+        )
+        if not types:
+            self.fail("{!r} should be e.g. PERSON,LOCATION".format(value), param, ctx)
+        return types
+
+
+class Shard(click.ParamType):
+    "One of N shards, e.g. 2/4 - returns an (index, count) tuple"
+
+    name = "shard"
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, tuple):
+            return value
+        index, _, count = value.partition("/")
+        try:
+            index, count = int(index), int(count)
+        except ValueError:
+            self.fail("{!r} should be e.g. 1/4".format(value), param, ctx)
+        if not 1 <= index <= count:
+            self.fail(
+                "{!r} should be between 1/{} and {}/{}".format(
+                    value, count, count, count
+                ),
+                param,
+                ctx,
+            )
+        return index, count
+
+
+def shard_of(count, *values):
+    "Shard from 0 to count - 1 for a row's primary key values"
+    return (
+        zlib.crc32("\0".join(repr(value) for value in values).encode("utf-8")) % count
+    )
+
+
+def retry_locked(fn, attempts=5, sleep=time.sleep):
+    """
+    Call fn(), retrying if the database is locked by another process for
+    longer than the connection's busy timeout
+    """
+    for attempt in range(attempts):
+        try:
+            return fn()
+        except sqlite3.OperationalError as e:
+            if "locked" not in str(e) and "busy" not in str(e):
+                raise
+            if attempt == attempts - 1:
+                raise
+            sleep(0.1 * 2**attempt)
+
+
+class BatchedCommits:
+    """
+    Groups the writes for several chunks into a single transaction
+
+    Each chunk is written inside a savepoint, so a chunk that fails part
+    way through is rolled back without affecting the chunks before it.
+    The transaction is committed every `every` chunks or seconds.
+
+    Rows buffered by writer, a BufferedWriter, are written by flush() and
+    before each commit. If that fails the whole transaction is rolled back,
+    as the chunks those rows came from have already been released.
+    """
+
+    def __init__(
+        self,
+        db,
+        every=1,
+        unit="chunks",
+        on_rollback=None,
+        writer=None,
+        sleep=time.sleep,
+    ):
+        self.db = db
+        self.every = every
+        self.unit = unit
+        self.on_rollback = on_rollback
+        self.writer = writer
+        self.sleep = sleep
+        self.commits = 0
+        self._reset()
+
+    def _reset(self):
+        self.pending_chunks = 0
+        self.started = time.monotonic()
+
+    @contextlib.contextmanager
+    def chunk(self):
+        if not self.db.conn.in_transaction:
+            # Take the write lock up front, waiting for any other process
+            # that is writing to the same database
+            retry_locked(lambda: self.db.execute("begin immediate"), sleep=self.sleep)
+        self.db.execute("savepoint chunk")
+        try:
+            yield
+        except BaseException:
+            self.db.execute("rollback to chunk")
+            self.db.execute("release chunk")
+            if self.on_rollback:
+                self.on_rollback()
+            raise
+        self.db.execute("release chunk")
+        self.pending_chunks += 1
+        if self.unit == "chunks":
+            due = self.pending_chunks >= self.every
+        else:
+            due = time.monotonic() - self.started >= self.every
+        if due:
+            self.commit()
+
+    def flush(self):
+        if self.writer is None:
+            return
+        try:
+            self.writer.flush()
+        except BaseException:
+            self.writer.discard()
+            if self.db.conn.in_transaction:
+                self.db.conn.rollback()
+            self._reset()
+            if self.on_rollback:
+                self.on_rollback()
+            raise
+
+    def commit(self):
+        # Rows can be buffered outside of a transaction, which writing them
+        # then begins
+        self.flush()
+        if self.db.conn.in_transaction:
+            retry_locked(self.db.conn.commit, sleep=self.sleep)
+            self.commits += 1
+        self._reset()
 
 
 # Adapted from Django's strip_tags() implementation
 class MLStripper(HTMLParser):
     def __init__(self):
         super().__init__(convert_charrefs=False)
-        self.reset()
+
+    def reset(self):
+        super().reset()
         self.accumulated = []
+        # True inside <script> and <style>, whose contents are dropped
+        self.in_raw_text = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag in ("script", "style"):
+            self.in_raw_text = True
+
+    def handle_endtag(self, tag):
+        if tag in ("script", "style"):
+            self.in_raw_text = False
 
     def handle_data(self, d):
-        self.accumulated.append(d)
+        if not self.in_raw_text:
+            self.accumulated.append(d)
 
     def handle_entityref(self, name):
         self.accumulated.append("&%s;" % name)
@@ -92,19 +398,35 @@ class MLStripper(HTMLParser):
         return "".join(self.accumulated)
 
 
+# Each thread reuses one MLStripper, which is reset before each value
+_strippers = threading.local()
+
+
 def _strip_once(value):
-    s = MLStripper()
-    s.feed(value)
-    s.close()
-    return s.get_string()
+    stripper = getattr(_strippers, "stripper", None)
+    if stripper is None:
+        stripper = _strippers.stripper = MLStripper()
+    else:
+        stripper.reset()
+    stripper.feed(value)
+    stripper.close()
+    return stripper.get_string()
 
 
 def strip_tags(value):
+    """
+    Remove HTML tags, comments and the contents of <script> and <style>
+
+    Tags that are formed by removing other tags are removed too, by
+    stripping again until no more tags are found.
+    """
     value = str(value)
-    while "<" in value and ">" in value:
+    count = value.count("<")
+    while count and ">" in value:
         new_value = _strip_once(value)
-        if value.count("<") == new_value.count("<"):
+        new_count = new_value.count("<")
+        if new_count == count:
             # _strip_once wasn't able to detect more tags.
             break
-        value = new_value
+        value, count = new_value, new_count
     return value
@@ -0,0 +1,190 @@
+import click
+import time
+from .pipeline import BATCH_SIZE
+
+# The current time as seconds since the epoch, as a float, in SQL
+SQL_NOW = "(julianday('now') - 2440587.5) * 86400.0"
+
+
+class Watcher:
+    """
+    Processes rows in a table soon after they are inserted or updated
+
+    Triggers on the table add the primary keys of new rows to a queue
+    table, {table}_comprehend_queue - and of changed rows too if the
+    pipeline is incremental, as only then are processed rows sent again.
+    While nothing is happening the
+    only query run on each poll is "pragma data_version", which changes
+    when another connection commits to the database.
+
+    Queued rows are processed once there are enough for a full batch, or
+    once the oldest of them has waited max_wait seconds.
+    """
+
+    def __init__(
+        self, pipeline, poll_interval=1.0, max_wait=5.0, sleep=None, clock=None
+    ):
+        self.pipeline = pipeline
+        self.db = pipeline.db
+        self.table = pipeline.table
+        self.pks = pipeline.pks
+        self.queue_table = queue_table(self.table)
+        self.poll_interval = poll_interval
+        self.max_wait = max_wait
+        self.sleep = sleep or time.sleep
+        self.clock = clock or time.time
+        self.processed = 0
+        # Only count and remove the rows in this process's shard
+        self.shard_clause = ""
+        self.shard_params = {}
+        if pipeline.shard:
+            self.shard_clause = (
+                " and comprehend_shard(:_shard_count, {}) = :_shard_index".format(
+                    self.pk_columns()
+                )
+            )
+            self.shard_params = {
+                "_shard_index": pipeline.shard[0] - 1,
+                "_shard_count": pipeline.shard[1],
+            }
+
+    def pk_columns(self, prefix=""):
+        return ", ".join("{}[{}]".format(prefix, pk) for pk in self.pks)
+
+    def install(self):
+        "Create the queue table and the triggers that add rows to it"
+        declared = {column.name: column.type for column in self.db[self.table].columns}
+        # An autoincrement ID means rows queued again while they are being
+        # processed always sort after the rows that are being processed
+        sql = """
+            create table if not exists [{queue}] (
+               [queue_id] INTEGER PRIMARY KEY AUTOINCREMENT,
+               {pks},
+               [queued_at] FLOAT
+            );
+            create unique index if not exists [{queue}_pks] on [{queue}] ({pk_columns});
+        """.format(
+            queue=self.queue_table,
+            pks=",\n               ".join(
+                "[{}] {}".format(pk, declared[pk]).strip() for pk in self.pks
+            ),
+            pk_columns=self.pk_columns(),
+        )
+        # Delete then insert, rather than "insert or replace", as the
+        # conflict clause of the statement that fired the trigger would be
+        # used instead
+        enqueue = """
+            begin
+                delete from [{queue}] where {match};
+                insert into [{queue}] ({pk_columns}, [queued_at])
+                values ({new_pks}, {now});
+            end;
+        """.format(
+            queue=self.queue_table,
+            match=" and ".join("[{pk}] = new.[{pk}]".format(pk=pk) for pk in self.pks),
+            pk_columns=self.pk_columns(),
+            new_pks=self.pk_columns("new."),
+            now=SQL_NOW,
+        )
+        sql += """
+            create trigger if not exists [{queue}_insert]
+            after insert on [{table}] {enqueue}
+        """.format(queue=self.queue_table, table=self.table, enqueue=enqueue)
+        if self.pipeline.incremental:
+            sql += """
+                create trigger if not exists [{queue}_update]
+                after update of {columns} on [{table}] {enqueue}
+            """.format(
+                queue=self.queue_table,
+                table=self.table,
+                columns=", ".join(
+                    "[{}]".format(column) for column in self.pipeline.columns
+                ),
+                enqueue=enqueue,
+            )
+        else:
+            # Left behind by an earlier --incremental run - updated rows
+            # that have been processed would be queued then skipped
+            sql += "drop trigger if exists [{}_update];".format(self.queue_table)
+        self.db.conn.executescript(sql)
+
+    def run(self):
+        "Process queued rows as they arrive, until interrupted or over budget"
+        version = None
+        due = None
+        while True:
+            current = self.data_version()
+            if current != version or (due is not None and self.clock() >= due):
+                version = current
+                due = self.process()
+                if self.pipeline.budget.reached:
+                    return
+            wait = self.poll_interval
+            if due is not None:
+                wait = min(wait, max(due - self.clock(), 0))
+            self.sleep(wait)
+
+    def data_version(self):
+        return self.pipeline.read_db.execute("pragma data_version").fetchone()[0]
+
+    def process(self):
+        """
+        Process the queued rows if there are enough of them or they have
+        waited long enough, otherwise return the time they will be due
+        """
+        count, oldest, last = self.pipeline.read_db.execute(
+            "select count(*), min(queued_at), max(queue_id) from [{}] where 1{}".format(
+                self.queue_table, self.shard_clause
+            ),
+            self.shard_params,
+        ).fetchone()
+        if not count:
+            return None
+        due = oldest + self.max_wait
+        if count < BATCH_SIZE and self.clock() < due:
+            return due
+        # Rows that have already been processed are skipped by pending_rows()
+        rows = self.pipeline.pending_rows(
+            where="({pks}) in (select {pks} from [{queue}] where queue_id <= :_queue_last)".format(
+                pks=self.pk_columns(), queue=self.queue_table
+            ),
+            params={"_queue_last": last},
+        )
+        processed = self.processed
+        self.pipeline.run(self.counted(rows))
+        if self.pipeline.budget.reached:
+            # Leave the rows that were not sent in the queue
+            return None
+        with self.db.conn:
+            self.db.execute(
+                "delete from [{}] where queue_id <= :_queue_last{}".format(
+                    self.queue_table, self.shard_clause
+                ),
+                dict(self.shard_params, _queue_last=last),
+            )
+        processed = self.processed - processed
+        if processed:
+            click.echo(
+                "Processed {} row{}".format(processed, "" if processed == 1 else "s"),
+                err=True,
+            )
+        return None
+
+    def counted(self, rows):
+        for row in rows:
+            self.processed += 1
+            yield row
+
+
+def queue_table(table):
+    return "{}_comprehend_queue".format(table)
+
+
+def uninstall(db, table):
+    "Drop the triggers and queue table created by Watcher.install()"
+    queue = queue_table(table)
+    db.conn.executescript("""
+        drop trigger if exists [{queue}_insert];
+        drop trigger if exists [{queue}_update];
+        drop table if exists [{queue}];
+        """.format(queue=queue))
@@ -0,0 +1,75 @@
+import time
+
+# Buffered rows are written once there are this many of them, or once the
+# oldest has waited this many seconds - and always before a commit
+FLUSH_ROWS = 10000
+FLUSH_SECONDS = 5.0
+
+
+class BufferedWriter:
+    """
+    Buffers rows for prepared executemany() statements across chunks
+
+    Each call to add() takes a list of (sql, rows) pairs for one chunk, where
+    rows are tuples of parameters. flush() runs one executemany() for each
+    statement with every row buffered for it, in the order the statements
+    were first added - so the output rows and the _done rows that record
+    them are always written together.
+    """
+
+    def __init__(
+        self,
+        db,
+        max_rows=FLUSH_ROWS,
+        max_seconds=FLUSH_SECONDS,
+        metrics=None,
+        clock=time.monotonic,
+    ):
+        self.db = db
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.metrics = metrics
+        self.clock = clock
+        self.statements = {}
+        self.buffered = 0
+        self.oldest = None
+        # Totals for every flush
+        self.written = 0
+        self.seconds = 0.0
+
+    def add(self, writes):
+        for sql, rows in writes:
+            if not rows:
+                continue
+            self.statements.setdefault(sql, []).extend(rows)
+            self.buffered += len(rows)
+        if self.buffered and self.oldest is None:
+            self.oldest = self.clock()
+
+    @property
+    def due(self):
+        return self.buffered >= self.max_rows or (
+            self.oldest is not None and self.clock() - self.oldest >= self.max_seconds
+        )
+
+    def flush(self):
+        if not self.buffered:
+            return
+        start = time.perf_counter()
+        for sql, rows in self.statements.items():
+            self.db.conn.executemany(sql, rows)
+        self.seconds += time.perf_counter() - start
+        self.written += self.buffered
+        if self.metrics:
+            self.metrics.count("written", self.buffered)
+        self.discard()
+
+    def discard(self):
+        "Drop the buffered rows, e.g. after the transaction was rolled back"
+        self.statements = {}
+        self.buffered = 0
+        self.oldest = None
+
+    @property
+    def rows_per_second(self):
+        return self.written / self.seconds if self.seconds else 0.0
@@ -1,9 +1,38 @@
+from botocore.exceptions import ClientError
 from click.testing import CliRunner
-from unittest.mock import call
+from unittest.mock import ANY, call
+from sqlite_comprehend import EntityExtractor, Result
+from sqlite_comprehend.cache import EntityCache
 from sqlite_comprehend.cli import cli
-from sqlite_comprehend.utils import strip_tags
+from sqlite_comprehend.metrics import Metrics
+from sqlite_comprehend.retry import AdaptiveRateLimiter, call_with_retries
+from sqlite_comprehend.utils import (
+    cached_client,
+    make_client,
+    retry_locked,
+    segment_text,
+    strip_tags,
+)
+from sqlite_comprehend.watch import Watcher
+from sqlite_comprehend.writer import BufferedWriter
+import concurrent.futures
+import sqlite3
+import io
+import json
 import sqlite_utils
 import pytest
+import re
+import subprocess
+import sys
+import tarfile
+import time
+
+
+@pytest.fixture(autouse=True)
+def clear_cached_clients():
+    # Each test patches boto3.client, so clients can't be reused between them
+    cached_client.cache_clear()
+
 
 ENTITIES_SQL = """
 select
@@ -97,10 +126,15 @@ def test_entities(mocker, tmpdir, compound_primary_key):
                 "entity_type": "PERSON",
             },
         ]
+        done_rows = list(db["pages_comprehend_entities_done"].rows)
+        # Each row has a fingerprint of its text and the settings used
+        assert all(
+            re.match("^[0-9a-f]{32}$", row.pop("fingerprint")) for row in done_rows
+        )
         if compound_primary_key:
-            assert list(db["pages_comprehend_entities_done"].rows) == [
-                {"id": 1, "text": "John Bob"},
-                {"id": 2, "text": "Sandra X"},
+            assert done_rows == [
+                {"id": 1, "text": "John Bob", "language": "en"},
+                {"id": 2, "text": "Sandra X", "language": "en"},
             ]
             assert db["pages_comprehend_entities"].schema == (
                 "CREATE TABLE [pages_comprehend_entities] (\n"
@@ -113,9 +147,9 @@ def test_entities(mocker, tmpdir, compound_primary_key):
                 ")"
             )
         else:
-            assert list(db["pages_comprehend_entities_done"].rows) == [
-                {"id": 1},
-                {"id": 2},
+            assert done_rows == [
+                {"id": 1, "language": "en"},
+                {"id": 2, "language": "en"},
             ]
             assert db["pages_comprehend_entities"].schema == (
                 "CREATE TABLE [pages_comprehend_entities] (\n"
@@ -128,7 +162,7 @@ def test_entities(mocker, tmpdir, compound_primary_key):
                 ")"
             )
         assert boto3.mock_calls == [
-            call("comprehend"),
+            call("comprehend", config=ANY),
             call().batch_detect_entities(
                 TextList=["John Bob", "Sandra X"], LanguageCode="en"
             ),
@@ -146,8 +180,8 @@ def test_entities(mocker, tmpdir, compound_primary_key):
         result = runner.invoke(cli, ["entities", db_path, "pages", "text"])
         assert result.exit_code == 0
 
+    # The client from the first run is reused
     assert boto3.mock_calls == [
-        call("comprehend"),
         call().batch_detect_entities(TextList=["Another Row"], LanguageCode="en"),
     ]
 
@@ -158,7 +192,6 @@ def test_entities(mocker, tmpdir, compound_primary_key):
         assert result.exit_code == 0
 
     assert boto3.mock_calls == [
-        call("comprehend"),
         call().batch_detect_entities(
             TextList=["John Bob", "Sandra X", "Another Row"], LanguageCode="en"
         ),
@@ -233,7 +266,2132 @@ def test_entities_errors(mocker, tmpdir):
         ("a < b", "a < b"),
         ("abc<em>", "abc"),
         ("<em>a < b</em>", "a < b"),
+        ("<p>a <b>b<i>c</i></b></p>", "a bc"),
+        ("AT&amp;T &#169;", "AT&amp;T &#169;"),
+        ("a<script>if (x < 1) { y = '<b>'; }</script> b", "a b"),
+        ("<style>p { color: red }</style>a<STYLE/>b", "ab"),
+        ("a<br/>b", "ab"),
+        ("<!DOCTYPE html>a<!-- <b>comment</b> -->b", "ab"),
+        ("<a title='x > y'>link</a>", "link"),
+        ("</>", ""),
+        # Tags that are formed by removing other tags are removed too
+        ("<<b>b>", ""),
+        ("a<<b>/b>b", "ab"),
+        ("<" * 5 + "a>" * 5 + "b", "b"),
+        ('<a title="<b>">a', "a"),
+        ("abc<em", "abc<em"),
+        # Malformed HTML, as found in scraped pages
+        ("<a href='it's'>x</a>", "x"),
+        ("<p class=a<b>x</p>", "x"),
+        ("<title>a<b</title>", "a"),
     ),
 )
 def test_strip_tags(input, expected):
     assert strip_tags(input) == expected
+
+
+def _fake_batch_detect_entities(TextList, LanguageCode):
+    return {
+        "ResultList": [
+            {
+                "Index": i,
+                "Entities": [
+                    {
+                        "Score": 0.9,
+                        "Type": "OTHER",
+                        "Text": text,
+                        "BeginOffset": 0,
+                        "EndOffset": len(text),
+                    }
+                ],
+            }
+            for i, text in enumerate(TextList)
+        ],
+        "ErrorList": [],
+    }
+
+
+@pytest.mark.parametrize("concurrency", (1, 3))
+def test_entities_concurrency(mocker, tmpdir, concurrency):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text", "--concurrency", str(concurrency)],
+    )
+    assert result.exit_code == 0
+    assert boto3.return_value.batch_detect_entities.call_count == 4
+    config = boto3.call_args[1]["config"]
+    assert config.max_pool_connections == (concurrency if concurrency > 1 else 10)
+    assert config.tcp_keepalive
+    assert config.retries == {"mode": "standard", "total_max_attempts": 2}
+    # Every row was written exactly once
+    assert [
+        (row["id"], row["name"])
+        for row in db.query(
+            "select pages_comprehend_entities.id, comprehend_entities.name "
+            "from pages_comprehend_entities join comprehend_entities "
+            "on pages_comprehend_entities.entity = comprehend_entities.id "
+            "order by pages_comprehend_entities.id"
+        )
+    ] == [(i, "Text {}".format(i)) for i in range(1, 101)]
+    assert db["pages_comprehend_entities_done"].count == 100
+
+
+def test_entities_concurrency_error_leaves_done_consistent(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    calls = []
+
+    def batch_detect_entities(TextList, LanguageCode):
+        calls.append(TextList)
+        if TextList[0] == "Text 26":
+            raise Exception("Network error")
+        return _fake_batch_detect_entities(TextList, LanguageCode)
+
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--concurrency", "2"]
+    )
+    assert result.exit_code == 1
+    # Only the batch before the failed one was written and marked as done
+    done_ids = [row["id"] for row in db["pages_comprehend_entities_done"].rows]
+    assert done_ids == list(range(1, 26))
+    assert db["pages_comprehend_entities"].count == 25
+
+
+def test_entity_cache(tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    cache = EntityCache(db)
+    ids = cache.lookup_many(
+        [("PERSON", "Bob"), ("PERSON", "Bob"), ("PLACE", "Paris"), ("PERSON", "Sue")]
+    )
+    assert ids == {("PERSON", "Bob"): 1, ("PLACE", "Paris"): 2, ("PERSON", "Sue"): 3}
+    assert (cache.hits, cache.misses) == (1, 3)
+    assert list(db["comprehend_entity_types"].rows) == [
+        {"id": 1, "value": "PERSON"},
+        {"id": 2, "value": "PLACE"},
+    ]
+    # A new cache is preloaded from the database, bounded to max_size
+    cache2 = EntityCache(db, max_size=2)
+    assert len(cache2.entities) == 2
+    assert cache2.lookup_many([("PERSON", "Bob"), ("PERSON", "Sue")]) == {
+        ("PERSON", "Bob"): 1,
+        ("PERSON", "Sue"): 3,
+    }
+    assert cache2.lookup_many([("PLACE", "Paris"), ("PLACE", "London")]) == {
+        ("PLACE", "Paris"): 2,
+        ("PLACE", "London"): 4,
+    }
+    assert len(cache2.entities) == 2
+    assert db["comprehend_entities"].count == 4
+
+
+def test_entities_stats(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i % 3)} for i in range(1, 31)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--stats"])
+    assert result.exit_code == 0
+    assert "Entity cache: 27 hits, 3 misses" in result.output
+
+
+@pytest.mark.parametrize(
+    "commit_every,expected_commits", (("1", 4), ("3", 2), ("10", 1), ("60s", 1))
+)
+def test_entities_commit_every(mocker, tmpdir, commit_every, expected_commits):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli,
+        [
+            "entities",
+            db_path,
+            "pages",
+            "text",
+            "--commit-every",
+            commit_every,
+            "--wal",
+            "--stats",
+        ],
+    )
+    assert result.exit_code == 0
+    assert sqlite_utils.Database(db_path).journal_mode == "wal"
+    assert "Transactions committed: {}".format(expected_commits) in result.output
+    # 100 mentions and 100 _done rows
+    assert "Rows written to the database: 200," in result.output
+    assert db["pages_comprehend_entities"].count == 100
+    assert db["pages_comprehend_entities_done"].count == 100
+
+
+def test_entities_commit_every_invalid(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "a"}, pk="id")
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--commit-every", "soon"]
+    )
+    assert result.exit_code == 2
+    assert "'soon' should be e.g. 10 or 30s" in result.output
+
+
+def test_entities_failed_write_rolls_back_chunk(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    lookup_many = EntityCache.lookup_many
+
+    def failing_lookup_many(self, pairs):
+        ids = lookup_many(self, pairs)
+        if ("OTHER", "Text 51") in ids:
+            raise KeyboardInterrupt
+        return ids
+
+    mocker.patch.object(EntityCache, "lookup_many", failing_lookup_many)
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--commit-every", "10"]
+    )
+    assert result.exit_code == 1
+    # The first two chunks were committed, the third rolled back in full
+    assert db["pages_comprehend_entities_done"].count == 50
+    assert db["pages_comprehend_entities"].count == 50
+    assert db["comprehend_entities"].count == 50
+
+
+def test_buffered_writer():
+    db = sqlite_utils.Database(memory=True)
+    db.execute("create table output (id integer, value text)")
+    db.execute("create table done (id integer primary key)")
+    now = [0.0]
+    writer = BufferedWriter(db, max_rows=6, max_seconds=5, clock=lambda: now[0])
+    insert_output = "insert into output values (?, ?)"
+    insert_done = "insert into done values (?)"
+    writer.add([(insert_output, [(1, "a"), (1, "b")]), (insert_done, [(1,)])])
+    writer.add([(insert_output, []), (insert_done, [(2,)])])
+    assert writer.buffered == 4
+    assert not writer.due
+    assert db["output"].count == 0
+    now[0] = 5.0
+    assert writer.due
+    writer.add([(insert_output, [(3, "c")]), (insert_done, [(3,)])])
+    assert writer.buffered == 6
+    writer.flush()
+    assert not writer.due
+    assert writer.written == 6
+    assert db.execute("select id, value from output").fetchall() == [
+        (1, "a"),
+        (1, "b"),
+        (3, "c"),
+    ]
+    assert [row[0] for row in db.execute("select id from done")] == [1, 2, 3]
+
+
+def test_entities_failed_flush_rolls_back_transaction(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    flush = BufferedWriter.flush
+
+    def failing_flush(self):
+        flush(self)
+        raise KeyboardInterrupt
+
+    mocker.patch.object(BufferedWriter, "flush", failing_flush)
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--commit-every", "10"]
+    )
+    assert result.exit_code == 1
+    # The entities created for the buffered rows were rolled back with them
+    assert db["pages_comprehend_entities_done"].count == 0
+    assert db["pages_comprehend_entities"].count == 0
+    assert db["comprehend_entities"].count == 0
+
+
+def test_entities_response_cache(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    # 40 rows but only 30 distinct texts
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i % 30)} for i in range(1, 41)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--cache", "--stats"]
+    )
+    assert result.exit_code == 0
+    # Each distinct text was sent exactly once, in full batches of misses
+    sent = [c[1]["TextList"] for c in batch_detect_entities.call_args_list]
+    assert [len(texts) for texts in sent] == [25, 5]
+    assert sorted(text for texts in sent for text in texts) == sorted(
+        "Text {}".format(i) for i in range(30)
+    )
+    assert db["pages_comprehend_entities"].count == 40
+    assert db["pages_comprehend_entities_done"].count == 40
+    assert db["comprehend_cache"].count == 30
+    assert (
+        "Response cache: 10 hits, 30 misses (25.0% hit rate), 30 cached responses"
+        in result.output
+    )
+
+    # With --reset everything is served from the cache
+    batch_detect_entities.reset_mock()
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--cache", "--reset", "--stats"]
+    )
+    assert result.exit_code == 0
+    assert batch_detect_entities.call_count == 0
+    assert "Response cache: 40 hits, 0 misses (100.0% hit rate)" in result.output
+    assert [
+        (row["id"], row["name"])
+        for row in db.query(
+            "select pages.id, comprehend_entities.name from pages "
+            "join pages_comprehend_entities on pages.id = pages_comprehend_entities.id "
+            "join comprehend_entities on pages_comprehend_entities.entity = comprehend_entities.id "
+            "order by pages.id"
+        )
+    ] == [(i, "Text {}".format(i % 30)) for i in range(1, 41)]
+
+
+@pytest.mark.parametrize("compound_primary_key", (True, False))
+@pytest.mark.parametrize("no_count", (True, False))
+def test_entities_pending_rows_paginated(
+    mocker, tmpdir, compound_primary_key, no_count
+):
+    mocker.patch("sqlite_comprehend.pipeline.PAGE_SIZE", 10)
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)],
+        pk=("id", "text") if compound_primary_key else "id",
+    )
+    # Some rows have already been processed
+    db["pages_comprehend_entities_done"].insert_all(
+        (
+            [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101, 3)]
+            if compound_primary_key
+            else [{"id": i} for i in range(1, 101, 3)]
+        ),
+        pk=("id", "text") if compound_primary_key else "id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    args = [
+        "entities",
+        db_path,
+        "pages",
+        "text",
+        "--where",
+        "id <= :max",
+        "-p",
+        "max",
+        "90",
+    ]
+    if no_count:
+        args.append("--no-count")
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    sent = [
+        text for c in batch_detect_entities.call_args_list for text in c[1]["TextList"]
+    ]
+    # Every pending row that matched the --where was sent once, in primary key order
+    assert sent == ["Text {}".format(i) for i in range(1, 91) if (i - 1) % 3 != 0]
+    assert db["pages_comprehend_entities_done"].count == 94
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+        self.slept = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept.append(seconds)
+        self.now += seconds
+
+
+def test_adaptive_rate_limiter():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(4, clock=clock, sleep=clock.sleep)
+    # Starts with a full bucket of 4 tokens
+    for _ in range(4):
+        limiter.acquire()
+    assert clock.slept == []
+    limiter.acquire()
+    assert clock.slept == [0.25]
+    # Throttling halves the rate and empties the bucket
+    limiter.throttled()
+    limiter.throttled()
+    assert limiter.rate == 1
+    limiter.acquire()
+    assert clock.slept == [0.25, 1.0]
+    # Each success ramps the rate back up towards the maximum
+    for _ in range(100):
+        limiter.succeeded()
+    assert limiter.rate == 4
+    assert limiter.throttles == 2
+
+
+def _throttling_error():
+    return ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+        "BatchDetectEntities",
+    )
+
+
+def test_call_with_retries():
+    clock = FakeClock()
+    limiter = AdaptiveRateLimiter(10, clock=clock, sleep=clock.sleep)
+    responses = [_throttling_error(), _throttling_error(), "ok"]
+
+    def fn():
+        response = responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    metrics = Metrics()
+    assert call_with_retries(fn, limiter, metrics=metrics) == "ok"
+    assert limiter.throttles == 2
+    assert metrics.counters["throttled"] == 2
+    # Gives up after max_retries
+    responses = [_throttling_error()] * 3
+    with pytest.raises(ClientError):
+        call_with_retries(fn, limiter, max_retries=2, metrics=metrics)
+    # Other errors are raised immediately
+    responses = [
+        ClientError({"Error": {"Code": "AccessDenied"}}, "BatchDetectEntities")
+    ]
+    with pytest.raises(ClientError):
+        call_with_retries(fn, limiter, metrics=metrics)
+    assert limiter.throttles == 5
+    # The final throttled call is not retried
+    assert metrics.counters["throttled"] == 4
+
+
+def test_entities_retries(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 31)], pk="id"
+    )
+    calls = []
+
+    def batch_detect_entities(TextList, LanguageCode):
+        calls.append(TextList)
+        if len(calls) == 1:
+            raise _throttling_error()
+        response = _fake_batch_detect_entities(TextList, LanguageCode)
+        failed = [
+            i
+            for i, text in enumerate(TextList)
+            # Text 3 fails twice, Text 5 always fails, Text 7 is invalid
+            if (text == "Text 3" and len(calls) <= 3) or text in ("Text 5", "Text 7")
+        ]
+        response["ResultList"] = [
+            result for result in response["ResultList"] if result["Index"] not in failed
+        ]
+        response["ErrorList"] = [
+            {
+                "Index": i,
+                "ErrorCode": (
+                    "InvalidRequestException"
+                    if TextList[i] == "Text 7"
+                    else "INTERNAL_SERVER_ERROR"
+                ),
+                "ErrorMessage": "Failed",
+            }
+            for i in failed
+        ]
+        return response
+
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = batch_detect_entities
+    result = CliRunner().invoke(
+        cli,
+        [
+            "entities",
+            db_path,
+            "pages",
+            "text",
+            "--max-retries",
+            "2",
+            "--rate",
+            "1000",
+            "--stats",
+        ],
+    )
+    assert result.exit_code == 0
+    # Throttled call was repeated, failed documents were packed into the
+    # next batch along with the rows that had not been sent yet
+    assert calls[0] == calls[1]
+    assert len(calls[1]) == 25
+    assert calls[2] == ["Text 3", "Text 5"] + [
+        "Text {}".format(i) for i in range(26, 31)
+    ]
+    assert calls[3] == ["Text 3", "Text 5"]
+    assert len(calls) == 4
+    assert "retries: 4, throttled: 1" in result.output
+    assert "Throttled: 1" in result.output
+    assert "rows with errors: 2" in result.output
+    # Text 3 eventually succeeded
+    assert db["pages_comprehend_entities"].count == 28
+    assert list(db["comprehend_errors"].rows) == [
+        {
+            "output_table": "pages_comprehend_entities",
+            "row_pks": '{"id": 7}',
+            "error_code": "InvalidRequestException",
+            "error_message": "Failed",
+            "attempts": 1,
+        },
+        {
+            "output_table": "pages_comprehend_entities",
+            "row_pks": '{"id": 5}',
+            "error_code": "INTERNAL_SERVER_ERROR",
+            "error_message": "Failed",
+            "attempts": 3,
+        },
+    ]
+    # Rows with errors are not processed again unless --retry-errors
+    assert db["pages_comprehend_entities_done"].count == 30
+    boto3.return_value.batch_detect_entities.reset_mock()
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text"])
+    assert result.exit_code == 0
+    assert boto3.return_value.batch_detect_entities.call_count == 0
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--retry-errors"]
+    )
+    assert result.exit_code == 0
+    assert boto3.return_value.batch_detect_entities.call_args[1]["TextList"] == [
+        "Text 5",
+        "Text 7",
+    ]
+    assert db["pages_comprehend_entities"].count == 30
+    assert db["comprehend_errors"].count == 0
+
+
+def test_entities_retry_errors_after_reset(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all([{"id": 1, "text": "Text 1"}], pk="id")
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.return_value = {
+        "ResultList": [],
+        "ErrorList": [
+            {"Index": 0, "ErrorCode": "InvalidRequestException", "ErrorMessage": "x"}
+        ],
+    }
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text"])
+    assert result.exit_code == 0
+    assert db["comprehend_errors"].count == 1
+    # --reset clears the errors for the output table
+    boto3.return_value.batch_detect_entities.return_value = None
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--reset"])
+    assert result.exit_code == 0
+    assert db["comprehend_errors"].count == 0
+    assert db["pages_comprehend_entities"].count == 1
+    boto3.return_value.batch_detect_entities.reset_mock()
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--retry-errors"]
+    )
+    assert result.exit_code == 0
+    assert boto3.return_value.batch_detect_entities.call_count == 0
+    assert db["pages_comprehend_entities"].count == 1
+    # A row that succeeds no longer has an error, and retrying a row
+    # replaces its earlier output rather than adding to it
+    db["comprehend_errors"].insert(
+        {
+            "output_table": "pages_comprehend_entities",
+            "row_pks": '{"id": 1}',
+            "error_code": "InvalidRequestException",
+            "error_message": "x",
+            "attempts": 1,
+        }
+    )
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--retry-errors"]
+    )
+    assert result.exit_code == 0
+    assert boto3.return_value.batch_detect_entities.call_count == 1
+    assert db["pages_comprehend_entities"].count == 1
+    assert db["comprehend_errors"].count == 0
+
+
+def test_entities_incremental_clears_errors(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all([{"id": 1, "text": "Text 1"}], pk="id")
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.return_value = {
+        "ResultList": [],
+        "ErrorList": [
+            {"Index": 0, "ErrorCode": "InvalidRequestException", "ErrorMessage": "x"}
+        ],
+    }
+    args = ["entities", db_path, "pages", "text", "--incremental"]
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert db["comprehend_errors"].count == 1
+    # The row changes and succeeds, so its error is removed
+    db["pages"].update(1, {"text": "Text 2"})
+    boto3.return_value.batch_detect_entities.return_value = None
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(cli, args)
+    assert result.exit_code == 0
+    assert db["comprehend_errors"].count == 0
+    assert db["pages_comprehend_entities"].count == 1
+
+
+def test_entities_bulk(mocker, tmpdir):
+    mocker.patch("sqlite_comprehend.bulk.LINES_PER_FILE", 20)
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text\n{}".format(i)} for i in range(1, 51)], pk="id"
+    )
+    uploads = {}
+    s3 = mocker.Mock()
+    s3.upload_fileobj.side_effect = lambda fp, bucket, key: uploads.update(
+        {(bucket, key): fp.read().decode("utf-8")}
+    )
+
+    def get_object(Bucket, Key):
+        assert (Bucket, Key) == ("bucket", "prefix/out/output.tar.gz")
+        # Build the job output from what was uploaded, failing line 3 of part 1
+        lines = []
+        for (_, key), content in sorted(uploads.items()):
+            name = key.rsplit("/", 1)[-1]
+            for i, text in enumerate(content.splitlines()):
+                if name == "part-00001.txt" and i == 3:
+                    lines.append(
+                        {
+                            "File": name,
+                            "Line": i,
+                            "ErrorCode": "InvalidRequestException",
+                            "ErrorMessage": "Bad",
+                        }
+                    )
+                    continue
+                lines.append(
+                    {
+                        "File": name,
+                        "Line": i,
+                        "Entities": [
+                            {
+                                "Score": 0.9,
+                                "Type": "OTHER",
+                                "Text": text,
+                                "BeginOffset": 0,
+                                "EndOffset": len(text),
+                            }
+                        ],
+                    }
+                )
+        data = "\n".join(json.dumps(line) for line in reversed(lines)).encode("utf-8")
+        buffer = io.BytesIO()
+        with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+            info = tarfile.TarInfo("output")
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+        buffer.seek(0)
+        return {"Body": buffer}
+
+    s3.get_object.side_effect = get_object
+    comprehend = mocker.Mock()
+    comprehend.start_entities_detection_job.return_value = {"JobId": "job-1"}
+    comprehend.describe_entities_detection_job.side_effect = [
+        {"EntitiesDetectionJobProperties": {"JobStatus": "IN_PROGRESS"}},
+        {
+            "EntitiesDetectionJobProperties": {
+                "JobStatus": "COMPLETED",
+                "OutputDataConfig": {"S3Uri": "s3://bucket/prefix/out/output.tar.gz"},
+            }
+        },
+    ]
+    boto3 = mocker.patch("boto3.client")
+    boto3.side_effect = lambda service, **kwargs: {
+        "s3": s3,
+        "comprehend": comprehend,
+    }[service]
+    result = CliRunner().invoke(
+        cli,
+        [
+            "entities",
+            db_path,
+            "pages",
+            "text",
+            "--bulk",
+            "--s3-uri",
+            "s3://bucket/prefix",
+            "--role-arn",
+            "arn:aws:iam::123:role/comprehend",
+            "--poll-interval",
+            "0",
+            "--endpoint-url",
+            "http://localhost:5000",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert "Started entities detection job job-1 for 50 documents" in result.output
+    # Both clients use the custom endpoint
+    assert boto3.call_args_list == [
+        call("comprehend", config=ANY, endpoint_url="http://localhost:5000"),
+        call("s3", config=ANY, endpoint_url="http://localhost:5000"),
+    ]
+    keys = [key for _, key in sorted(uploads)]
+    assert len(keys) == 3
+    for i, key in enumerate(keys):
+        assert re.match(
+            r"^prefix/pages_comprehend_entities-\d+/input/part-0000{}.txt$".format(i),
+            key,
+        )
+    # Newlines were replaced, one document per line
+    assert sorted(uploads.items())[0][1].splitlines()[:2] == ["Text 1", "Text 2"]
+    kwargs = comprehend.start_entities_detection_job.call_args[1]
+    assert kwargs["InputDataConfig"]["InputFormat"] == "ONE_DOC_PER_LINE"
+    assert kwargs["DataAccessRoleArn"] == "arn:aws:iam::123:role/comprehend"
+    assert [
+        (row["id"], row["name"])
+        for row in db.query(
+            "select pages_comprehend_entities.id, comprehend_entities.name "
+            "from pages_comprehend_entities join comprehend_entities "
+            "on pages_comprehend_entities.entity = comprehend_entities.id "
+            "order by pages_comprehend_entities.id"
+        )
+    ] == [(i, "Text {}".format(i)) for i in range(1, 51) if i != 24]
+    assert db["pages_comprehend_entities_done"].count == 50
+    assert [row["row_pks"] for row in db["comprehend_errors"].rows] == ['{"id": 24}']
+
+
+def test_entities_bulk_requires_s3_uri_and_role(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "a"}, pk="id")
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--bulk"])
+    assert result.exit_code == 1
+    assert "--bulk requires --s3-uri and --role-arn" in result.output
+
+
+def test_analyze(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "<b>Text {}</b>".format(i)} for i in range(1, 31)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    # Entities have already been found for the first 25 rows
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text", "--strip-tags", "--where", "id <= 25"],
+    )
+    assert result.exit_code == 0
+    client.batch_detect_entities.reset_mock()
+
+    client.batch_detect_key_phrases.side_effect = lambda TextList, LanguageCode: {
+        "ResultList": [
+            {
+                "Index": i,
+                "KeyPhrases": [
+                    {"Score": 0.5, "Text": text, "BeginOffset": 0, "EndOffset": 4}
+                ],
+            }
+            for i, text in enumerate(TextList)
+        ],
+        "ErrorList": [],
+    }
+    client.batch_detect_sentiment.side_effect = lambda TextList, LanguageCode: {
+        "ResultList": [
+            {
+                "Index": i,
+                "Sentiment": "NEUTRAL",
+                "SentimentScore": {
+                    "Positive": 0.1,
+                    "Negative": 0.1,
+                    "Neutral": 0.7,
+                    "Mixed": 0.1,
+                },
+            }
+            for i, text in enumerate(TextList)
+        ],
+        "ErrorList": [],
+    }
+
+    def detect_pii_entities(Text, LanguageCode):
+        if Text == "Text 2":
+            raise ClientError(
+                {"Error": {"Code": "TextSizeLimitExceededException", "Message": "Big"}},
+                "DetectPiiEntities",
+            )
+        return {
+            "Entities": [
+                {"Score": 0.99, "Type": "NAME", "BeginOffset": 0, "EndOffset": 4}
+            ]
+        }
+
+    client.detect_pii_entities.side_effect = detect_pii_entities
+    result = CliRunner().invoke(
+        cli,
+        [
+            "analyze",
+            db_path,
+            "pages",
+            "text",
+            "--strip-tags",
+            "--entities",
+            "--key-phrases",
+            "--sentiment",
+            "--pii",
+            "--concurrency",
+            "2",
+            "--rate",
+            "1000",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    # Each analysis only processed the rows it had not seen before
+    assert [c[1]["TextList"] for c in client.batch_detect_entities.call_args_list] == [
+        ["Text {}".format(i) for i in range(26, 31)]
+    ]
+    assert [
+        c[1]["TextList"] for c in client.batch_detect_key_phrases.call_args_list
+    ] == [
+        ["Text {}".format(i) for i in range(1, 26)],
+        ["Text {}".format(i) for i in range(26, 31)],
+    ]
+    assert client.batch_detect_sentiment.call_count == 2
+    assert client.detect_pii_entities.call_count == 30
+    # The client's connection pool covers every analysis
+    assert boto3.call_args[1]["config"].max_pool_connections == 8
+    assert db["pages_comprehend_entities"].count == 30
+    assert db["pages_comprehend_key_phrases"].count == 30
+    assert db["pages_comprehend_sentiment"].count == 30
+    assert db["pages_comprehend_pii_entities"].count == 29
+    for analysis in ("entities", "key_phrases", "sentiment", "pii_entities"):
+        assert db["pages_comprehend_{}_done".format(analysis)].count == 30
+    assert list(db["pages_comprehend_sentiment"].rows)[0] == {
+        "id": 1,
+        "sentiment": "NEUTRAL",
+        "positive": 0.1,
+        "negative": 0.1,
+        "neutral": 0.7,
+        "mixed": 0.1,
+    }
+    assert list(db["pages_comprehend_key_phrases"].rows)[0] == {
+        "id": 1,
+        "score": 0.5,
+        "text": "Text 1",
+        "begin_offset": 0,
+        "end_offset": 4,
+    }
+    assert list(db["pages_comprehend_pii_entities"].rows)[0] == {
+        "id": 1,
+        "type": "NAME",
+        "score": 0.99,
+        "begin_offset": 0,
+        "end_offset": 4,
+    }
+    assert list(db["comprehend_errors"].rows) == [
+        {
+            "output_table": "pages_comprehend_pii_entities",
+            "row_pks": '{"id": 2}',
+            "error_code": "TextSizeLimitExceededException",
+            "error_message": "Big",
+            "attempts": 1,
+        }
+    ]
+    # Running again does nothing
+    client.reset_mock()
+    result = CliRunner().invoke(
+        cli, ["analyze", db_path, "pages", "text", "--key-phrases", "--sentiment"]
+    )
+    assert result.exit_code == 0
+    assert client.batch_detect_key_phrases.call_count == 0
+    assert client.batch_detect_sentiment.call_count == 0
+
+
+def test_analyze_requires_an_analysis(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "a"}, pk="id")
+    result = CliRunner().invoke(cli, ["analyze", db_path, "pages", "text"])
+    assert result.exit_code == 1
+    assert "Specify at least one of --entities" in result.output
+
+
+def test_segment_text():
+    text = "One two. Three four five. " * 20 + "é" * 30
+    segments = list(segment_text(text, max_bytes=50))
+    for offset, segment in segments:
+        assert len(segment.encode("utf-8")) <= 50
+        assert text[offset : offset + len(segment)] == segment
+    # Segments end at sentence boundaries where possible
+    assert segments[0] == (0, "One two. Three four five. One two.")
+    assert segments[1] == (35, "Three four five. One two. Three four five.")
+    # Long runs without whitespace are split without breaking characters
+    assert segments[-2:] == [(503, "Three four five. " + "é" * 16), (536, "é" * 14)]
+    # Only whitespace is dropped
+    assert "".join(segment for _, segment in segments).replace(" ", "") == (
+        text.replace(" ", "")
+    )
+    assert list(segment_text("  short  ")) == [(2, "short  ")]
+    assert list(segment_text("   ")) == []
+
+
+def test_entities_segment(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    long_text = " ".join("Sentence number {}.".format(i) for i in range(600))
+    assert len(long_text) > 10000
+    db["pages"].insert_all(
+        [
+            {"id": 1, "text": long_text},
+            {"id": 2, "text": "Short text"},
+            {"id": 3, "text": long_text + " Broken."},
+        ],
+        pk="id",
+    )
+
+    def batch_detect_entities(TextList, LanguageCode):
+        response = _fake_batch_detect_entities(TextList, LanguageCode)
+        broken = [i for i, text in enumerate(TextList) if text.endswith("Broken.")]
+        response["ResultList"] = [
+            result for result in response["ResultList"] if result["Index"] not in broken
+        ]
+        response["ErrorList"] = [
+            {"Index": i, "ErrorCode": "InvalidRequestException", "ErrorMessage": "Bad"}
+            for i in broken
+        ]
+        return response
+
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_entities.side_effect = batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--segment", "--rate", "1000"]
+    )
+    assert result.exit_code == 0, result.output
+    texts = [
+        text
+        for c in client.batch_detect_entities.call_args_list
+        for text in c[1]["TextList"]
+    ]
+    assert all(len(text.encode("utf-8")) <= 5000 for text in texts)
+    # Segments from different rows are packed into the same batches
+    assert [
+        len(c[1]["TextList"]) for c in client.batch_detect_entities.call_args_list
+    ] == [len(texts)]
+    assert "Short text" in texts
+    # Offsets point into the whole of the original text
+    rows = list(db.query(ENTITIES_SQL))
+    assert {row["page_id"] for row in rows} == {1, 2}
+    for row in rows:
+        text = long_text if row["page_id"] == 1 else "Short text"
+        assert text[row["begin_offset"] : row["end_offset"]] == row["entity_name"]
+    assert max(row["end_offset"] for row in rows) == len(long_text)
+    # A row with a failed segment is done, with no partial results
+    assert db["pages_comprehend_entities_done"].count == 3
+    assert [row["row_pks"] for row in db["comprehend_errors"].rows] == ['{"id": 3}']
+
+
+def test_entities_segment_not_with_bulk(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "A"}, pk="id")
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text", "--segment", "--bulk"]
+        + ["--s3-uri", "s3://bucket/prefix", "--role-arn", "arn"],
+    )
+    assert result.exit_code == 1
+    assert "--segment cannot be used with --bulk" in result.output
+
+
+def test_entities_metrics(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    metrics_path = str(tmpdir / "metrics.jsonl")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 31)]
+        + [{"id": 31, "text": "x" * 450}],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text", "--stats"]
+        + ["--metrics-file", metrics_path],
+    )
+    assert result.exit_code == 0, result.output
+    bytes_sent = sum(len("Text {}".format(i)) for i in range(1, 31)) + 450
+    # Each short text is billed as the minimum of 3 units, 450 characters as 5
+    assert (
+        "Rows: 31, bytes sent: {}, billable units: 95, mentions: 31, "
+        "errors: 0, retries: 0, throttled: 0".format(bytes_sent)
+    ) in result.output
+    assert re.search(r"^api +\d+\.\d+ +\d+\.\d%$", result.output, re.MULTILINE)
+    lines = [json.loads(line) for line in open(metrics_path)]
+    assert [line["rows"] for line in lines] == [25, 31]
+    assert [line["mentions"] for line in lines] == [25, 31]
+    assert lines[-1]["throttled"] == 0
+    assert lines[-1]["analysis"] == "entities"
+    assert set(lines[-1]["seconds"]) == {
+        "query",
+        "prepare",
+        "cache",
+        "api",
+        "lookup",
+        "write",
+    }
+
+
+def test_entities_prepare_workers(mocker, tmpdir):
+    rows = [
+        {
+            "id": i,
+            "text": "<p>Paragraph <b>{}</b></p><script>x()</script>".format(i)
+            + " More text." * (i * 40),
+        }
+        for i in range(1, 61)
+    ]
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    results = []
+    for extra in ([], ["--prepare-workers", "2"]):
+        db_path = str(tmpdir / "data-{}.db".format(len(extra)))
+        db = sqlite_utils.Database(db_path)
+        db["pages"].insert_all(rows, pk="id")
+        client.batch_detect_entities.reset_mock()
+        result = CliRunner().invoke(
+            cli,
+            ["entities", db_path, "pages", "text", "--strip-tags", "--segment"]
+            + ["--rate", "1000"]
+            + extra,
+        )
+        assert result.exit_code == 0, result.output
+        results.append(
+            (
+                [c[1]["TextList"] for c in client.batch_detect_entities.call_args_list],
+                list(db.query(ENTITIES_SQL + " order by page_id, begin_offset")),
+            )
+        )
+    assert results[0] == results[1]
+    assert len(results[0][1]) > 60
+
+
+def test_entities_incremental(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 41)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    args = ["entities", db_path, "pages", "text"]
+    assert CliRunner().invoke(cli, args).exit_code == 0
+    # A done table from before fingerprints were recorded
+    db.execute("update pages_comprehend_entities_done set fingerprint = null")
+    db.conn.commit()
+    assert CliRunner().invoke(cli, args + ["--incremental"]).exit_code == 0
+    # Assumes nothing had changed, no rows are processed
+    assert batch_detect_entities.call_count == 2
+    assert db.execute(
+        "select count(*) from pages_comprehend_entities_done where fingerprint is null"
+    ).fetchone() == (0,)
+    # Change two rows and add a new one
+    db["pages"].update(3, {"text": "Changed 3"})
+    db["pages"].update(30, {"text": "Changed 30"})
+    db["pages"].insert({"id": 41, "text": "Text 41"})
+    batch_detect_entities.reset_mock()
+    # Without --incremental only the new row is processed
+    result = CliRunner().invoke(cli, args + ["--where", "id > 40"])
+    assert result.exit_code == 0
+    assert batch_detect_entities.call_args[1]["TextList"] == ["Text 41"]
+    batch_detect_entities.reset_mock()
+    result = CliRunner().invoke(cli, args + ["--incremental"])
+    assert result.exit_code == 0, result.output
+    assert [c[1]["TextList"] for c in batch_detect_entities.call_args_list] == [
+        ["Changed 3", "Changed 30"]
+    ]
+    assert [
+        (row["page_id"], row["entity_name"])
+        for row in db.query(ENTITIES_SQL + " where page_id in (3, 30, 41)")
+    ] == [(3, "Changed 3"), (30, "Changed 30"), (41, "Text 41")]
+    assert db["pages_comprehend_entities"].count == 41
+    assert db["pages_comprehend_entities_done"].count == 41
+    # Results for different settings have different fingerprints
+    batch_detect_entities.reset_mock()
+    result = CliRunner().invoke(cli, args + ["--incremental", "--strip-tags"])
+    assert result.exit_code == 0
+    assert batch_detect_entities.call_count == 2
+    assert db["pages_comprehend_entities"].count == 41
+
+
+def test_entity_extractor_documents(mocker):
+    client = mocker.Mock()
+
+    def batch_detect_entities(TextList, LanguageCode):
+        response = _fake_batch_detect_entities(TextList, LanguageCode)
+        response["ResultList"] = [r for r in response["ResultList"] if r["Index"] != 1]
+        response["ErrorList"] = [
+            {"Index": 1, "ErrorCode": "InvalidRequestException", "ErrorMessage": "Bad"}
+        ]
+        return response
+
+    client.batch_detect_entities.side_effect = batch_detect_entities
+    extractor = EntityExtractor(client, rate=1000)
+    results = list(
+        extractor.extract(("doc-{}".format(i), "Text {}".format(i)) for i in range(30))
+    )
+    assert [result.key for result in results] == ["doc-{}".format(i) for i in range(30)]
+    assert results[0] == Result(
+        "entities",
+        "doc-0",
+        {
+            "Entities": [
+                {
+                    "Score": 0.9,
+                    "Type": "OTHER",
+                    "Text": "Text 0",
+                    "BeginOffset": 0,
+                    "EndOffset": 6,
+                }
+            ]
+        },
+        None,
+    )
+    assert [result.key for result in results if result.error] == ["doc-1", "doc-26"]
+    assert results[1].error["ErrorCode"] == "InvalidRequestException"
+    assert client.batch_detect_entities.call_count == 2
+    # Results are filtered in the same way as the output tables
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    for options in ({"min_score": 0.95}, {"types": ["PERSON"]}):
+        extractor = EntityExtractor(client, rate=1000, **options)
+        results = list(extractor.extract([("doc", "Text")]))
+        assert results == [Result("entities", "doc", {"Entities": []}, None)]
+    extractor = EntityExtractor(client, rate=1000, min_score=0.5, types=["OTHER"])
+    assert len(list(extractor.extract([("doc", "Text")]))[0].result["Entities"]) == 1
+
+
+def test_entity_extractor_tables(mocker, tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    for table in ("pages", "posts"):
+        db[table].insert_all(
+            [{"id": i, "text": "Text {}".format(i)} for i in range(1, 31)], pk="id"
+        )
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    extractor = EntityExtractor(client, rate=1000)
+    for table in ("pages", "posts"):
+        results = extractor.extract_table(db, table, ["text"])
+        first = next(results)
+        assert first.key == {"id": 1}
+        assert first.result["Entities"][0]["Text"] == "Text 1"
+        # Results are yielded as each batch is written
+        assert db["{}_comprehend_entities".format(table)].count == 25
+        assert len(list(results)) == 29
+        assert db["{}_comprehend_entities_done".format(table)].count == 30
+    # The two tables share one entity cache
+    assert list(extractor.entity_caches.values())[0].hits == 30
+    assert list(db.query(ENTITIES_SQL.replace("pages", "posts")))[0] == {
+        "page_id": 1,
+        "score": 0.9,
+        "begin_offset": 0,
+        "end_offset": 6,
+        "entity_name": "Text 1",
+        "entity_type": "OTHER",
+    }
+    # Nothing is left to process
+    assert list(extractor.extract_table(db, "pages", ["text"])) == []
+
+
+def test_entity_extractor_tables_yields_written_results(mocker, tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 61)], pk="id"
+    )
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    # Nothing is committed until the end, so rows are only written when the
+    # buffered writer is flushed
+    extractor = EntityExtractor(client, rate=1000, commit_every=(100, "chunks"))
+    seen = 0
+    for result in extractor.extract_table(db, "pages", ["text"]):
+        seen += 1
+        assert db.execute(
+            "select count(*) from pages_comprehend_entities where id = ?",
+            [result.key["id"]],
+        ).fetchone() == (1,)
+        assert db.execute(
+            "select count(*) from pages_comprehend_entities_done where id = ?",
+            [result.key["id"]],
+        ).fetchone() == (1,)
+    assert seen == 60
+
+
+def test_entities_shard(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    shards = []
+    for shard in ("1/3", "2/3", "3/3"):
+        batch_detect_entities.reset_mock()
+        result = CliRunner().invoke(
+            cli, ["entities", db_path, "pages", "text", "--shard", shard]
+        )
+        assert result.exit_code == 0, result.output
+        shards.append(
+            {
+                text
+                for c in batch_detect_entities.call_args_list
+                for text in c[1]["TextList"]
+            }
+        )
+    assert all(shards)
+    assert set.union(*shards) == {"Text {}".format(i) for i in range(1, 101)}
+    assert sum(len(shard) for shard in shards) == 100
+    assert db["pages_comprehend_entities_done"].count == 100
+
+
+@pytest.mark.parametrize("shard", ("0/3", "4/3", "1", "a/b"))
+def test_entities_shard_invalid(tmpdir, shard):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "A"}, pk="id")
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--shard", shard]
+    )
+    assert result.exit_code == 2
+    assert "Invalid value for '--shard'" in result.output
+
+
+def test_entity_extractor_shards_in_parallel(mocker, tmpdir):
+    # Each shard has its own connection, so they contend for the write lock
+    # in the same way as separate processes
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert_all(
+        [{"id": i, "text": "Text {} {}".format(i, i % 7)} for i in range(1, 201)],
+        pk="id",
+    )
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+
+    def run_shard(index):
+        db = sqlite_utils.Database(db_path)
+        db.execute("pragma busy_timeout = 10000")
+        extractor = EntityExtractor(client, rate=1000)
+        return list(extractor.extract_table(db, "pages", ["text"], shard=(index, 4)))
+
+    with concurrent.futures.ThreadPoolExecutor(4) as executor:
+        results = list(executor.map(run_shard, range(1, 5)))
+    keys = [result.key["id"] for shard in results for result in shard]
+    assert sorted(keys) == list(range(1, 201))
+    db = sqlite_utils.Database(db_path)
+    assert db["pages_comprehend_entities"].count == 200
+    assert db["pages_comprehend_entities_done"].count == 200
+    assert db["comprehend_entities"].count == 200
+
+
+def test_retry_locked():
+    calls = []
+    sleeps = []
+
+    def fn():
+        calls.append(1)
+        if len(calls) < 3:
+            raise sqlite3.OperationalError("database is locked")
+        return "ok"
+
+    assert retry_locked(fn, sleep=sleeps.append) == "ok"
+    assert sleeps == [0.1, 0.2]
+
+    def other():
+        raise sqlite3.OperationalError("no such table: foo")
+
+    with pytest.raises(sqlite3.OperationalError):
+        retry_locked(other, sleep=sleeps.append)
+    assert sleeps == [0.1, 0.2]
+
+
+def test_watch(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 4)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    sent = []
+
+    def sleep(seconds):
+        sent.append(
+            [
+                text
+                for c in batch_detect_entities.call_args_list
+                for text in c[1]["TextList"]
+            ]
+        )
+        batch_detect_entities.reset_mock()
+        other = sqlite_utils.Database(db_path)
+        if len(sent) == 1:
+            other["pages"].insert_all(
+                [{"id": i, "text": "Text {}".format(i)} for i in range(4, 6)]
+            )
+        elif len(sent) == 2:
+            # Only changes to the watched columns are queued
+            other["pages"].update(4, {"text": "Edited 4"})
+            other["pages"].add_column("other", str)
+            other["pages"].update(5, {"other": "Ignored"})
+        else:
+            raise KeyboardInterrupt
+
+    mocker.patch("time.sleep", side_effect=sleep)
+    result = CliRunner().invoke(
+        cli,
+        ["watch", db_path, "pages", "text", "--max-wait", "0", "--incremental"],
+    )
+    assert result.exit_code == 0, result.output
+    assert sent == [["Text 1", "Text 2", "Text 3"], ["Text 4", "Text 5"], ["Edited 4"]]
+    assert "Processed 2 rows" in result.output
+    assert db["pages_comprehend_entities_done"].count == 5
+    assert db["pages_comprehend_queue"].count == 0
+    assert [
+        row["name"]
+        for row in db.query(
+            "select name from pages_comprehend_entities join comprehend_entities "
+            "on entity = comprehend_entities.id where pages_comprehend_entities.id = 4"
+        )
+    ] == ["Edited 4"]
+
+    result = CliRunner().invoke(cli, ["unwatch", db_path, "pages"])
+    assert result.exit_code == 0
+    assert not db["pages_comprehend_queue"].exists()
+    assert db.triggers == []
+
+
+def test_watcher_max_wait(tmpdir, mocker):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].create({"id": int, "text": str}, pk="id")
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    pipeline = EntityExtractor(client, rate=1000).pipeline(db, "pages", ["text"])
+    watcher = Watcher(pipeline, max_wait=60)
+    watcher.install()
+    db["pages"].insert_all([{"id": i, "text": "Text"} for i in range(1, 4)])
+    # A partial batch waits for up to max_wait seconds
+    due = watcher.process()
+    assert time.time() + 55 < due < time.time() + 65
+    assert not client.batch_detect_entities.called
+    # A full batch is sent straight away
+    db["pages"].insert_all([{"id": i, "text": "Text"} for i in range(4, 26)])
+    assert watcher.process() is None
+    assert client.batch_detect_entities.call_count == 1
+    assert db["pages_comprehend_entities_done"].count == 25
+    assert db["pages_comprehend_queue"].count == 0
+
+
+def test_watcher_updates_need_incremental(tmpdir, mocker):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    db["pages"].insert_all([{"id": 1, "text": "Text 1"}], pk="id")
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    extractor = EntityExtractor(client, rate=1000)
+    pipeline = extractor.pipeline(db, "pages", ["text"])
+    pipeline.run(pipeline.pending_rows())
+    Watcher(
+        extractor.pipeline(db, "pages", ["text"], incremental=True), max_wait=0
+    ).install()
+    assert len(db.triggers) == 2
+    # Without --incremental updates to processed rows would be queued and
+    # then skipped, so they are not queued at all
+    watcher = Watcher(extractor.pipeline(db, "pages", ["text"]), max_wait=0)
+    watcher.install()
+    assert [trigger.name for trigger in db.triggers] == [
+        "pages_comprehend_queue_insert"
+    ]
+    db["pages"].update(1, {"text": "Edited 1"})
+    assert db["pages_comprehend_queue"].count == 0
+    db["pages"].insert({"id": 2, "text": "Text 2"})
+    client.batch_detect_entities.reset_mock()
+    assert watcher.process() is None
+    assert client.batch_detect_entities.call_args[1]["TextList"] == ["Text 2"]
+    assert db["pages_comprehend_queue"].count == 0
+
+
+@pytest.mark.parametrize(
+    "options,expected",
+    (
+        ([], "entities: 3 rows, 3 documents, 5,050 bytes, 31 billable units"),
+        (
+            ["--segment"],
+            "entities: 3 rows, 4 documents, 6,050 bytes, 36 billable units",
+        ),
+        (
+            ["--strip-tags"],
+            "entities: 3 rows, 3 documents, 5,050 bytes, 31 billable units\n"
+            "Estimated by stripping tags from a sample of up to 1,000 rows",
+        ),
+    ),
+)
+def test_dry_run(mocker, tmpdir, options, expected):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    tags = "--strip-tags" in options
+    db["pages"].insert_all(
+        [
+            {"id": 1, "text": "<b>{}</b>".format("a" * 50) if tags else "a" * 50},
+            {"id": 2, "text": "é" * 3000},
+            {"id": 3, "text": None},
+            {"id": 4, "text": "Too short"},
+        ],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text", "--dry-run", "--where", "id < 4"]
+        + options,
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output.strip() == expected
+    assert not boto3.called
+    assert db.table_names() == ["pages"]
+
+
+def test_dry_run_skips_done_rows(tmpdir, mocker):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "x" * 250} for i in range(1, 11)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--where", "id < 5"])
+    db["pages"].update(1, {"text": "y" * 250})
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--dry-run"]
+    )
+    assert result.output == (
+        "entities: 6 rows, 6 documents, 1,500 bytes, 18 billable units\n"
+    )
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--dry-run", "--incremental"]
+    )
+    assert result.output == (
+        "entities: 7 rows, 7 documents, 1,750 bytes, 21 billable units\n"
+    )
+    # Done rows from before fingerprints were recorded are assumed to be
+    # unchanged, as they are by --incremental
+    db.execute("update pages_comprehend_entities_done set fingerprint = null")
+    db.conn.commit()
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--dry-run", "--incremental"]
+    )
+    assert result.output == (
+        "entities: 6 rows, 6 documents, 1,500 bytes, 18 billable units\n"
+    )
+
+
+def test_max_units(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 101)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    # Each batch of 25 is 75 units, a third batch would go over
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--max-units", "200"]
+    )
+    assert result.exit_code == 0, result.output
+    assert (
+        "Stopped after sending 150 billable units, the limit set by --max-units is 200"
+        in result.output
+    )
+    assert batch_detect_entities.call_count == 2
+    assert db["pages_comprehend_entities_done"].count == 50
+    # The next run carries on from where it stopped
+    result = CliRunner().invoke(cli, ["entities", db_path, "pages", "text"])
+    assert result.exit_code == 0
+    assert batch_detect_entities.call_count == 4
+    assert db["pages_comprehend_entities_done"].count == 100
+
+
+def test_archive_and_rebuild(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i % 7)} for i in range(1, 61)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--archive"]
+    )
+    assert result.exit_code == 0, result.output
+    archive = db["pages_comprehend_entities_archive"]
+    assert archive.count == 60
+    done = {
+        row["id"]: row["fingerprint"]
+        for row in db["pages_comprehend_entities_done"].rows
+    }
+    assert {row["id"]: row["fingerprint"] for row in archive.rows} == done
+
+    sql = (
+        "select pages_comprehend_entities.id, score, comprehend_entities.name, comprehend_entity_types.value, "
+        "begin_offset, end_offset from pages_comprehend_entities "
+        "join comprehend_entities on entity = comprehend_entities.id "
+        "join comprehend_entity_types on comprehend_entities.type = comprehend_entity_types.id "
+        "order by pages_comprehend_entities.id"
+    )
+    expected = db.execute(sql).fetchall()
+    assert len(expected) == 60
+    for table in (
+        "pages_comprehend_entities",
+        "comprehend_entities",
+        "comprehend_entity_types",
+    ):
+        db[table].drop()
+
+    boto3.reset_mock()
+    result = CliRunner().invoke(cli, ["rebuild", db_path, "pages"])
+    assert result.exit_code == 0, result.output
+    assert result.output == "entities: 60 rows written\n"
+    assert not boto3.called
+    assert db.execute(sql).fetchall() == expected
+    assert db["comprehend_entities"].count == 7
+
+
+def test_rebuild_keeps_rows_not_in_archive(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 3)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text"])
+    db["pages"].insert({"id": 3, "text": "Text 3"})
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--archive"])
+    assert db["pages_comprehend_entities_archive"].count == 1
+    expected = list(db["pages_comprehend_entities"].rows)
+    assert len(expected) == 3
+    result = CliRunner().invoke(cli, ["rebuild", db_path, "pages"])
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "entities: 1 rows written\n"
+        "entities: 2 rows not in the archive were left unchanged\n"
+    )
+    # Only the archived row was replaced
+    assert list(db["pages_comprehend_entities"].rows_where(order_by="id")) == expected
+    assert db["pages_comprehend_entities_done"].count == 3
+
+
+def test_incremental_removes_replaced_archive_rows(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {}".format(i)} for i in range(1, 4)], pk="id"
+    )
+
+    def batch_detect_entities(TextList, LanguageCode):
+        response = _fake_batch_detect_entities(TextList, LanguageCode)
+        failed = [i for i, text in enumerate(TextList) if text == "Invalid"]
+        response["ResultList"] = [
+            result for result in response["ResultList"] if result["Index"] not in failed
+        ]
+        response["ErrorList"] = [
+            {"Index": i, "ErrorCode": "InvalidRequestException", "ErrorMessage": "No"}
+            for i in failed
+        ]
+        return response
+
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = batch_detect_entities
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--archive"])
+    assert db["pages_comprehend_entities_archive"].count == 3
+    # Row 1 now fails, row 2 is processed again without --archive
+    db["pages"].update(1, {"text": "Invalid"})
+    CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--incremental", "--archive"]
+    )
+    db["pages"].update(2, {"text": "Edited 2"})
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--incremental"])
+    assert [row["id"] for row in db["pages_comprehend_entities_archive"].rows] == [3]
+    expected = list(db["pages_comprehend_entities"].rows_where(order_by="id"))
+    assert [row["id"] for row in expected] == [2, 3]
+    result = CliRunner().invoke(cli, ["rebuild", db_path, "pages"])
+    assert result.exit_code == 0, result.output
+    # The old results for rows 1 and 2 are not brought back
+    assert list(db["pages_comprehend_entities"].rows_where(order_by="id")) == expected
+
+
+def test_rebuild_requires_archive(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "A"}, pk="id")
+    result = CliRunner().invoke(cli, ["rebuild", db_path, "pages", "--sentiment"])
+    assert result.exit_code == 1
+    assert result.output == (
+        "Error: Archive table pages_comprehend_sentiment_archive does not exist"
+        " - it is created by --archive\n"
+    )
+
+
+def test_cli_import_does_not_import_boto3():
+    # boto3 is only imported once a command needs a client
+    output = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, sqlite_comprehend.cli; "
+            "print(sorted(m for m in sys.modules if m.startswith('boto')))",
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert output == "[]\n"
+
+
+def test_make_client_reuses_clients(mocker):
+    boto3 = mocker.patch("boto3.client")
+    boto3.side_effect = lambda *args, **kwargs: object()
+    first = make_client("comprehend", access_key="key", secret_key="secret")
+    assert make_client("comprehend", access_key="key", secret_key="secret") is first
+    assert (
+        make_client("comprehend", access_key="other", secret_key="secret") is not first
+    )
+    assert make_client("s3", access_key="key", secret_key="secret") is not first
+    # Credentials from the environment
+    assert make_client("comprehend") is not first
+    assert boto3.call_count == 4
+
+
+def _fake_words_response(TextList, LanguageCode):
+    # One entity per word, "Name" words are people, scores vary by length
+    return {
+        "ResultList": [
+            {
+                "Index": i,
+                "Entities": [
+                    {
+                        "Score": min(len(match.group()) / 10, 1),
+                        "Type": (
+                            "PERSON" if match.group().startswith("Name") else "OTHER"
+                        ),
+                        "Text": match.group(),
+                        "BeginOffset": match.start(),
+                        "EndOffset": match.end(),
+                    }
+                    for match in re.finditer(r"\w+", text)
+                ],
+            }
+            for i, text in enumerate(TextList)
+        ],
+        "ErrorList": [],
+    }
+
+
+def _summary_from_scratch(db):
+    return db.execute("""
+        select entity, count(*), count(distinct id), round(avg(score), 6)
+        from pages_comprehend_entities group by entity order by entity
+        """).fetchall()
+
+
+def test_entities_filters_and_indexes(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [
+            {"id": 1, "text": "Name1 Namelonger2 Place"},
+            {"id": 2, "text": "Nm Namelonger Placelonger"},
+        ],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_words_response
+    result = CliRunner().invoke(
+        cli,
+        ["entities", db_path, "pages", "text"]
+        + ["--min-score", "0.6", "--types", "person, location"],
+    )
+    assert result.exit_code == 0, result.output
+    assert [
+        (row["page_id"], row["entity_name"], row["entity_type"])
+        for row in db.query(ENTITIES_SQL + " order by page_id, begin_offset")
+    ] == [(1, "Namelonger2", "PERSON"), (2, "Namelonger", "PERSON")]
+    # Filtered entities are not added to comprehend_entities
+    assert db["comprehend_entities"].count == 2
+    assert {
+        tuple(index.columns) for index in db["pages_comprehend_entities"].indexes
+    } == {("id",), ("entity",)}
+
+
+def test_entities_types_invalid(tmpdir):
+    db_path = str(tmpdir / "data.db")
+    sqlite_utils.Database(db_path)["pages"].insert({"id": 1, "text": "A"}, pk="id")
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--types", " , "]
+    )
+    assert result.exit_code == 2
+    assert "should be e.g. PERSON,LOCATION" in result.output
+
+
+def test_entities_summary(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [
+            {
+                "id": i,
+                "text": "Name{} Place{} Place{} Common".format(i % 3, i % 4, i % 5),
+            }
+            for i in range(1, 41)
+        ],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_words_response
+    # Rows written before --summary was used are included in it
+    runner = CliRunner()
+    runner.invoke(cli, ["entities", db_path, "pages", "text", "--where", "id <= 10"])
+    result = runner.invoke(cli, ["entities", db_path, "pages", "text", "--summary"])
+    assert result.exit_code == 0, result.output
+
+    def summary():
+        return [
+            (
+                row["entity"],
+                row["mentions"],
+                row["documents"],
+                round(row["average_score"], 6),
+            )
+            for row in db["pages_comprehend_entities_summary"].rows_where(
+                order_by="entity"
+            )
+        ]
+
+    assert summary() == _summary_from_scratch(db)
+    common = db.execute(
+        "select id from comprehend_entities where name = 'Common'"
+    ).fetchone()[0]
+    assert db["pages_comprehend_entities_summary"].get(common)["documents"] == 40
+
+    # Changed rows are subtracted from the summary before they are added again
+    for i in range(1, 41, 3):
+        db["pages"].update(i, {"text": "Name{} Other".format(i % 2)})
+    result = runner.invoke(
+        cli, ["entities", db_path, "pages", "text", "--summary", "--incremental"]
+    )
+    assert result.exit_code == 0, result.output
+    assert summary() == _summary_from_scratch(db)
+    assert db["pages_comprehend_entities_summary"].get(common)["documents"] == 26
+
+
+def test_rebuild_with_filters_and_summary(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Name{} Ab Placename".format(i)} for i in range(1, 31)],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_words_response
+    CliRunner().invoke(cli, ["entities", db_path, "pages", "text", "--archive"])
+    assert db["pages_comprehend_entities"].count == 90
+    result = CliRunner().invoke(
+        cli, ["rebuild", db_path, "pages", "--min-score", "0.5", "--summary"]
+    )
+    assert result.exit_code == 0, result.output
+    assert result.output == "entities: 60 rows written\n"
+    assert db["pages_comprehend_entities"].count == 60
+    assert [
+        (row["mentions"], row["documents"])
+        for row in db["pages_comprehend_entities_summary"].rows_where(
+            order_by="mentions desc", limit=1
+        )
+    ] == [(30, 30)]
+    assert db.execute(
+        "select entity, mentions, documents, round(average_score, 6) "
+        "from pages_comprehend_entities_summary order by entity"
+    ).fetchall() == _summary_from_scratch(db)
+
+
+def test_run_jobs(mocker, tmpdir):
+    content = sqlite_utils.Database(str(tmpdir / "content.db"))
+    content["pages"].insert_all(
+        [{"id": i, "text": "Page {}".format(i)} for i in range(1, 61)], pk="id"
+    )
+    content["posts"].insert_all(
+        [
+            {"id": i, "body": "<p>Post {}</p>".format(i), "draft": i % 2}
+            for i in range(1, 41)
+        ],
+        pk="id",
+    )
+    (tmpdir / "archive").mkdir()
+    archive = sqlite_utils.Database(str(tmpdir / "archive" / "archive.db"))
+    archive["letters"].insert_all(
+        [{"id": i, "text": "Letter {}".format(i)} for i in range(1, 31)], pk="id"
+    )
+    jobs_path = tmpdir / "jobs.toml"
+    jobs_path.write_text(
+        """
+        [[jobs]]
+        database = "content.db"
+        table = "pages"
+        columns = "text"
+
+        [[jobs]]
+        database = "content.db"
+        table = "posts"
+        columns = ["body"]
+        where = "draft = :draft"
+        params = {draft = 0}
+        output = "post_entities"
+        strip_tags = true
+
+        [[jobs]]
+        database = "archive/archive.db"
+        table = "letters"
+        columns = ["text"]
+        """,
+        "utf-8",
+    )
+    boto3 = mocker.patch("boto3.client")
+    batch_detect_entities = boto3.return_value.batch_detect_entities
+    batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["run", str(jobs_path), "--concurrency", "2", "--stats"]
+    )
+    assert result.exit_code == 0, result.output
+    assert "content.db pages: 60 rows processed" in result.output
+    assert "content.db posts: 20 rows processed" in result.output
+    assert "archive.db letters: 30 rows processed" in result.output
+    # Full batches from each table are sent in turn, then the partial ones
+    first_texts = [
+        calls[1]["TextList"][0] for calls in batch_detect_entities.call_args_list
+    ]
+    assert first_texts[:3] == ["Page 1", "Letter 1", "Page 26"]
+    assert sorted(first_texts) == [
+        "Letter 1",
+        "Letter 26",
+        "Page 1",
+        "Page 26",
+        "Page 51",
+        "Post 2",
+    ]
+    assert content["pages_comprehend_entities_done"].count == 60
+    assert content["post_entities_done"].count == 20
+    # Tags were stripped from posts only
+    assert {
+        row["name"]
+        for row in content.query(
+            "select name from comprehend_entities "
+            "join post_entities on post_entities.entity = comprehend_entities.id"
+        )
+    } == {"Post {}".format(i) for i in range(2, 41, 2)}
+    assert archive["letters_comprehend_entities_done"].count == 30
+    # Entity IDs are shared by the tables in each database
+    assert content["comprehend_entities"].count == 80
+    assert archive["comprehend_entities"].count == 30
+    assert "Entity cache: 0 hits, 80 misses" in result.output
+    # Running again picks up where each job left off
+    result = CliRunner().invoke(cli, ["run", str(jobs_path)])
+    assert result.exit_code == 0, result.output
+    assert "content.db pages: 0 rows processed" in result.output
+    assert batch_detect_entities.call_count == 6
+
+
+def test_run_jobs_dry_run_and_max_units(mocker, tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    for table in ("pages", "posts"):
+        db[table].insert_all(
+            [{"id": i, "text": "Text {}".format(i)} for i in range(1, 41)], pk="id"
+        )
+    jobs_path = tmpdir / "jobs.json"
+    jobs_path.write_text(
+        json.dumps(
+            [
+                {"database": "data.db", "table": table, "columns": ["text"]}
+                for table in ("pages", "posts")
+            ]
+        ),
+        "utf-8",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(cli, ["run", str(jobs_path), "--dry-run"])
+    assert result.exit_code == 0, result.output
+    assert result.output == (
+        "data.db pages: entities: 40 rows, 40 documents, 271 bytes, 120 billable units\n"
+        "data.db posts: entities: 40 rows, 40 documents, 271 bytes, 120 billable units\n"
+    )
+    assert not boto3.called
+    result = CliRunner().invoke(
+        cli, ["run", str(jobs_path), "--max-units", "100", "--no-count"]
+    )
+    assert result.exit_code == 0, result.output
+    assert (
+        "Stopped after sending 75 billable units, the limit set by --max-units is 100"
+        in result.output
+    )
+    assert boto3.return_value.batch_detect_entities.call_count == 1
+
+
+def test_run_jobs_share_prepare_pool(mocker, tmpdir):
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    for table in ("pages", "posts", "letters"):
+        db[table].insert_all(
+            [{"id": i, "text": "<p>{} {}</p>".format(table, i)} for i in range(1, 31)],
+            pk="id",
+        )
+    jobs_path = tmpdir / "jobs.json"
+    jobs_path.write_text(
+        json.dumps(
+            [
+                {"database": "data.db", "table": table, "columns": ["text"]}
+                for table in ("pages", "posts", "letters")
+            ]
+        ),
+        "utf-8",
+    )
+    boto3 = mocker.patch("boto3.client")
+    boto3.return_value.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    shutdown = mocker.spy(concurrent.futures.ProcessPoolExecutor, "shutdown")
+    pool_class = mocker.patch(
+        "concurrent.futures.ProcessPoolExecutor",
+        wraps=concurrent.futures.ProcessPoolExecutor,
+    )
+    result = CliRunner().invoke(
+        cli, ["run", str(jobs_path), "--prepare-workers", "2", "--no-count"]
+    )
+    assert result.exit_code == 0, result.output
+    # One pool for all of the jobs, shut down once the command has finished
+    assert pool_class.call_count == 1
+    assert pool_class.call_args[1] == {"max_workers": 2}
+    assert shutdown.call_count == 1
+    assert db["letters_comprehend_entities_done"].count == 30
+
+
+@pytest.mark.parametrize(
+    "spec,error",
+    (
+        ("[]", "does not list any jobs"),
+        ('{"jobs": [{"database": "data.db"}]}', "Job 1 is missing: table, columns"),
+        (
+            '[{"database": "data.db", "table": "t", "columns": "c", "colour": 1}]',
+            "Job 1 has unknown settings: colour",
+        ),
+        (
+            '[{"database": "missing.db", "table": "t", "columns": "c"}]',
+            "Job 1: database missing.db does not exist",
+        ),
+        (
+            '[{"database": "data.db", "table": "t", "columns": "c"},'
+            ' {"database": "./data.db", "table": "t", "columns": "d"}]',
+            "Job 2 writes to the same output table as job 1",
+        ),
+    ),
+)
+def test_run_jobs_invalid(tmpdir, spec, error):
+    sqlite_utils.Database(str(tmpdir / "data.db"))["t"].insert({"c": "a"})
+    jobs_path = tmpdir / "jobs.json"
+    jobs_path.write_text(spec, "utf-8")
+    result = CliRunner().invoke(cli, ["run", str(jobs_path)])
+    assert result.exit_code == 1
+    assert error in result.output
+
+
+def _fake_detect_dominant_language(TextList):
+    languages = {"Bonjour": "fr", "Salve": "la", "Hello": "en"}
+    return {
+        "ResultList": [
+            {
+                "Index": i,
+                "Languages": [
+                    {"LanguageCode": "en", "Score": 0.1},
+                    {"LanguageCode": languages[text.split()[0]], "Score": 0.9},
+                ],
+            }
+            for i, text in enumerate(TextList)
+        ],
+        "ErrorList": [],
+    }
+
+
+def test_entities_auto_language(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    # Alternating languages, so every chunk has rows in each of them
+    greetings = ("Hello", "Bonjour", "Hello", "Bonjour", "Salve")
+    db["pages"].insert_all(
+        [{"id": i, "text": "{} {}".format(greetings[i % 5], i)} for i in range(1, 76)],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_dominant_language.side_effect = _fake_detect_dominant_language
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--auto-language", "--stats"]
+    )
+    assert result.exit_code == 0, result.output
+    # One detection call for each chunk of 25 rows
+    assert client.batch_detect_dominant_language.call_count == 3
+    # Full batches of one language first, then what is left of each one
+    batches = [
+        (
+            calls[1]["LanguageCode"],
+            {text.split()[0] for text in calls[1]["TextList"]},
+            len(calls[1]["TextList"]),
+        )
+        for calls in client.batch_detect_entities.call_args_list
+    ]
+    assert sorted(batches) == [
+        ("en", {"Hello"}, 5),
+        ("en", {"Hello"}, 25),
+        ("fr", {"Bonjour"}, 5),
+        ("fr", {"Bonjour"}, 25),
+    ]
+    # Latin is not supported, so those rows were recorded as errors
+    errors = list(db["comprehend_errors"].rows)
+    assert len(errors) == 15
+    assert {error["error_code"] for error in errors} == {"UnsupportedLanguageException"}
+    assert errors[0]["error_message"] == "entities does not support language la"
+    assert db.execute(
+        "select language, count(*) from pages_comprehend_entities_done "
+        "group by language order by language"
+    ).fetchall() == [("en", 30), ("fr", 30), ("la", 15)]
+    assert db["comprehend_languages"].count == 75
+    assert "Language cache: 0 hits, 75 misses" in result.output
+    # Languages are not detected again for text that has not changed
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--auto-language", "--reset"]
+    )
+    assert client.batch_detect_dominant_language.call_count == 3
+    assert client.batch_detect_entities.call_count == 8
+    assert db["pages_comprehend_entities_done"].count == 75
+
+
+def test_entities_auto_language_budget_after_detection(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [{"id": i, "text": "Hello {}".format(i)} for i in range(1, 26)], pk="id"
+    )
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_dominant_language.side_effect = _fake_detect_dominant_language
+    # Enough for detecting the languages, but not for detecting entities
+    result = CliRunner().invoke(
+        cli,
+        [
+            "entities",
+            db_path,
+            "pages",
+            "text",
+            "--auto-language",
+            "--max-units",
+            "75",
+        ],
+    )
+    assert result.exit_code == 0, result.output
+    assert client.batch_detect_dominant_language.call_count == 1
+    assert not client.batch_detect_entities.called
+    # The detected languages were still saved
+    assert db["comprehend_languages"].count == 25
+
+
+def test_entities_language_column(mocker, tmpdir):
+    db_path = str(tmpdir / "data.db")
+    db = sqlite_utils.Database(db_path)
+    db["pages"].insert_all(
+        [
+            {"id": i, "text": "Text {}".format(i), "lang": lang}
+            for i, lang in enumerate(("de", "en", None, "de", "xx"), 1)
+        ],
+        pk="id",
+    )
+    boto3 = mocker.patch("boto3.client")
+    client = boto3.return_value
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    result = CliRunner().invoke(
+        cli, ["entities", db_path, "pages", "text", "--language-column", "lang"]
+    )
+    assert result.exit_code == 0, result.output
+    assert not client.batch_detect_dominant_language.called
+    assert sorted(
+        (calls[1]["LanguageCode"], calls[1]["TextList"])
+        for calls in client.batch_detect_entities.call_args_list
+    ) == [("de", ["Text 1", "Text 4"]), ("en", ["Text 2", "Text 3"])]
+    # Rows without a language use the default
+    assert db.execute(
+        "select id, language from pages_comprehend_entities_done order by id"
+    ).fetchall() == [(1, "de"), (2, "en"), (3, "en"), (4, "de"), (5, "xx")]
+    assert [row["row_pks"] for row in db["comprehend_errors"].rows] == ['{"id": 5}']
+
+
+@pytest.mark.parametrize("wal", (False, True))
+def test_entity_extractor_reads_pages_during_large_transaction(mocker, tmpdir, wal):
+    # Several pages of rows are read while one transaction spills its
+    # changes to the database file, which a second connection would wait on
+    mocker.patch("sqlite_comprehend.pipeline.PAGE_SIZE", 100)
+    db = sqlite_utils.Database(str(tmpdir / "data.db"))
+    db["pages"].insert_all(
+        [{"id": i, "text": "Text {} {}".format(i, "x" * 2000)} for i in range(1, 501)],
+        pk="id",
+    )
+    if wal:
+        db.enable_wal()
+    db.execute("pragma busy_timeout = 100")
+    db.execute("pragma cache_size = 10")
+    client = mocker.Mock()
+    client.batch_detect_entities.side_effect = _fake_batch_detect_entities
+    extractor = EntityExtractor(client, rate=1000, commit_every=(1000, "chunks"))
+    pipeline = extractor.pipeline(db, "pages", ["text"])
+    assert (pipeline.read_db is db) is not wal
+    pipeline.run(pipeline.pending_rows())
+    assert db["pages_comprehend_entities_done"].count == 500